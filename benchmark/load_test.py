@@ -0,0 +1,405 @@
+# LOAD GENERATOR AND BENCHMARK
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import hashlib
+import re
+from urllib.parse import unquote
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'common'))
+from framing import FrameDecoder
+from wire import PROTOCOL_V2, FLAG_AEAD, encode_packet, decode_packet
+from chunking import CHUNK_SIZE, chunk_count
+from session_crypto import (KEY_EXCHANGE, generate_keypair, derive_session_keys, encode_key, decode_key,
+                            new_nonce_prefix, seal_chunk, stream_cipher)
+
+# Constants
+MESSAGE_TYPES = ["chat", "private", "fhir", "media"]
+FHIR_SAMPLES = ["general_patient.json", "mom.json"]
+MEDIA_SAMPLES = ["image.png", "simpsons.gif", "file.pdf"]
+BENCH_TAG = "bench"
+SERVER_START_TIMEOUT = 15  # seconds
+UPLOAD_TIMEOUT = 60  # seconds
+PRIVATE_ERROR = re.compile(r"User '.*' not found")  # The only error a private message to a bench client can get
+SKIP_NOTICE = re.compile(r"\d+ messages were skipped")  # Sent by the server, not caused by a request
+
+# Latency samples and counters for one message type within one phase
+class TypeStats:
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.latencies = []
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        return {
+            "sent": self.sent,
+            "delivered": self.delivered,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "sent_per_sec": self.sent / elapsed if elapsed else 0.0,
+            "delivered_per_sec": self.delivered / elapsed if elapsed else 0.0,
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] * 1000 if latencies else None,
+            },
+        }
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index] * 1000
+
+# Shared state for every simulated client during one phase
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.stats = {message_type: TypeStats() for message_type in MESSAGE_TYPES}
+        self.upload_started = {}  # transfer ID -> send time
+        self.upload_names = {}  # published file name -> transfer ID
+        self.skip_notices = 0
+
+# One simulated user speaking the real protocol: v2 framing, X25519 session,
+# chat/private messages and chunked AES-GCM uploads
+class SimClient:
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.index = index
+        self.nick = None
+        self.reader = None
+        self.writer = None
+        self.aead = None
+        self.ready = asyncio.Event()
+        self.upload_acks = {}
+        self.upload_results = {}
+        self.sequence = 0
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        private_key, public_key = generate_keypair()
+        self.private_key, self.public_key = private_key, public_key
+        await self.send({"type": "hello", "nick": f"{BENCH_TAG}{self.index}", "category": "Other",
+                         "protocol": PROTOCOL_V2, "key_exchange": KEY_EXCHANGE, "public_key": encode_key(public_key),
+                         "heartbeat": True, "presence": True}, version=1)
+        asyncio.ensure_future(self.receive_loop())
+        await self.ready.wait()
+
+    async def send(self, packet, payload=None, flags=0, version=PROTOCOL_V2):
+        frame = encode_packet(packet, payload, version, flags)
+        self.writer.write(frame)
+        await self.writer.drain()
+        return len(frame)
+
+    async def receive_loop(self):
+        decoder = FrameDecoder()
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            for frame in decoder.feed(data):
+                self.dispatch(decode_packet(frame)[0])
+
+    def dispatch(self, message):
+        now = time.monotonic()
+        phase = self.bench.phase
+        message_type = message['type']
+        if message_type == 'ping':
+            self.writer.write(encode_packet({"type": "pong"}, version=PROTOCOL_V2))
+        elif message_type == 'update_nick':
+            self.nick = message['nick']
+            server_public_key = decode_key(message['public_key'])
+            session_keys = derive_session_keys(self.private_key, self.public_key, server_public_key, server_public_key)
+            self.aead = stream_cipher(session_keys.stream_key)
+            self.ready.set()
+        elif message_type in ('chat', 'private'):
+            parts = message['message'].split(' ')
+            if phase is not None and len(parts) == 3 and parts[0] == BENCH_TAG:
+                stats = phase.stats[message_type]
+                stats.delivered += 1
+                stats.latencies.append(now - float(parts[2]))
+        elif message_type in ('fhir', 'media'):
+            name = unquote(message['data'].rsplit('/', 1)[-1])
+            started = phase.upload_started.get(phase.upload_names.get(name)) if phase else None
+            if started is not None:
+                stats = phase.stats[message_type]
+                stats.delivered += 1
+                stats.latencies.append(now - started)
+        elif message_type == 'upload_ack':
+            future = self.upload_acks.pop(message['transfer_id'], None)
+            if future is not None and not future.done():
+                future.set_result(message['next_chunk'])
+        elif message_type == 'upload_done':
+            future = self.upload_results.pop(message['transfer_id'], None)
+            if future is not None and not future.done():
+                future.set_result(True)
+        elif message_type == 'error':
+            for futures in (self.upload_acks, self.upload_results):
+                future = futures.pop(message.get('transfer_id'), None)
+                if future is not None and not future.done():
+                    future.set_exception(IOError(message['message']))
+            # Upload errors are counted by send_one through the failed future;
+            # anything else is the reply to a chat or private message
+            if phase is not None and not message.get('transfer_id'):
+                if SKIP_NOTICE.match(message['message']):
+                    phase.skip_notices += 1
+                elif PRIVATE_ERROR.fullmatch(message['message']):
+                    phase.stats['private'].errors += 1
+                else:
+                    phase.stats['chat'].errors += 1
+
+    # Function to send one message of the given type and count it
+    async def send_one(self, message_type, phase):
+        stats = phase.stats[message_type]
+        self.sequence += 1
+        text = f"{BENCH_TAG} {self.index}.{self.sequence} {time.monotonic()}"
+        try:
+            if message_type == 'chat':
+                stats.bytes_sent += await self.send({"type": "chat", "message": text})
+            elif message_type == 'private':
+                target = random.choice([client for client in self.bench.clients if client is not self])
+                stats.bytes_sent += await self.send({"type": "private", "target": target.nick, "message": text})
+            else:
+                stats.bytes_sent += await self.upload(message_type, phase)
+            stats.sent += 1
+        except Exception:
+            stats.errors += 1
+
+    # Function to run a chunked upload and wait for the server to publish it
+    async def upload(self, kind, phase):
+        filename, data, digest = random.choice(self.bench.samples[kind])
+        transfer_id = uuid.uuid4().hex
+        # Make every upload publish under its own name so its delivery can be
+        # matched to this transfer: FHIR files are named by their digest, so
+        # the resource gets the transfer ID as its id; media names keep the
+        # sender's file name
+        if kind == 'fhir':
+            resource = json.loads(data)
+            resource['id'] = transfer_id
+            data = json.dumps(resource).encode('utf-8')
+            digest = hashlib.sha256(data).hexdigest()
+            name = f"{digest}.json"
+        else:
+            filename = f"{transfer_id}-{filename}"
+            name = f"{digest[:16]}-{filename}"
+        nonce_prefix = new_nonce_prefix()
+        loop = asyncio.get_running_loop()
+        self.upload_acks[transfer_id] = loop.create_future()
+        self.upload_results[transfer_id] = done = loop.create_future()
+        phase.upload_names[name] = transfer_id
+        phase.upload_started[transfer_id] = time.monotonic()
+        sent = await self.send({"type": "upload_start", "transfer_id": transfer_id, "kind": kind, "filename": filename,
+                                "size": len(data), "chunk_size": CHUNK_SIZE, "sha256": digest,
+                                "cipher": "aesgcm", "nonce_prefix": encode_key(nonce_prefix)})
+        start = await asyncio.wait_for(self.upload_acks[transfer_id], UPLOAD_TIMEOUT)
+        total_chunks = chunk_count(len(data))
+        for index in range(start, total_chunks):
+            chunk = data[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+            sealed = seal_chunk(self.aead, nonce_prefix, index, index == total_chunks - 1, chunk, transfer_id)
+            sent += await self.send({"type": "upload_chunk", "transfer_id": transfer_id, "index": index}, sealed, FLAG_AEAD)
+        await asyncio.wait_for(done, UPLOAD_TIMEOUT)
+        return sent
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+# Function to read CPU seconds and memory of a local process from /proc
+def process_usage(pid):
+    if pid is None or not os.path.exists(f"/proc/{pid}/stat"):
+        return None
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    usage = {"cpu_seconds": (int(fields[11]) + int(fields[12])) / ticks}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                name, value = line.split(':', 1)
+                usage["rss_kb" if name == 'VmRSS' else "peak_rss_kb"] = int(value.split()[0])
+    return usage
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.clients = []
+        self.phase = None
+        self.server_pid = None
+        self.samples = {"fhir": load_samples('fhir_files', FHIR_SAMPLES), "media": load_samples('media_files', MEDIA_SAMPLES)}
+
+    # Function to drive one phase: every client sends the given mix at the
+    # configured per-client rate for the phase duration (nothing, for the
+    # idle phase)
+    async def run_phase(self, name, weights):
+        phase = self.phase = Phase(name)
+        before = process_usage(self.server_pid)
+        started = time.monotonic()
+        deadline = started + self.args.duration
+        types = list(weights)
+        type_weights = [weights[message_type] for message_type in types]
+
+        async def drive(client):
+            if not types:
+                await asyncio.sleep(deadline - time.monotonic())  # Idle phase: only pings and pongs
+                return
+            while True:
+                await asyncio.sleep(random.expovariate(self.args.rate))
+                if time.monotonic() >= deadline:
+                    return
+                await client.send_one(random.choices(types, type_weights)[0], phase)
+
+        await asyncio.gather(*(drive(client) for client in self.clients))
+        await asyncio.sleep(self.args.drain)  # Let in-flight fan-out arrive
+        elapsed = time.monotonic() - started
+        after = process_usage(self.server_pid)
+
+        result = {"name": name, "duration_sec": elapsed, "mix": weights,
+                  "types": {message_type: phase.stats[message_type].report(elapsed) for message_type in types}}
+        sent = sum(phase.stats[message_type].sent for message_type in types)
+        delivered = sum(phase.stats[message_type].delivered for message_type in types)
+        result["messages_per_sec"] = sent / elapsed
+        result["deliveries_per_sec"] = delivered / elapsed
+        all_latencies = sorted(latency for message_type in types for latency in phase.stats[message_type].latencies)
+        result["fanout_latency_ms"] = {"p50": percentile(all_latencies, 50), "p99": percentile(all_latencies, 99)}
+        result["skip_notices"] = phase.skip_notices
+        if before and after:
+            cpu = after["cpu_seconds"] - before["cpu_seconds"]
+            result["server"] = {"cpu_seconds": cpu, "cpu_percent": 100 * cpu / elapsed,
+                                "cpu_ms_per_message": 1000 * cpu / sent if sent else None,
+                                "rss_kb": after.get("rss_kb"), "peak_rss_kb": after.get("peak_rss_kb")}
+        self.phase = None
+        return result
+
+    async def run(self, host, port):
+        for index in range(self.args.clients):
+            client = SimClient(self, index)
+            await client.connect(host, port)
+            self.clients.append(client)
+
+        phases = []
+        for name in self.args.phases:
+            weights = parse_mix(self.args.mix) if name == 'mixed' else {} if name == 'idle' else {name: 1}
+            print(f"*** Running phase '{name}' with {len(self.clients)} clients for {self.args.duration}s")
+            phases.append(await self.run_phase(name, weights))
+            print_phase(phases[-1])
+
+        for client in self.clients:
+            client.close()
+        return phases
+
+def load_samples(directory, names):
+    samples = []
+    for name in names:
+        with open(os.path.join(REPO_DIR, directory, name), 'rb') as f:
+            data = f.read()
+        samples.append((name, data, hashlib.sha256(data).hexdigest()))
+    return samples
+
+def parse_mix(text):
+    weights = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in MESSAGE_TYPES:
+            raise SystemExit(f"Unknown message type in --mix: {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+def print_phase(result):
+    server = result.get("server", {})
+    print(f"    {result['messages_per_sec']:.1f} msg/s sent, {result['deliveries_per_sec']:.1f} deliveries/s, "
+          f"fan-out p50 {format_ms(result['fanout_latency_ms']['p50'])} p99 {format_ms(result['fanout_latency_ms']['p99'])}"
+          + (f", server CPU {server['cpu_percent']:.0f}% RSS {server['rss_kb'] // 1024}MB" if server else ""))
+    for message_type, stats in result["types"].items():
+        print(f"    {message_type:8} sent {stats['sent']:6} delivered {stats['delivered']:7} errors {stats['errors']:4} "
+              f"p50 {format_ms(stats['latency_ms']['p50'])} p99 {format_ms(stats['latency_ms']['p99'])}")
+
+def format_ms(value):
+    return "-" if value is None else f"{value:.2f}ms"
+
+# Function to start chat_server.py in a scratch directory and wait for it
+def spawn_server(port, server_args):
+    workdir = tempfile.mkdtemp(prefix="dpc_bench_")
+    server_path = os.path.join(REPO_DIR, 'server', 'chat_server.py')
+    process = subprocess.Popen([sys.executable, server_path, str(port)] + server_args, cwd=workdir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    host = socket.gethostbyname(socket.gethostname())
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("*** The server exited during startup")
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process, host, workdir
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise SystemExit("*** The server did not start listening in time")
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="DP Chat load generator and benchmark")
+    parser.add_argument("--host", help="Benchmark a running server instead of spawning one")
+    parser.add_argument("--port", type=int, default=23456)
+    parser.add_argument("--clients", type=int, default=50, help="Number of simulated users")
+    parser.add_argument("--rate", type=float, default=2.0, help="Messages per second per client")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per phase")
+    parser.add_argument("--drain", type=float, default=1.0, help="Seconds to wait for deliveries after each phase")
+    parser.add_argument("--phases", nargs='+', default=MESSAGE_TYPES + ["mixed"],
+                        choices=MESSAGE_TYPES + ["mixed", "idle"],
+                        help="Phases to run, in order; 'idle' keeps every client connected without sending")
+    parser.add_argument("--mix", default="chat=80,private=10,fhir=5,media=5", help="Message mix for the mixed phase")
+    parser.add_argument("--label", help="Free-form label stored with the results")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON results")
+    parser.add_argument("--server-arg", action='append', default=[], help="Extra argument for a spawned server")
+    args = parser.parse_args()
+
+    server_process = None
+    if args.host:
+        host = args.host
+    else:
+        server_process, host, workdir = spawn_server(args.port, args.server_arg)
+        print(f"*** Spawned server (pid {server_process.pid}) in {workdir}")
+
+    benchmark = Benchmark(args)
+    benchmark.server_pid = server_process.pid if server_process else None
+    try:
+        phases = asyncio.run(benchmark.run(host, args.port))
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    results = {
+        "version": git_version(),
+        "label": args.label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "parameters": {"clients": args.clients, "rate": args.rate, "duration": args.duration,
+                       "mix": args.mix, "server_args": args.server_arg, "spawned_server": server_process is not None},
+        "phases": phases,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"*** Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
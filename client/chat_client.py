@@ -6,20 +6,47 @@ import sys
 import json
 import os
 import re
-from chatui import init_windows, read_command, print_message, end_windows
-from fhir.resources.patient import Patient # type: ignore
-from pydantic import ValidationError # type: ignore
+import base64
+import queue
+import itertools
+import time
+import uuid
+import io
+import hashlib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from wire import PROTOCOL_V1, PROTOCOL_V2, SUPPORTED_PROTOCOL, FLAG_FERNET_RAW, FLAG_AEAD, encode_packet, decode_packet
+from session_crypto import (KEY_EXCHANGE, STREAM_CIPHER, generate_keypair, derive_session_keys,
+                            encode_key, decode_key, new_nonce_prefix, seal_chunk, stream_cipher)
+from chunking import CHUNK_SIZE, MAX_TRANSFER_SIZE, file_digest, transfer_id_for, chunk_count
+from framing import FrameDecoder, MAX_FRAME_SIZE
+from compression import supported_codecs, compress, pack_text, unpack_text
+from chatui import init_windows, read_command, print_message, print_messages, set_status, set_completer, end_windows
+from fhir_handler import validate_fhir_data
 from cryptography.fernet import Fernet # type: ignore
 
 # Constants
-HEADER_LENGTH = 4
+RECV_BUFFER_SIZE = 64 * 1024
 CATEGORIES = ["Doctor", "Nurse", "Patient", "Other"]
 MEDIA_TYPES = ['.jpg', '.jpeg', '.png', '.gif', '.pdf']
-MAX_FILE_SIZE = 5 * 1024 * 1024  # 5 MB
-
-# Encryption key (for demonstration, in practice would handle this more securely)
-ENCRYPTION_KEY = Fernet.generate_key()
-cipher_suite = Fernet(ENCRYPTION_KEY)
+MAX_FILE_SIZE = 5 * 1024 * 1024  # 5 MB, for servers without chunked uploads
+UPLOAD_ACK_TIMEOUT = 30  # seconds
+SESSION_TIMEOUT = 10  # seconds
+PRIORITY_CHAT = 0  # chat, private messages and upload control packets
+PRIORITY_BULK = 1  # file contents
+PRIORITY_STOP = 2  # tells the writer to exit once everything else is sent
+MAX_QUEUED_CHUNKS = 4  # encrypted chunks prepared ahead of the writer
+PROGRESS_INTERVAL = 0.25  # seconds between status line updates
+STATE_FILE = os.path.join(os.path.expanduser("~"), ".dpc_chat_state.json")
+DEFAULT_ROOM = "lobby"
+PRESENCE_NAMES_SHOWN = 5  # names listed when a presence update covers several users
+TARGETED_COMMAND = re.compile(r'^(/send_(?:private|fhir|media)=)(["\']?)([^"\']*)$')
+
+# Ephemeral key pair for this connection. The session keys are derived once
+# the server's public key arrives in update_nick; no key is ever sent.
+private_key, public_key = generate_keypair()
+cipher_suite = None
+stream_aead = None
+session_ready = threading.Event()
 
 # Handle command line arguments
 if len(sys.argv) != 4:
@@ -30,6 +57,36 @@ nickname = sys.argv[1]
 server_address = sys.argv[2]
 port = int(sys.argv[3])
 
+# Function to load what this client remembers about each server it has
+# used, keyed by "host:port"
+def load_state():
+    try:
+        with open(STATE_FILE) as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+# Function to remember the rooms we are in and the newest message sequence
+# number seen, with the ID of the server log it belongs to, so the next
+# connection can rejoin them and ask the server for what was missed in between
+def save_state():
+    state = load_state()
+    state[server_key] = {"last_seq": last_seq, "log_id": log_id, "rooms": sorted(joined_rooms)}
+    try:
+        with open(STATE_FILE, 'w') as f:
+            json.dump(state, f)
+    except OSError:
+        pass
+
+server_key = f"{server_address}:{port}"
+saved_state = load_state().get(server_key, {})
+last_seq = saved_state.get("last_seq")
+log_id = saved_state.get("log_id")
+joined_rooms = set(saved_state.get("rooms") or [DEFAULT_ROOM])
+# Room that chat and shared files without a target go to
+current_room = DEFAULT_ROOM if DEFAULT_ROOM in joined_rooms else min(joined_rooms)
+
 # Initialize TUI
 init_windows()
 
@@ -50,44 +107,426 @@ nickname_with_category = f"{nickname} ({category})"
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 client_socket.connect((server_address, port))
 
-# Send initial "hello" packet
-hello_packet = json.dumps({"type": "hello", "nick": nickname, "category": category, "encryption_key": ENCRYPTION_KEY.decode()})
-client_socket.send(len(hello_packet).to_bytes(HEADER_LENGTH, byteorder='big') + hello_packet.encode('utf-8'))
-
-# Function to receive messages from the server
+# Protocol version agreed with the server; v1 until update_nick says otherwise
+protocol_version = PROTOCOL_V1
+# Compression codec agreed with the server, if any
+compression_codec = None
+# Everyone online, casefolded nick -> (nick, category), kept up to date from
+# the server's roster snapshot and presence updates. Servers that send no
+# roster leave roster_known False, and targets are not checked locally.
+roster = {}
+roster_known = False
+
+# Outgoing frames, sent by the writer thread. Chat frames sort ahead of file
+# contents, so a message typed during an upload waits for at most one chunk.
+# The sequence number keeps frames of the same priority in order.
+send_queue = queue.PriorityQueue()
+send_sequence = itertools.count()
+
+# Function to queue a packet in the negotiated protocol version. File frames
+# carry their upload and the number of file bytes they hold, for progress.
+def send_packet(packet, payload=None, flags=0, priority=PRIORITY_CHAT, upload=None, file_bytes=0):
+    frame = encode_packet(packet, payload, protocol_version, flags)
+    send_queue.put((priority, next(send_sequence), frame, upload, file_bytes))
+
+# Function to queue a chat or private message, compressing long text when
+# the server agreed to a codec
+def send_text(packet):
+    codec = compression_codec if protocol_version >= PROTOCOL_V2 else None
+    packet, payload = pack_text(packet, 'message', codec)
+    send_packet(packet, payload)
+
+# Function run by the writer thread: the only place that writes to the socket
+def write_frames():
+    while True:
+        _, _, frame, upload, file_bytes = send_queue.get()
+        if frame is None:
+            return
+        if upload is not None and upload["cancelled"]:
+            upload["window"].release()
+            continue
+        try:
+            client_socket.sendall(frame)
+        except OSError as e:
+            print_message(f"*** Connection to server lost: {e}")
+            return
+        if upload is not None:
+            upload["window"].release()
+            report_progress(upload, file_bytes)
+
+# Function to queue one frame of file contents. At most MAX_QUEUED_CHUNKS
+# frames per upload wait for the writer, so memory stays bounded however
+# large the file is.
+def send_file_frame(upload, packet, payload, flags, file_bytes):
+    while not upload["window"].acquire(timeout=1):
+        if upload["cancelled"]:
+            return
+        if not writer_thread.is_alive():
+            raise ConnectionError("The connection to the server is closed")
+    send_packet(packet, payload, flags, PRIORITY_BULK, upload, file_bytes)
+
+# Function to send an encrypted file body: raw bytes on v2, a JSON string on v1
+def send_encrypted(upload, packet, token, file_bytes):
+    if protocol_version >= PROTOCOL_V2:
+        send_file_frame(upload, packet, base64.urlsafe_b64decode(token), FLAG_FERNET_RAW, file_bytes)
+    else:
+        packet["data"] = token.decode('latin1')
+        send_file_frame(upload, packet, None, 0, file_bytes)
+
+# Function to derive the session ciphers from the server's half of the exchange
+def establish_session(message):
+    global cipher_suite, stream_aead
+    if message.get('key_exchange') != KEY_EXCHANGE:
+        print_message("*** The server does not support secure sessions; file transfers are disabled", f"{nickname}> ")
+        return
+    server_public_key = decode_key(message['public_key'])
+    session_keys = derive_session_keys(private_key, public_key, server_public_key, server_public_key)
+    cipher_suite = Fernet(session_keys.fernet_key)
+    if message.get('stream_cipher') == STREAM_CIPHER:
+        stream_aead = stream_cipher(session_keys.stream_key)
+    session_ready.set()
+
+# Function to wait until file transfers can be encrypted
+def require_session():
+    if not session_ready.wait(SESSION_TIMEOUT):
+        raise ConnectionError("No secure session with the server")
+
+# Function to get the largest file the server accepts
+def max_file_size():
+    return MAX_TRANSFER_SIZE if protocol_version >= PROTOCOL_V2 else MAX_FILE_SIZE
+
+# Uploads started by this client, keyed by transfer ID. Single-frame uploads
+# to v1 servers get a local ID so they can be cancelled the same way. The
+# receive thread finishes uploads while the input thread cancels them, so
+# entries are taken out under uploads_lock.
+active_uploads = {}
+uploads_lock = threading.Lock()
+
+# Files waiting to be prepared and sent by the upload worker
+upload_jobs = queue.Queue()
+
+def new_upload(transfer_id, kind, filename, size, target_nick, chunked):
+    upload = {"transfer_id": transfer_id, "kind": kind, "filename": filename, "size": size, "target": target_nick,
+              "chunked": chunked, "acked": threading.Event(), "next_chunk": 0, "error": None, "cancelled": False,
+              "window": threading.Semaphore(MAX_QUEUED_CHUNKS), "sent_bytes": 0, "resumed_bytes": 0,
+              "started": time.monotonic(), "reported": 0.0}
+    active_uploads[transfer_id] = upload
+    return upload
+
+# Function run by the writer after each file frame: updates the status line
+# with the upload's progress and rate, and completes single-frame uploads
+def report_progress(upload, file_bytes):
+    upload["sent_bytes"] += file_bytes
+    now = time.monotonic()
+    done = upload["sent_bytes"] >= upload["size"]
+    if done and not upload["chunked"]:
+        finish_upload(upload["transfer_id"])
+        return
+    if now - upload["reported"] < PROGRESS_INTERVAL and not done:
+        return
+    upload["reported"] = now
+    if done:
+        set_status(f"Sent {upload['filename']}, waiting for the server to verify it")
+        return
+    rate = (upload["sent_bytes"] - upload["resumed_bytes"]) / max(now - upload["started"], 1e-6)
+    percent = 100 * upload["sent_bytes"] // max(upload["size"], 1)
+    set_status(f"Sending {upload['filename']}: {percent}% of {upload['size'] / (1024 * 1024):.1f}MB "
+               f"at {rate / (1024 * 1024):.1f}MB/s (/cancel to stop)")
+
+# Function to stop every upload that is queued, being prepared or being sent
+def cancel_uploads():
+    cancelled = 0
+    while True:
+        try:
+            upload_jobs.get_nowait()
+            cancelled += 1
+        except queue.Empty:
+            break
+    with uploads_lock:
+        uploads = list(active_uploads.items())
+        active_uploads.clear()
+    for transfer_id, upload in uploads:
+        upload["cancelled"] = True
+        upload["acked"].set()
+        if upload["chunked"]:
+            send_packet({"type": "upload_cancel", "transfer_id": transfer_id})
+        cancelled += 1
+    set_status("")
+    return cancelled
+
+# Function run by the upload worker: reading, validating and encrypting files
+# happens here, never on the input thread
+def run_upload_jobs():
+    while True:
+        job = upload_jobs.get()
+        if job is None:
+            return
+        kind, filepath, target_nick, room = job
+        if kind == "fhir":
+            send_fhir_data(filepath, target_nick, room)
+        else:
+            send_media(filepath, target_nick, room)
+
+# Function to stream a file to the server in encrypted chunks. If the server
+# already holds part of this upload (same file, same target), only the
+# missing chunks are sent. When raw_data is given it is compressed with the
+# agreed codec and the compressed bytes are sent instead of the file.
+def send_file_chunked(kind, filepath, target_nick=None, room=None, raw_data=None):
+    filename = os.path.basename(filepath)
+    if raw_data is not None:
+        data = compress(compression_codec, raw_data)
+        size = len(data)
+        digest = hashlib.sha256(data).hexdigest()
+    else:
+        size = os.path.getsize(filepath)
+        digest = file_digest(filepath)
+    transfer_id = transfer_id_for(kind, filename, digest, target_nick)
+    nonce_prefix = new_nonce_prefix() if stream_aead else None
+    upload = new_upload(transfer_id, kind, filename, size, target_nick, True)
+    start_packet = {"type": "upload_start", "transfer_id": transfer_id, "kind": kind, "filename": filename,
+                    "size": size, "chunk_size": CHUNK_SIZE, "sha256": digest, "target": target_nick, "room": room}
+    if nonce_prefix:
+        start_packet.update({"cipher": STREAM_CIPHER, "nonce_prefix": encode_key(nonce_prefix)})
+    if raw_data is not None:
+        start_packet.update({"compression": compression_codec, "raw_sha256": hashlib.sha256(raw_data).hexdigest()})
+    send_packet(start_packet)
+    if not upload["acked"].wait(UPLOAD_ACK_TIMEOUT):
+        active_uploads.pop(transfer_id, None)
+        raise TimeoutError("Server did not acknowledge the upload")
+    if upload["cancelled"]:
+        return
+    if upload["error"]:
+        active_uploads.pop(transfer_id, None)
+        raise IOError(upload["error"])
+
+    start = upload["next_chunk"]
+    if start:
+        print_message(f"*** Resuming upload of {filename} from chunk {start}", f"{nickname}> ")
+    upload["sent_bytes"] = upload["resumed_bytes"] = min(start * CHUNK_SIZE, size)
+    upload["started"] = time.monotonic()
+    with io.BytesIO(data) if raw_data is not None else open(filepath, 'rb') as file:
+        file.seek(start * CHUNK_SIZE)
+        total_chunks = chunk_count(size)
+        for index in range(start, total_chunks):
+            if upload["error"] or upload["cancelled"]:
+                return
+            chunk = file.read(CHUNK_SIZE)
+            chunk_packet = {"type": "upload_chunk", "transfer_id": transfer_id, "index": index}
+            if nonce_prefix:
+                sealed = seal_chunk(stream_aead, nonce_prefix, index, index == total_chunks - 1, chunk, transfer_id)
+                send_file_frame(upload, chunk_packet, sealed, FLAG_AEAD, len(chunk))
+            else:
+                token = cipher_suite.encrypt(chunk)
+                send_file_frame(upload, chunk_packet, base64.urlsafe_b64decode(token), FLAG_FERNET_RAW, len(chunk))
+
+# Function to report the outcome of a chunked upload
+def finish_upload(transfer_id, error=None):
+    with uploads_lock:
+        upload = active_uploads.get(transfer_id)
+        if upload is None:
+            return
+        if not upload["acked"].is_set():
+            upload["error"] = error
+            upload["acked"].set()
+            return
+        active_uploads.pop(transfer_id, None)
+    set_status("")
+    label = "FHIR data" if upload["kind"] == "fhir" else "Media file"
+    if error:
+        handle_long_message(f"*** Error sending {label.lower()}: {error}", f"{nickname}> ")
+        upload["error"] = error
+    elif upload["target"]:
+        print_message(f"*** {label} sent to {upload['target']} successfully", f"{nickname}> ")
+    else:
+        print_message(f"*** {label} sent successfully", f"{nickname}> ")
+
+# Start the writer thread and the upload worker
+writer_thread = threading.Thread(target=write_frames, daemon=True)
+writer_thread.start()
+upload_thread = threading.Thread(target=run_upload_jobs, daemon=True)
+upload_thread.start()
+
+# Send initial "hello" packet, offering the newest protocol we speak and
+# asking for the messages sent since our last visit
+hello = {"type": "hello", "nick": nickname, "category": category, "protocol": SUPPORTED_PROTOCOL,
+         "key_exchange": KEY_EXCHANGE, "public_key": encode_key(public_key), "rooms": sorted(joined_rooms),
+         "compression": supported_codecs(), "heartbeat": True, "presence": True}
+if last_seq is not None:
+    hello["since"] = last_seq
+    if log_id:
+        hello["log_id"] = log_id
+send_packet(hello)
+
+# Function to handle one message from the server; lines to display are
+# collected in `lines` so a whole batch reaches the UI at once
+def handle_message(message, lines):
+    global nickname_with_category, protocol_version, last_seq, log_id, current_room, compression_codec, roster_known
+    if isinstance(message.get('seq'), int):
+        last_seq = max(last_seq or 0, message['seq'])
+    first_line = len(lines)
+    if message['type'] == 'chat':
+        if message['nick'] == nickname_with_category:
+            lines.append((f"Me: {message['message']}", "Me> "))
+        else:
+            lines.append((f"{message['nick']}: {message['message']}", "Me> "))
+    elif message['type'] == 'room_join':
+        # Our own join is acknowledged with the room's member count
+        if 'members' in message and message['nick'] == nickname_with_category:
+            joined_rooms.add(message['room'])
+            current_room = message['room']
+            lines.append((f"*** You are talking in #{current_room} ({message['members']} member(s))", "Me> "))
+        else:
+            lines.append((f"*** {message['nick']} joined #{message['room']}", "Me> "))
+    elif message['type'] == 'room_leave':
+        if 'members' in message and message['nick'] == nickname_with_category:
+            joined_rooms.discard(message['room'])
+            if current_room == message['room']:
+                current_room = DEFAULT_ROOM if DEFAULT_ROOM in joined_rooms else min(joined_rooms, default=None)
+            lines.append((f"*** You left #{message['room']}", "Me> "))
+        else:
+            lines.append((f"*** {message['nick']} left #{message['room']}", "Me> "))
+    elif message['type'] == 'room_list':
+        rooms = ", ".join(f"#{room['room']} ({room['members']}){'*' if room['room'] in joined_rooms else ''}"
+                          for room in message['rooms'])
+        lines.append((f"*** Rooms (* = joined): {rooms or 'none'}", "Me> "))
+    elif message['type'] == 'private':
+        lines.append((f"*** Private message from {message['nick']}: {message['message']}", f"{nickname_with_category}> "))
+    elif message['type'] == 'join':
+        if not message.get('replay'):
+            roster[message['nick'].casefold()] = (message['nick'], message.get('category', ''))
+        lines.append((f"*** {message['nick']} has joined the chat", "Me> "))
+    elif message['type'] == 'leave':
+        if not message.get('replay'):
+            roster.pop(message['nick'].casefold(), None)
+        lines.append((f"*** {message['nick']} has left the chat", "Me> "))
+    elif message['type'] == 'roster':
+        roster.clear()
+        roster.update((nick.casefold(), (nick, category)) for nick, category in message['users'])
+        roster_known = True
+        others = len(roster) - (nickname_with_category.casefold() in roster)
+        lines.append((f"*** {others} other user(s) online. Type /who to list them", "Me> "))
+    elif message['type'] == 'presence':
+        for nick in message['left']:
+            roster.pop(nick.casefold(), None)
+        for nick, category in message['joined']:
+            roster[nick.casefold()] = (nick, category)
+        lines.extend(presence_lines([nick for nick, _ in message['joined']], "joined"))
+        lines.extend(presence_lines(message['left'], "left"))
+    elif message['type'] == 'fhir':
+        lines.append((f"*** Received FHIR data from {message['nick']}. View the data at: {message['data']}", f"{nickname_with_category}> "))
+    elif message['type'] == 'media':
+        lines.append((f"*** Received media from {message['nick']}. View the file at: {message['data']}", f"{nickname_with_category}> "))
+    elif message['type'] == 'error':
+        if message.get('transfer_id'):
+            finish_upload(message['transfer_id'], message['message'])
+        else:
+            lines.append((f"*** Error: {message['message']}", f"{nickname_with_category}> "))
+    elif message['type'] == 'upload_ack':
+        upload = active_uploads.get(message['transfer_id'])
+        if upload is not None:
+            upload["next_chunk"] = message['next_chunk']
+            upload["acked"].set()
+    elif message['type'] == 'upload_done':
+        finish_upload(message['transfer_id'])
+    elif message['type'] == 'update_nick':
+        nickname_with_category = message['nick']
+        protocol_version = message.get('protocol', PROTOCOL_V1)
+        compression_codec = message.get('compression')
+        establish_session(message)
+        # Sequence numbers of a log the server no longer has mean nothing
+        if message.get('log_id') and message['log_id'] != log_id:
+            log_id = message['log_id']
+            last_seq = None
+    elif message['type'] == 'history':
+        if message['count']:
+            note = " (older messages were skipped)" if message.get('truncated') else ""
+            lines.append((f"*** Replaying {message['count']} message(s) sent while you were away{note}", "Me> "))
+    # Room traffic outside the lobby is labelled with its room
+    room = message.get('room')
+    if room and room != DEFAULT_ROOM and message['type'] in ('chat', 'fhir', 'media'):
+        lines[first_line:] = [(f"#{room} {text}", prompt) for text, prompt in lines[first_line:]]
+    # Replayed messages are shown with the time they were originally sent
+    if message.get('replay') and 'ts' in message:
+        sent_at = time.strftime("[%H:%M] ", time.localtime(message['ts']))
+        lines[first_line:] = [(sent_at + text, prompt) for text, prompt in lines[first_line:]]
+
+# Function to describe the users in a presence update, naming the first few
+def presence_lines(nicks, action):
+    nicks = [nick for nick in nicks if nick != nickname_with_category]
+    if not nicks:
+        return []
+    names = ", ".join(nicks[:PRESENCE_NAMES_SHOWN])
+    if len(nicks) > PRESENCE_NAMES_SHOWN:
+        names += f" and {len(nicks) - PRESENCE_NAMES_SHOWN} others"
+    return [(f"*** {names} {'has' if len(nicks) == 1 else 'have'} {action} the chat", "Me> ")]
+
+# Function to check a target against the local roster before anything is
+# sent; returns False (and says so) if nobody by that name is online
+def target_online(target_nick):
+    if not roster_known or target_nick.casefold() in roster:
+        return True
+    print_message(f"*** User '{target_nick}' is not online. Type /who to see who is, or press Tab to complete a name",
+                  f"{nickname}> ")
+    return False
+
+# Function to complete the nickname in /send_private=, /send_fhir= and
+# /send_media= from the local roster; run by the UI when Tab is pressed
+def complete_nickname(line):
+    match = TARGETED_COMMAND.match(line)
+    if not match:
+        return None
+    command, quote, partial = match.groups()
+    quote = quote or '"'
+    candidates = sorted(nick for nick, _ in list(roster.values())
+                        if nick.casefold().startswith(partial.casefold()) and nick != nickname_with_category)
+    if not candidates:
+        return None
+    if len(candidates) == 1:
+        return f"{command}{quote}{candidates[0]}{quote} "
+    print_message("*** " + ", ".join(candidates[:PRESENCE_NAMES_SHOWN * 4]), f"{nickname}> ")
+    prefix = os.path.commonprefix(candidates)
+    return f"{command}{quote}{prefix if len(prefix) > len(partial) else partial}"
+
+# Function to list everyone online by category
+def display_roster():
+    by_category = {}
+    for nick, user_category in sorted(list(roster.values()), key=lambda user: user[0].casefold()):
+        by_category.setdefault(user_category or "Other", []).append(nick)
+    lines = [(f"*** {len(roster)} user(s) online", f"{nickname}> ")]
+    lines.extend((f"    {user_category}: {', '.join(nicks)}", f"{nickname}> ")
+                 for user_category, nicks in sorted(by_category.items()))
+    print_messages(lines)
+
+# Function to receive messages from the server. Each recv reads as much as
+# the socket has buffered into one reusable buffer, and every frame it
+# completes is handled before the UI is updated once for the whole batch.
+# Pings from the server are answered here, without involving the UI.
 def receive_messages():
-    global nickname_with_category
+    receive_buffer = bytearray(RECV_BUFFER_SIZE)
+    receive_view = memoryview(receive_buffer)
+    decoder = FrameDecoder()
     while True:
         try:
-            data_length = int.from_bytes(client_socket.recv(HEADER_LENGTH), byteorder='big')
-            data = client_socket.recv(data_length).decode('utf-8')
-            message = json.loads(data)
-
-            if message['type'] == 'chat':
-                if message['nick'] == nickname_with_category:
-                    print_message(f"Me: {message['message']}")
-                else:
-                    print_message(f"{message['nick']}: {message['message']}")
-            elif message['type'] == 'private':
-                print_message(f"*** Private message from {message['nick']}: {message['message']}", f"{nickname_with_category}> ")
-            elif message['type'] == 'join':
-                print_message(f"*** {message['nick']} has joined the chat")
-            elif message['type'] == 'leave':
-                print_message(f"*** {message['nick']} has left the chat")
-            elif message['type'] == 'fhir':
-                print_message(f"*** Received FHIR data from {message['nick']}. View the data at: {message['data']}", f"{nickname_with_category}> ")
-            elif message['type'] == 'media':
-                print_message(f"*** Received media from {message['nick']}. View the file at: {message['data']}", f"{nickname_with_category}> ")
-            elif message['type'] == 'error':
-                print_message(f"*** Error: {message['message']}", f"{nickname_with_category}> ")
-            elif message['type'] == 'update_nick':
-                nickname_with_category = message['nick']
+            received = client_socket.recv_into(receive_buffer)
+            if not received:
+                raise ConnectionError("The server closed the connection")
+            lines = []
+            for frame in decoder.feed(receive_view[:received]):
+                message, payload, _ = decode_packet(frame)
+                if message['type'] == 'ping':
+                    send_packet({"type": "pong"})
+                    continue
+                if message['type'] in ('chat', 'private'):
+                    unpack_text(message, payload, 'message', MAX_FRAME_SIZE)
+                handle_message(message, lines)
+            print_messages(lines)
         except Exception as e:
             print_message(f"*** Connection to server lost: {e}")
+            save_state()
             break
 
 # Function to send FHIR data to the server
-def send_fhir_data(filepath, target_nick=None):
+def send_fhir_data(filepath, target_nick=None, room=None):
     if not filepath.endswith('.json'):
         print_message("*** Only JSON FHIR data is accepted", f"{nickname}> ")
         return
@@ -96,8 +535,8 @@ def send_fhir_data(filepath, target_nick=None):
         print_message("*** File does not exist", f"{nickname}> ")
         return
 
-    if os.path.getsize(filepath) > MAX_FILE_SIZE:
-        print_message("*** File size exceeds the 5MB limit", f"{nickname}> ")
+    if os.path.getsize(filepath) > max_file_size():
+        print_message(f"*** File size exceeds the {max_file_size() // (1024 * 1024)}MB limit", f"{nickname}> ")
         return
 
     try:
@@ -109,31 +548,33 @@ def send_fhir_data(filepath, target_nick=None):
                 print_message("*** Incorrectly formed JSON file", f"{nickname}> ")
                 return
 
-        # Validate FHIR data
-        try:
-            patient = Patient.parse_raw(fhir_json)
-        except ValidationError as ve:
-            handle_long_message("*** Invalid FHIR Data", f"{nickname}> ")
-            handle_long_message(str(ve), f"{nickname}> ")
+        # Validate FHIR data; a file sent before is answered from the cache
+        is_valid, validation_message = validate_fhir_data(fhir_json)
+        if not is_valid:
+            handle_long_message(f"*** {validation_message}", f"{nickname}> ")
             return
-        except Exception as e:
-            handle_long_message("*** Invalid FHIR Data", f"{nickname}> ")
-            handle_long_message(str(e), f"{nickname}> ")
+
+        require_session()
+        # FHIR JSON is compressed before it is encrypted when the server
+        # agreed to a codec
+        fhir_bytes = fhir_json.encode()
+        if protocol_version >= PROTOCOL_V2:
+            send_file_chunked("fhir", filepath, target_nick, room, fhir_bytes if compression_codec else None)
             return
 
-        encrypted_fhir = cipher_suite.encrypt(fhir_json.encode())
-        fhir_packet = json.dumps({"type": "fhir", "data": encrypted_fhir.decode(), "target": target_nick})
-        client_socket.send(len(fhir_packet).to_bytes(HEADER_LENGTH, byteorder='big') + fhir_packet.encode('utf-8'))
-        if target_nick:
-            print_message(f"*** FHIR data sent to {target_nick} successfully", f"{nickname}> ")
-        else:
-            print_message("*** FHIR data sent successfully", f"{nickname}> ")
+        fhir_packet = {"type": "fhir", "target": target_nick, "room": room}
+        if compression_codec:
+            fhir_packet["compression"] = compression_codec
+            fhir_bytes = compress(compression_codec, fhir_bytes)
+        upload = new_upload(uuid.uuid4().hex, "fhir", os.path.basename(filepath), len(fhir_bytes), target_nick, False)
+        upload["acked"].set()
+        send_encrypted(upload, fhir_packet, cipher_suite.encrypt(fhir_bytes), len(fhir_bytes))
     except Exception as e:
         handle_long_message("*** Error sending FHIR data", f"{nickname}> ")
         handle_long_message(str(e), f"{nickname}> ")
 
 # Function to send media files to the server
-def send_media(filepath, target_nick=None):
+def send_media(filepath, target_nick=None, room=None):
     if not any(filepath.lower().endswith(ext) for ext in MEDIA_TYPES):
         print_message("*** Only media files (.jpg, .jpeg, .png, .gif, .pdf) are accepted", f"{nickname}> ")
         return
@@ -142,21 +583,24 @@ def send_media(filepath, target_nick=None):
         print_message("*** File does not exist", f"{nickname}> ")
         return
 
-    if os.path.getsize(filepath) > MAX_FILE_SIZE:
-        print_message("*** File size exceeds the 5MB limit", f"{nickname}> ")
+    if os.path.getsize(filepath) > max_file_size():
+        print_message(f"*** File size exceeds the {max_file_size() // (1024 * 1024)}MB limit", f"{nickname}> ")
         return
 
     try:
+        require_session()
+        if protocol_version >= PROTOCOL_V2:
+            send_file_chunked("media", filepath, target_nick, room)
+            return
+
         with open(filepath, 'rb') as file:
             media_data = file.read()
 
-        encrypted_media = cipher_suite.encrypt(media_data)
-        media_packet = json.dumps({"type": "media", "filename": os.path.basename(filepath), "data": encrypted_media.decode('latin1'), "target": target_nick})
-        client_socket.send(len(media_packet).to_bytes(HEADER_LENGTH, byteorder='big') + media_packet.encode('utf-8'))
-        if target_nick:
-            print_message(f"*** Media file sent to {target_nick} successfully", f"{nickname}> ")
-        else:
-            print_message("*** Media file sent successfully", f"{nickname}> ")
+        filename = os.path.basename(filepath)
+        upload = new_upload(uuid.uuid4().hex, "media", filename, len(media_data), target_nick, False)
+        upload["acked"].set()
+        send_encrypted(upload, {"type": "media", "filename": filename, "target": target_nick, "room": room},
+                       cipher_suite.encrypt(media_data), len(media_data))
     except Exception as e:
         handle_long_message("*** Error sending media file", f"{nickname}> ")
         handle_long_message(str(e), f"{nickname}> ")
@@ -170,6 +614,11 @@ Available commands:
   /send_media <file_path>        : Send media files (e.g., .jpg, .jpeg, .png, .gif, .pdf).
   /send_media="<nickname>" <file_path> : Send media file to a specific user.
   /send_private="<nickname>" <msg> : Send a private message to a specific user.
+  /join <room>                   : Join a room (or switch to one you are in); messages go to it.
+  /leave [room]                  : Leave a room (default: the current one).
+  /rooms                         : List the rooms on the server.
+  /who                           : List the users online. Tab completes nicknames in /send_...="<nickname>".
+  /cancel                        : Cancel the file transfers in progress.
   /quit                          : Quit the chat.
   /help                          : Display this help message.
 """
@@ -179,13 +628,14 @@ Available commands:
 def send_message():
     print_message(f"*** Welcome to the DP Chat. Remember to chat responsibly. You are chatting as << {nickname_with_category} >>", f"{nickname_with_category}> ")
     while True:
-        message = read_command(f"Me> ")
+        message = read_command("Me> " if current_room == DEFAULT_ROOM else f"#{current_room or '-'} Me> ")
         if message.strip() == "":
             continue
         if message == "/quit" or message == "/QUIT":
             confirmation = read_command("Are you sure you want to quit? [Yes or y / No or n (default)] ")
             if confirmation.lower() in ["yes", "y"]:
                 print("*** Quitting chat")
+                cancel_uploads()
                 break
             else:
                 print_message("*** DP Chat says 'Quit cancelled.'", f"{nickname}> ")
@@ -193,6 +643,29 @@ def send_message():
         elif message == "/help":
             display_help()
             continue
+        elif message.startswith("/join "):
+            send_packet({"type": "room_join", "room": message.split(" ", 1)[1].strip()})
+            continue
+        elif message == "/leave" or message.startswith("/leave "):
+            room = message[len("/leave"):].strip() or current_room
+            if room:
+                send_packet({"type": "room_leave", "room": room})
+            else:
+                print_message("*** You are not in any room", f"{nickname}> ")
+            continue
+        elif message == "/rooms":
+            send_packet({"type": "room_list"})
+            continue
+        elif message == "/who":
+            if roster_known:
+                display_roster()
+            else:
+                print_message("*** This server does not send the list of users online", f"{nickname}> ")
+            continue
+        elif message == "/cancel":
+            cancelled = cancel_uploads()
+            print_message(f"*** Cancelled {cancelled} file transfer(s)" if cancelled else "*** No file transfers in progress", f"{nickname}> ")
+            continue
         elif message.startswith("/send_fhir="):
             match = re.match(r'/send_fhir=["\'](.+?)["\'] (.+)', message)
             if not match:
@@ -200,11 +673,12 @@ def send_message():
                 continue
             target_nick = match.group(1)
             filepath = match.group(2)
-            send_fhir_data(filepath, target_nick)
+            if target_online(target_nick):
+                upload_jobs.put(("fhir", filepath, target_nick, None))
             continue
         elif message.startswith("/send_fhir "):
             filepath = message.split(" ", 1)[1]
-            send_fhir_data(filepath)
+            upload_jobs.put(("fhir", filepath, None, current_room))
             continue
         elif message.startswith("/send_media="):
             match = re.match(r'/send_media=["\'](.+?)["\'] (.+)', message)
@@ -213,11 +687,12 @@ def send_message():
                 continue
             target_nick = match.group(1)
             filepath = match.group(2)
-            send_media(filepath, target_nick)
+            if target_online(target_nick):
+                upload_jobs.put(("media", filepath, target_nick, None))
             continue
         elif message.startswith("/send_media "):
             filepath = message.split(" ", 1)[1]
-            send_media(filepath)
+            upload_jobs.put(("media", filepath, None, current_room))
             continue
         elif message.startswith("/send_private="):
             match = re.match(r'/send_private=["\'](.+?)["\'] (.+)', message)
@@ -226,17 +701,23 @@ def send_message():
                 continue
             target_nick = match.group(1)
             private_message = match.group(2)
-            private_packet = json.dumps({"type": "private", "target": target_nick, "message": private_message})
-            client_socket.send(len(private_packet).to_bytes(HEADER_LENGTH, byteorder='big') + private_packet.encode('utf-8'))
-            print_message(f"Me to {target_nick}: {private_message}")
+            if target_online(target_nick):
+                send_text({"type": "private", "target": target_nick, "message": private_message})
+                print_message(f"Me to {target_nick}: {private_message}")
             continue
 
-        chat_packet = json.dumps({"type": "chat", "message": message})
-        client_socket.send(len(chat_packet).to_bytes(HEADER_LENGTH, byteorder='big') + chat_packet.encode('utf-8'))
+        if current_room is None:
+            print_message("*** You are not in any room. Use /join <room> first", f"{nickname}> ")
+            continue
+        send_text({"type": "chat", "message": message, "room": current_room})
         # Show the message in the sender's terminal as "Me"
         print_message(f"Me: {message}")
 
+    upload_jobs.put(None)
+    send_queue.put((PRIORITY_STOP, next(send_sequence), None, None, 0))
+    writer_thread.join(timeout=SESSION_TIMEOUT)
     client_socket.close()
+    save_state()
     end_windows()
     sys.exit(0)
 
@@ -266,6 +747,9 @@ def split_message_to_lines(message, max_width):
 
     return lines
 
+# Tab completes nicknames from the roster
+set_completer(complete_nickname)
+
 # Start the receiving thread
 receive_thread = threading.Thread(target=receive_messages)
 receive_thread.daemon = True
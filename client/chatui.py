@@ -1,43 +1,239 @@
 # CHAT UI IMPLEMENTATION
 
+# The screen is split into three windows: a scrollback pad for chat output,
+# a one-line status bar, and a one-line input window. print_message() only
+# queues text; a render thread draws whatever arrived during the last frame
+# in one batch, writing just the new rows into the pad. All curses calls are
+# made while holding screen_lock, since the receive thread and the input
+# thread both end up drawing.
+
 import curses
+import select
+import sys
+import threading
+import time
+from collections import deque
+
+# Constants
+SCROLLBACK_LINES = 2000
+FRAME_INTERVAL = 0.03  # seconds; messages arriving within one frame are drawn together
 
 stdscr = None
-output_lines = []
+output_pad = None
+status_win = None
+input_win = None
+screen_lock = threading.RLock()
+scrollback = deque(maxlen=SCROLLBACK_LINES)  # wrapped rows, mirrored row for row by output_pad
+pending_messages = deque()
+redraw_requested = threading.Event()
+render_thread = None
+rendering = False
+scroll_offset = 0  # rows scrolled back from the newest row; 0 follows new output
+idle_prompt = ""
+reading_input = False
+status_text = ""
+completer = None  # function(line) -> completed line or None, run on Tab
 
 def init_windows():
-    global stdscr
+    global stdscr, render_thread, rendering
     stdscr = curses.initscr()
     curses.noecho()
     curses.cbreak()
     stdscr.keypad(True)
+    with screen_lock:
+        create_windows()
+        stdscr.noutrefresh()
+        curses.doupdate()
+    rendering = True
+    render_thread = threading.Thread(target=render_loop, daemon=True)
+    render_thread.start()
 
 def end_windows():
-    global stdscr
-    curses.nocbreak()
-    stdscr.keypad(False)
-    curses.echo()
-    curses.endwin()
+    global stdscr, rendering
+    rendering = False
+    redraw_requested.set()
+    if render_thread is not None:
+        render_thread.join(timeout=1)
+    with screen_lock:
+        curses.nocbreak()
+        stdscr.keypad(False)
+        curses.echo()
+        curses.endwin()
 
-def read_command(prompt):
-    global stdscr
-    stdscr.addstr(curses.LINES-1, 0, prompt)
-    stdscr.clrtoeol()
-    stdscr.refresh()
-    curses.echo()
-    command = stdscr.getstr(curses.LINES-1, len(prompt)).decode('utf-8')
-    curses.noecho()
-    stdscr.clrtoeol()
-    return command
+# Function to (re)create the windows for the current terminal size and copy
+# the scrollback into a fresh pad
+def create_windows():
+    global output_pad, status_win, input_win
+    output_pad = curses.newpad(SCROLLBACK_LINES, curses.COLS)
+    output_pad.scrollok(True)
+    for row_number, row in enumerate(scrollback):
+        put_text(output_pad, row_number, row)
+    status_win = curses.newwin(1, curses.COLS, curses.LINES - 2, 0)
+    input_win = curses.newwin(1, curses.COLS, curses.LINES - 1, 0)
+    input_win.keypad(True)
+    input_win.nodelay(True)
+
+def output_height():
+    return max(1, curses.LINES - 2)
 
+def put_text(window, row, text):
+    try:
+        window.addstr(row, 0, text)
+    except curses.error:
+        pass  # Text wider than the window (e.g. wide characters) is clipped
+
+# Function to split a message into rows that fit the terminal width
+def wrap_rows(message):
+    width = max(1, curses.COLS - 1)
+    rows = []
+    for line in message.split("\n"):
+        rows.extend(line[start:start + width] for start in range(0, max(len(line), 1), width))
+    return rows
+
+# Function to queue a message for the next frame; safe to call from any thread
 def print_message(message, prompt="Me> "):
-    global stdscr, output_lines
-    output_lines.append(message)
-    if len(output_lines) >= curses.LINES - 2:
-        output_lines.pop(0)
-
-    stdscr.clear()
-    for i, line in enumerate(output_lines):
-        stdscr.addstr(i, 0, line)
-    stdscr.addstr(curses.LINES-1, 0, prompt)
-    stdscr.refresh()
+    pending_messages.append((message, prompt))
+    redraw_requested.set()
+
+# Function to show a line of text (e.g. upload progress) in the status bar;
+# safe to call from any thread
+def set_status(text):
+    global status_text
+    status_text = text
+    redraw_requested.set()
+
+# Function to set what Tab does to the line being typed
+def set_completer(function):
+    global completer
+    completer = function
+
+# Function to queue several (message, prompt) pairs with a single wakeup
+def print_messages(messages):
+    if messages:
+        pending_messages.extend(messages)
+        redraw_requested.set()
+
+def render_loop():
+    while rendering:
+        redraw_requested.wait()
+        time.sleep(FRAME_INTERVAL)  # Collect everything else that arrives during this frame
+        redraw_requested.clear()
+        with screen_lock:
+            draw_frame()
+
+# Function to draw the queued messages; only the new rows are written
+def draw_frame():
+    global idle_prompt
+    rows = []
+    while pending_messages:
+        message, prompt = pending_messages.popleft()
+        rows.extend(wrap_rows(message))
+        idle_prompt = prompt
+    if rows:
+        append_rows(rows)
+    refresh_output()
+    if not reading_input:
+        input_win.erase()
+        put_text(input_win, 0, idle_prompt[-(curses.COLS - 1):])
+    input_win.noutrefresh()  # Refreshed last so the cursor stays on the input line
+    curses.doupdate()
+
+def append_rows(rows):
+    global scroll_offset
+    rows = rows[-SCROLLBACK_LINES:]
+    overflow = len(scrollback) + len(rows) - SCROLLBACK_LINES
+    if overflow > 0:
+        output_pad.scroll(overflow)  # The oldest rows fall off the top of the pad
+    first_row = len(scrollback) - max(overflow, 0)
+    scrollback.extend(rows)
+    for row_number, row in enumerate(rows, first_row):
+        put_text(output_pad, row_number, row)
+    if scroll_offset:
+        # Keep the rows the user scrolled back to in view
+        scroll_offset = min(scroll_offset + len(rows), max_scroll_offset())
+
+def max_scroll_offset():
+    return max(0, len(scrollback) - output_height())
+
+# Function to show the visible part of the pad and the scrollback status
+def refresh_output():
+    height = output_height()
+    top = max(0, len(scrollback) - height - scroll_offset)
+    output_pad.noutrefresh(top, 0, 0, 0, height - 1, curses.COLS - 1)
+    status_win.erase()
+    if scroll_offset:
+        put_text(status_win, 0, f"-- {scroll_offset} more lines below (PgDn/End to return) --"[:curses.COLS - 1])
+    else:
+        put_text(status_win, 0, status_text[:curses.COLS - 1])
+    status_win.noutrefresh()
+
+def scroll_output(rows):
+    global scroll_offset
+    scroll_offset = min(max(0, scroll_offset + rows), max_scroll_offset())
+    refresh_output()
+
+def draw_input(prompt, buffer):
+    input_win.erase()
+    put_text(input_win, 0, (prompt + "".join(buffer))[-(curses.COLS - 1):])
+    input_win.noutrefresh()
+
+# Function to read one line from the user. Keys are only read when stdin has
+# input, so the screen lock is never held while waiting for the user.
+def read_command(prompt):
+    global reading_input
+    buffer = []
+    with screen_lock:
+        reading_input = True
+        draw_input(prompt, buffer)
+        curses.doupdate()
+    try:
+        while True:
+            with screen_lock:
+                line = handle_keys(prompt, buffer)
+            if line is not None:
+                return line
+            select.select([sys.stdin], [], [])
+    finally:
+        reading_input = False
+
+# Function to process the keys curses has buffered; returns the line once
+# Enter is pressed, otherwise None
+def handle_keys(prompt, buffer):
+    while True:
+        try:
+            key = input_win.get_wch()
+        except curses.error:
+            break  # No more input
+        if key in ("\n", "\r", curses.KEY_ENTER):
+            input_win.erase()
+            input_win.noutrefresh()
+            curses.doupdate()
+            return "".join(buffer)
+        elif key in ("\x7f", "\b", curses.KEY_BACKSPACE):
+            if buffer:
+                buffer.pop()
+        elif key == "\t":
+            completed = completer("".join(buffer)) if completer is not None else None
+            if completed is not None:
+                buffer[:] = completed
+        elif key == curses.KEY_PPAGE:
+            scroll_output(output_height() - 1)
+        elif key == curses.KEY_NPAGE:
+            scroll_output(-(output_height() - 1))
+        elif key == curses.KEY_UP:
+            scroll_output(1)
+        elif key == curses.KEY_DOWN:
+            scroll_output(-1)
+        elif key == curses.KEY_END:
+            scroll_output(-scroll_offset)
+        elif key == curses.KEY_RESIZE:
+            curses.update_lines_cols()
+            stdscr.erase()
+            stdscr.noutrefresh()
+            create_windows()
+            scroll_output(0)
+        elif isinstance(key, str) and key.isprintable():
+            buffer.append(key)
+    draw_input(prompt, buffer)
+    curses.doupdate()
+    return None
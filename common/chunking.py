@@ -0,0 +1,29 @@
+# CHUNKED TRANSFER HELPERS
+
+import hashlib
+
+# Constants
+CHUNK_SIZE = 256 * 1024  # 256 KB of plaintext per chunk
+MAX_TRANSFER_SIZE = 512 * 1024 * 1024  # 512 MB
+DIGEST_READ_SIZE = 1024 * 1024
+
+# Function to hash a file without loading it into memory
+def file_digest(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(DIGEST_READ_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+# Function to derive a stable transfer ID, so sending the same file again
+# after a dropped connection resumes the earlier upload
+def transfer_id_for(kind, filename, digest, target=None):
+    key = f"{kind}\0{filename}\0{digest}\0{(target or '').casefold()}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+# Function to count the chunks needed for a file of the given size
+def chunk_count(size, chunk_size=CHUNK_SIZE):
+    return max(1, -(-size // chunk_size))
@@ -0,0 +1,154 @@
+# PAYLOAD COMPRESSION
+
+# Peers list the codecs they can decode in the hello ("compression":
+# ["zlib"]) and the server answers with the one both sides will use. Data is
+# compressed before it is encrypted, since ciphertext does not compress.
+#
+# Decompression is streamed in bounded steps and stops as soon as the output
+# passes the caller's limit, so a small compressed "bomb" cannot expand into
+# gigabytes of memory. A codec registers a one-shot compress function and a
+# factory for zlib-style decompressor objects (decompress(data, max_length),
+# unconsumed_tail, eof).
+
+import zlib
+import time
+
+# Constants
+COMPRESSION_THRESHOLD = 512  # bytes; shorter messages are sent as they are
+DECOMPRESS_STEP = 64 * 1024  # most output produced per decompressor call
+ZLIB_LEVEL = 6
+
+class CompressionError(Exception):
+    pass
+
+CODECS = {}
+
+# Function to make a codec available for negotiation; codecs registered
+# first are preferred
+def register_codec(name, compress_function, decompressor_factory):
+    CODECS[name] = (compress_function, decompressor_factory)
+
+register_codec("zlib", lambda data: zlib.compress(data, ZLIB_LEVEL), zlib.decompressobj)
+
+def supported_codecs():
+    return list(CODECS)
+
+# Function to pick our most preferred codec that the peer also offered
+def choose_codec(offered):
+    if not isinstance(offered, list):
+        return None
+    for name in CODECS:
+        if name in offered:
+            return name
+    return None
+
+def codec_functions(codec):
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise CompressionError(f"Unsupported compression: {codec}")
+
+# Counters of bytes before and after compression, and the CPU time spent,
+# per codec and direction. Worker jobs fill their own instance and return
+# its counters, which the event loop merges into the server's.
+class CompressionStats:
+    def __init__(self):
+        self.counters = {}
+
+    def record(self, codec, direction, raw_bytes, compressed_bytes, seconds):
+        counter = self.counters.setdefault(codec, {}).setdefault(direction, [0, 0, 0, 0.0])
+        counter[0] += 1
+        counter[1] += raw_bytes
+        counter[2] += compressed_bytes
+        counter[3] += seconds
+
+    def merge(self, counters):
+        for codec, directions in (counters or {}).items():
+            for direction, (messages, raw_bytes, compressed_bytes, seconds) in directions.items():
+                counter = self.counters.setdefault(codec, {}).setdefault(direction, [0, 0, 0, 0.0])
+                counter[0] += messages
+                counter[1] += raw_bytes
+                counter[2] += compressed_bytes
+                counter[3] += seconds
+
+    def summary(self):
+        return {
+            codec: {
+                direction: {"messages": messages, "raw_bytes": raw_bytes, "compressed_bytes": compressed_bytes,
+                            "ratio": round(raw_bytes / compressed_bytes, 2) if compressed_bytes else None,
+                            "cpu_seconds": round(seconds, 4)}
+                for direction, (messages, raw_bytes, compressed_bytes, seconds) in directions.items()
+            }
+            for codec, directions in self.counters.items()
+        }
+
+def compress(codec, data, stats=None):
+    compress_function, _ = codec_functions(codec)
+    started = time.thread_time()
+    compressed = compress_function(data)
+    if stats is not None:
+        stats.record(codec, "compressed", len(data), len(compressed), time.thread_time() - started)
+    return compressed
+
+# Function to decompress a stream of compressed blocks, yielding the output
+# in pieces; raises CompressionError once the output exceeds max_size or if
+# the stream is truncated
+def iter_decompressed(codec, blocks, max_size, stats=None):
+    _, decompressor_factory = codec_functions(codec)
+    decompressor = decompressor_factory()
+    seconds = 0.0
+    raw_bytes = compressed_bytes = 0
+    try:
+        for block in blocks:
+            compressed_bytes += len(block)
+            pending = block
+            while pending and not decompressor.eof:
+                started = time.thread_time()
+                output = decompressor.decompress(pending, DECOMPRESS_STEP)
+                seconds += time.thread_time() - started
+                raw_bytes += len(output)
+                if raw_bytes > max_size:
+                    raise CompressionError(f"Decompressed data exceeds the {max_size} byte limit")
+                pending = decompressor.unconsumed_tail
+                if output:
+                    yield output
+            if decompressor.eof:
+                break
+    except zlib.error as e:
+        raise CompressionError(f"Corrupt compressed data: {e}")
+    if not decompressor.eof:
+        raise CompressionError("Compressed data is truncated")
+    if stats is not None:
+        stats.record(codec, "decompressed", raw_bytes, compressed_bytes, seconds)
+
+def decompress(codec, data, max_size, stats=None):
+    return b"".join(iter_decompressed(codec, [bytes(data)], max_size, stats))
+
+# Function to move a long text field of a packet into a compressed v2
+# payload; returns (packet, payload), or the packet unchanged and None when
+# there is no codec or compression would not help
+def pack_text(packet, field, codec, stats=None, threshold=COMPRESSION_THRESHOLD):
+    text = packet.get(field)
+    if not codec or not isinstance(text, str) or len(text) < threshold:
+        return packet, None
+    raw = text.encode('utf-8')
+    compressed = compress(codec, raw, stats)
+    if len(compressed) >= len(raw):
+        return packet, None
+    packed = {key: value for key, value in packet.items() if key != field}
+    packed["compression"] = codec
+    return packed, compressed
+
+# Function to restore a text field that pack_text() moved into the payload;
+# text longer than max_size bytes is refused, compressed or not
+def unpack_text(packet, payload, field, max_size, stats=None):
+    codec = packet.pop("compression", None)
+    if codec is None:
+        text = packet.get(field)
+        if isinstance(text, str) and len(text.encode('utf-8')) > max_size:
+            raise CompressionError(f"Message exceeds the {max_size} byte limit")
+        return packet
+    if payload is None:
+        raise CompressionError("Compressed message has no payload")
+    packet[field] = decompress(codec, payload, max_size, stats).decode('utf-8')
+    return packet
@@ -0,0 +1,194 @@
+# FHIR HANDLER
+
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Constants
+DEFAULT_CACHE_ENTRIES = 1024
+DEFAULT_CACHE_TTL = 3600  # seconds
+MAX_FHIR_SIZE = 64 * 1024 * 1024  # 64 MB
+OVERSIZE_MESSAGE = f"Resource exceeds the {MAX_FHIR_SIZE // (1024 * 1024)}MB limit"
+MAX_FHIR_DEPTH = 64
+RESOURCE_TYPE_PATTERN = re.compile(r'^[A-Z][A-Za-z]{1,63}$')
+
+# LRU cache of validation results keyed by the SHA-256 of the payload, so a
+# Patient resource that is sent again is not parsed by pydantic again.
+# Entries expire after a TTL, and the least recently used entry is evicted
+# once the cache is full. Worker threads share it, so access is locked.
+class ValidationCache:
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, ttl=DEFAULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, digest):
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            result, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[digest]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(digest)
+            self.hits += 1
+            return result
+
+    def put(self, digest, result):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[digest] = (result, time.monotonic() + self.ttl)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+validation_cache = ValidationCache()
+
+# Function to resize the shared validation cache
+def configure_validation_cache(max_entries=DEFAULT_CACHE_ENTRIES, ttl=DEFAULT_CACHE_TTL):
+    global validation_cache
+    validation_cache = ValidationCache(max_entries, ttl)
+
+def validation_cache_stats():
+    return validation_cache.stats()
+
+# Function to compute the content address of a FHIR payload
+def fhir_digest(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+class FHIRPrecheckError(Exception):
+    pass
+
+# FHIR model classes, imported on first use. Loading fhir.resources (and
+# pydantic with it) up front noticeably slows down client and server startup.
+model_classes = {}
+model_classes_lock = threading.Lock()
+
+# Function to get the model class for a resource type, importing it lazily
+def get_model_class(resource_type):
+    model_class = model_classes.get(resource_type)
+    if model_class is not None:
+        return model_class
+    with model_classes_lock:
+        if resource_type not in model_classes:
+            from fhir.resources import get_fhir_model_class # type: ignore
+            try:
+                model_classes[resource_type] = get_fhir_model_class(resource_type)
+            except Exception:
+                raise FHIRPrecheckError(f"Unsupported resourceType '{resource_type}'")
+        return model_classes[resource_type]
+
+# Function to get a model class that lives next to a resource, e.g. BundleEntry
+def get_component_class(resource_type, component):
+    resource_class = get_model_class(resource_type)
+    module = __import__(resource_class.__module__, fromlist=[component])
+    return getattr(module, component)
+
+# Function to reject obviously bad payloads before the expensive pydantic
+# parse: size, JSON well-formedness, nesting depth and resourceType
+def precheck_fhir_data(data):
+    if len(data) > MAX_FHIR_SIZE:
+        raise FHIRPrecheckError(OVERSIZE_MESSAGE)
+    try:
+        resource = json.loads(data)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise FHIRPrecheckError(f"Incorrectly formed JSON: {e}")
+    if not isinstance(resource, dict):
+        raise FHIRPrecheckError("A FHIR resource must be a JSON object")
+
+    stack = [(resource, 1)]
+    while stack:
+        value, depth = stack.pop()
+        if depth > MAX_FHIR_DEPTH:
+            raise FHIRPrecheckError(f"Resource is nested deeper than {MAX_FHIR_DEPTH} levels")
+        children = value.values() if isinstance(value, dict) else value
+        for child in children:
+            if isinstance(child, (dict, list)):
+                stack.append((child, depth + 1))
+
+    check_resource_type(resource)
+    return resource
+
+def check_resource_type(resource):
+    resource_type = resource.get('resourceType') if isinstance(resource, dict) else None
+    if not isinstance(resource_type, str) or not RESOURCE_TYPE_PATTERN.match(resource_type):
+        raise FHIRPrecheckError("Missing or invalid resourceType")
+    return resource_type
+
+# Function to validate an already decoded resource against its model. Bundle
+# entries are validated one at a time, so only one entry's model tree exists
+# at once instead of the whole Bundle's.
+def validate_resource(resource, path="resource"):
+    resource_type = check_resource_type(resource)
+    if resource_type != 'Bundle' or not isinstance(resource.get('entry'), list):
+        get_model_class(resource_type).parse_obj(resource)
+        return
+
+    shell = {key: value for key, value in resource.items() if key != 'entry'}
+    get_model_class('Bundle').parse_obj(shell)
+    entry_class = get_component_class('Bundle', 'BundleEntry')
+    for index, entry in enumerate(resource['entry']):
+        entry_path = f"{path}.entry[{index}]"
+        if not isinstance(entry, dict):
+            raise FHIRPrecheckError(f"{entry_path} must be a JSON object")
+        entry_class.parse_obj({key: value for key, value in entry.items() if key != 'resource'})
+        if 'resource' in entry:
+            try:
+                validate_resource(entry['resource'], f"{entry_path}.resource")
+            except FHIRPrecheckError:
+                raise
+            except Exception as e:
+                raise FHIRPrecheckError(f"{entry_path}.resource: {e}")
+
+# Function to reject a resource by its size alone, before it is read or
+# decompressed; returns the result validate_fhir_data would, or None
+def check_fhir_size(size):
+    if size > MAX_FHIR_SIZE:
+        return False, f"Invalid FHIR Data: {OVERSIZE_MESSAGE}"
+    return None
+
+def parse_fhir_data(data):
+    try:
+        resource = precheck_fhir_data(data)
+        validate_resource(resource)
+        return True, "FHIR data is valid"
+    except Exception as e:
+        return False, f"Invalid FHIR Data: {e}"
+
+def validate_fhir_data(data, digest=None):
+    digest = digest or fhir_digest(data)
+    result = validation_cache.get(digest)
+    if result is None:
+        result = parse_fhir_data(data)
+        validation_cache.put(digest, result)
+    return result
@@ -0,0 +1,47 @@
+# MESSAGE FRAMING
+
+# Constants
+HEADER_LENGTH = 4
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # 16 MB
+
+class FrameError(Exception):
+    pass
+
+# Function to prefix a payload with its 4-byte big-endian length
+def encode_frame(payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return len(payload).to_bytes(HEADER_LENGTH, byteorder='big') + payload
+
+# Incremental decoder that splits a byte stream into length-prefixed frames.
+# Bytes are appended to one growing buffer, so a frame that arrives in many
+# small reads is never re-copied until it is complete.
+class FrameDecoder:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    # Number of bytes received but not yet returned as a frame
+    @property
+    def pending(self):
+        return len(self.buffer)
+
+    # Append received bytes and return every frame that is now complete
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        start = 0
+        available = len(buffer)
+        while available - start >= HEADER_LENGTH:
+            data_length = int.from_bytes(buffer[start:start + HEADER_LENGTH], byteorder='big')
+            if data_length > self.max_frame_size:
+                raise FrameError(f"Frame of {data_length} bytes exceeds the {self.max_frame_size} byte limit")
+            end = start + HEADER_LENGTH + data_length
+            if end > available:
+                break
+            frames.append(bytes(buffer[start + HEADER_LENGTH:end]))
+            start = end
+        if start:
+            del buffer[:start]
+        return frames
@@ -0,0 +1,75 @@
+# SESSION KEY EXCHANGE AND CHUNK ENCRYPTION
+
+import base64
+import os
+import struct
+from cryptography.hazmat.primitives import hashes # type: ignore
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey # type: ignore
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF # type: ignore
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM # type: ignore
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat # type: ignore
+
+# Constants
+KEY_EXCHANGE = "x25519"
+STREAM_CIPHER = "aesgcm"
+SESSION_INFO = b"dpc session v1"
+NONCE_PREFIX_LENGTH = 7
+CHUNK_NONCE = struct.Struct('!IB')  # chunk index, last-chunk marker
+
+class SessionError(Exception):
+    pass
+
+# Keys derived from one X25519 exchange: a Fernet key for single-frame
+# messages and an AES-256-GCM key for chunked uploads
+class SessionKeys:
+    def __init__(self, fernet_key, stream_key):
+        self.fernet_key = fernet_key
+        self.stream_key = stream_key
+
+def encode_key(key_bytes):
+    return base64.b64encode(key_bytes).decode('ascii')
+
+def decode_key(text):
+    try:
+        key_bytes = base64.b64decode(text, validate=True)
+    except (TypeError, ValueError):
+        raise SessionError("Public key is not valid base64")
+    if len(key_bytes) != 32:
+        raise SessionError("Public key must be 32 bytes")
+    return key_bytes
+
+# Function to create an ephemeral key pair for one connection
+def generate_keypair():
+    private_key = X25519PrivateKey.generate()
+    public_key = private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    return private_key, public_key
+
+# Function to derive the session keys; both sides pass the client's public
+# key first so they bind the same transcript
+def derive_session_keys(private_key, client_public_key, server_public_key, peer_public_key):
+    try:
+        shared_secret = private_key.exchange(X25519PublicKey.from_public_bytes(peer_public_key))
+    except ValueError as e:
+        raise SessionError(f"Key exchange failed: {e}")
+    material = HKDF(algorithm=hashes.SHA256(), length=64, salt=None,
+                    info=SESSION_INFO + client_public_key + server_public_key).derive(shared_secret)
+    return SessionKeys(base64.urlsafe_b64encode(material[:32]), material[32:])
+
+def new_nonce_prefix():
+    return os.urandom(NONCE_PREFIX_LENGTH)
+
+# Streaming AEAD for chunked uploads (the STREAM construction): each nonce is
+# a per-upload random prefix, the chunk index and a last-chunk marker, and the
+# transfer ID is authenticated with every chunk. Reordered, replayed, truncated
+# or cross-upload chunks therefore fail to decrypt.
+def chunk_nonce(nonce_prefix, index, last):
+    return nonce_prefix + CHUNK_NONCE.pack(index, 1 if last else 0)
+
+def seal_chunk(aead, nonce_prefix, index, last, data, transfer_id):
+    return aead.encrypt(chunk_nonce(nonce_prefix, index, last), data, transfer_id.encode('ascii'))
+
+def open_chunk(aead, nonce_prefix, index, last, data, transfer_id):
+    return aead.decrypt(chunk_nonce(nonce_prefix, index, last), data, transfer_id.encode('ascii'))
+
+def stream_cipher(stream_key):
+    return AESGCM(stream_key)
@@ -0,0 +1,103 @@
+# WIRE PROTOCOL
+
+# Version 1 frames are a UTF-8 JSON object behind the 4-byte length prefix.
+# Version 2 frames keep the same length prefix but carry a small binary
+# header, JSON metadata for the control fields only, and a raw binary
+# payload section for file contents:
+#
+#   | version (1) | type (1) | flags (1) | meta length (4) | meta JSON | payload |
+#
+# A v1 frame always starts with "{", so both versions can be told apart
+# frame by frame. Peers announce "protocol": 2 in the hello / update_nick
+# packets and keep speaking v1 to anyone who does not.
+
+import json
+import struct
+from framing import HEADER_LENGTH, encode_frame
+
+# Constants
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+SUPPORTED_PROTOCOL = PROTOCOL_V2
+V2_HEADER = struct.Struct('!BBBI')
+
+# Flags
+FLAG_FERNET_RAW = 0x01  # Payload is a Fernet token with its base64 layer removed
+FLAG_AEAD = 0x02  # Payload is an AES-GCM sealed upload chunk
+
+MESSAGE_TYPES = {
+    "hello": 1,
+    "update_nick": 2,
+    "join": 3,
+    "leave": 4,
+    "chat": 5,
+    "private": 6,
+    "fhir": 7,
+    "media": 8,
+    "error": 9,
+    "upload_start": 10,
+    "upload_chunk": 11,
+    "upload_ack": 12,
+    "upload_done": 13,
+    "upload_cancel": 14,
+    "history": 15,
+    "room_join": 16,
+    "room_leave": 17,
+    "room_list": 18,
+    "ping": 19,
+    "pong": 20,
+    "presence": 21,
+    "roster": 22,
+}
+MESSAGE_NAMES = {code: name for name, code in MESSAGE_TYPES.items()}
+
+class ProtocolError(Exception):
+    pass
+
+# Function to encode a packet (and optional binary payload) as a complete frame
+def encode_packet(packet, payload=None, version=PROTOCOL_V1, flags=0):
+    if version == PROTOCOL_V1:
+        if payload is not None:
+            raise ProtocolError("Protocol v1 frames cannot carry a binary payload")
+        return encode_frame(json.dumps(packet))
+
+    meta = {key: value for key, value in packet.items() if key != 'type'}
+    meta_bytes = json.dumps(meta, ensure_ascii=False, separators=(',', ':')).encode('utf-8') if meta else b""
+    try:
+        type_code = MESSAGE_TYPES[packet['type']]
+    except KeyError:
+        raise ProtocolError(f"Unknown message type: {packet.get('type')}")
+    header = V2_HEADER.pack(PROTOCOL_V2, type_code, flags, len(meta_bytes))
+    payload = payload or b""
+    frame_length = len(header) + len(meta_bytes) + len(payload)
+    return b"".join((frame_length.to_bytes(HEADER_LENGTH, byteorder='big'), header, meta_bytes, payload))
+
+# Function to decode a frame body into (packet, payload, flags)
+def decode_packet(frame):
+    if not frame:
+        raise ProtocolError("Empty frame")
+    if frame[0] != PROTOCOL_V2:
+        return json.loads(bytes(frame).decode('utf-8')), None, 0
+
+    if len(frame) < V2_HEADER.size:
+        raise ProtocolError("Truncated v2 header")
+    _, type_code, flags, meta_length = V2_HEADER.unpack_from(frame)
+    meta_end = V2_HEADER.size + meta_length
+    if meta_end > len(frame):
+        raise ProtocolError("Truncated v2 metadata")
+    try:
+        message_type = MESSAGE_NAMES[type_code]
+    except KeyError:
+        raise ProtocolError(f"Unknown message type code: {type_code}")
+    view = memoryview(frame)
+    packet = json.loads(bytes(view[V2_HEADER.size:meta_end]).decode('utf-8')) if meta_length else {}
+    packet['type'] = message_type
+    payload = view[meta_end:] if meta_end < len(frame) else None
+    return packet, payload, flags
+
+# Function to agree on the highest protocol both peers speak
+def negotiate(peer_protocol):
+    try:
+        return max(PROTOCOL_V1, min(int(peer_protocol or PROTOCOL_V1), SUPPORTED_PROTOCOL))
+    except (TypeError, ValueError):
+        return PROTOCOL_V1
@@ -1,227 +1,1050 @@
 # CHAT SERVER IMPLEMENTATION
 
 import socket
-import select
+import selectors
+import argparse
 import sys
-import json
 import os
-import uuid
-from http.server import SimpleHTTPRequestHandler, HTTPServer
+import errno
+import base64
+import hashlib
 import threading
-from fhir_handler import validate_fhir_data
+import time
+from urllib.parse import quote
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from framing import FrameDecoder, FrameError
+from wire import PROTOCOL_V1, PROTOCOL_V2, FLAG_FERNET_RAW, MESSAGE_TYPES, encode_packet, decode_packet, negotiate
+from compression import CompressionStats, CompressionError, choose_codec, codec_functions, pack_text, unpack_text
+from fanout import ClientOutbox, OutboxTotals, POLICIES, DEFAULT_MAX_QUEUE_BYTES, summarize
+from nick_index import NicknameIndex
+from rooms import RoomIndex, RoomError, DEFAULT_ROOM, room_name
+from transfer import (IncomingTransfer, TransferError, UPLOADS_DIR, TRANSFER_ID_PATTERN, SHA256_PATTERN,
+                      DEFAULT_UPLOAD_MAX_AGE, sweep_abandoned)
+from chunking import MAX_TRANSFER_SIZE
+from session_crypto import (KEY_EXCHANGE, STREAM_CIPHER, NONCE_PREFIX_LENGTH, SessionError,
+                            generate_keypair, derive_session_keys, encode_key, decode_key, stream_cipher)
+from fhir_handler import configure_validation_cache, validation_cache_stats, DEFAULT_CACHE_ENTRIES, DEFAULT_CACHE_TTL
+from workers import (WorkerPool, POOL_MODES, DEFAULT_WORKERS, DEFAULT_MAX_IN_FLIGHT,
+                     process_fhir, process_media, process_chunk, process_finished_upload, process_replay)
+from message_log import MessageLog, ReplayError, check_replay_point, seq_at_time, DEFAULT_REPLAY_LIMIT
+from file_server import FileRequestHandler, serve_files, DEFAULT_HTTP_HOST, DEFAULT_HTTP_PORT
+from metrics import Metrics, SamplingProfiler, render, DEFAULT_PROFILE_SECONDS
+from file_store import FileStore, media_object_name, DEFAULT_MAX_BYTES, DEFAULT_MAX_AGE
+from timer_wheel import TimerWheel
+from presence import Presence, DEFAULT_PRESENCE_WINDOW
+from shard_bus import start_shards, BusError, BUS_BROADCAST, BUS_ROUTE, BUS_STATS
 from cryptography.fernet import Fernet # type: ignore
 
 # Constants
-HEADER_LENGTH = 4
+RECV_BUFFER_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024  # 1 MB
+MAX_CHAT_TEXT = 64 * 1024  # bytes of text in one chat or private message, after decompression
+STATS_INTERVAL = 1.0  # seconds between a shard's stats reports to the hub
+DEFAULT_PING_INTERVAL = 30  # seconds
+DEFAULT_IDLE_TIMEOUT = 90  # seconds
+KEEPALIVE_INTERVAL = 10  # seconds between TCP keepalive probes
+KEEPALIVE_COUNT = 3  # unanswered probes before the kernel drops a connection
+ACCEPT_BACKOFF = 0.5  # seconds the listener is not watched after running out of file descriptors
+DROPPABLE_TYPES = ("chat", "join", "leave", "presence")  # broadcasts a slow consumer may miss
 
 # Handle command line arguments
-if len(sys.argv) != 2:
-    print("Usage: python chat_server.py <port>")
-    sys.exit(1)
+parser = argparse.ArgumentParser(description="DP Chat server")
+parser.add_argument("port", type=int)
+parser.add_argument("--slow-consumer-policy", choices=POLICIES, default="drop",
+                    help="What to do when a client's outbound queue is full")
+parser.add_argument("--max-queue-bytes", type=int, default=DEFAULT_MAX_QUEUE_BYTES,
+                    help="Outbound queue limit per client, in bytes")
+parser.add_argument("--pool", choices=POOL_MODES, default="thread",
+                    help="Run decryption, FHIR validation and file writes on threads or processes")
+parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                    help="Number of pool workers")
+parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                    help="Pending pool jobs per client before the server stops reading from it")
+parser.add_argument("--fhir-cache-entries", type=int, default=DEFAULT_CACHE_ENTRIES,
+                    help="FHIR validation results to keep, keyed by payload SHA-256 (0 disables the cache)")
+parser.add_argument("--fhir-cache-ttl", type=float, default=DEFAULT_CACHE_TTL,
+                    help="Seconds a cached FHIR validation result stays valid")
+parser.add_argument("--ping-interval", type=float, default=DEFAULT_PING_INTERVAL,
+                    help="Seconds a client may be quiet before it is pinged")
+parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT,
+                    help="Seconds without any traffic (pongs included) before a connection is closed")
+parser.add_argument("--presence-window", type=float, default=DEFAULT_PRESENCE_WINDOW,
+                    help="Seconds of joins and leaves collected into one presence update")
+parser.add_argument("--http-host", default=DEFAULT_HTTP_HOST,
+                    help="Address the file server binds to (0.0.0.0 for all interfaces)")
+parser.add_argument("--http-port", type=int, default=DEFAULT_HTTP_PORT,
+                    help="Port of the file server")
+parser.add_argument("--http-url",
+                    help="Base URL put in file links (defaults to the file server's address)")
+parser.add_argument("--shards", type=int, default=1,
+                    help="Worker processes accepting on the same port (SO_REUSEPORT), joined by a message bus")
+parser.add_argument("--profile-dir", default="./profiles/",
+                    help="Where SIGUSR1 sampling profiles are written")
+parser.add_argument("--profile-seconds", type=float, default=DEFAULT_PROFILE_SECONDS,
+                    help="How long a SIGUSR1 sampling profile runs")
+parser.add_argument("--store-dir", default="./rendered_files/store/",
+                    help="Directory of the received file store")
+parser.add_argument("--store-max-mb", type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                    help="Disk space received files may use before the least recently used are deleted")
+parser.add_argument("--store-max-age-days", type=float, default=DEFAULT_MAX_AGE / 86400,
+                    help="Age after which received files are deleted (0 keeps them until space runs out)")
+parser.add_argument("--upload-max-age-hours", type=float, default=DEFAULT_UPLOAD_MAX_AGE / 3600,
+                    help="Hours an unfinished upload is kept for resuming before it is deleted")
+parser.add_argument("--history-dir", default="./rendered_files/message_log/",
+                    help="Directory of the persistent message log")
+parser.add_argument("--no-history", action="store_true",
+                    help="Do not log room traffic or replay it to reconnecting clients")
+parser.add_argument("--history-segment-mb", type=int, default=64,
+                    help="Size at which a new log segment is started")
+parser.add_argument("--history-retention-mb", type=int, default=1024,
+                    help="Disk space the message log may use before old segments are deleted")
+parser.add_argument("--history-retention-days", type=float, default=7,
+                    help="Age after which old log segments are deleted")
+parser.add_argument("--history-replay-limit", type=int, default=DEFAULT_REPLAY_LIMIT,
+                    help="Most messages replayed to a reconnecting client")
+args = parser.parse_args()
 
-port = int(sys.argv[1])
+port = args.port
 
 # Get the IP address of the server machine
 hostname = socket.gethostname()
 local_ip = socket.gethostbyname(hostname)
 print(f"Server IP Address: {local_ip}")
 
-# Create a listener socket
+# Base URL of the links sent for received files
+http_host = local_ip if args.http_host in ("", "0.0.0.0") else args.http_host
+http_url = (args.http_url or f"http://{http_host}:{args.http_port}").rstrip('/')
+
+# Received files go into the file store. Files saved by older versions in
+# the flat directories below are still served from there.
+FHIR_FILES_DIR = "./rendered_files/rendered_fhir_files/"
+MEDIA_FILES_DIR = "./rendered_files/rendered_media_files/"
+os.makedirs(UPLOADS_DIR, exist_ok=True)
+file_store = FileStore(args.store_dir, args.store_max_mb * 1024 * 1024, args.store_max_age_days * 86400)
+
+# Unfinished uploads are kept for resuming, but not forever; they are swept
+# at startup and with every file store collection
+def sweep_uploads():
+    removed = sweep_abandoned(UPLOADS_DIR, args.upload_max_age_hours * 3600)
+    if removed:
+        print(f"Deleted {removed} abandoned upload(s)")
+
+sweep_uploads()
+
+configure_validation_cache(args.fhir_cache_entries, args.fhir_cache_ttl)
+
+# FHIR JSON is served gzipped to clients that accept it
+class CustomHTTPRequestHandler(FileRequestHandler):
+    routes = {
+        "fhir_files": (FHIR_FILES_DIR, True),
+        "media_files": (MEDIA_FILES_DIR, False),
+    }
+
+    def resolve(self, prefix, name):
+        return file_store.lookup(prefix, name) or super().resolve(prefix, name)
+
+    def get_stats(self):
+        stats = bus_hub.stats() if bus_hub is not None else fanout_stats()
+        stats["file_store"] = file_store.stats()
+        return stats
+
+    def get_metrics(self):
+        return render(bus_hub.metric_snapshots() if bus_hub is not None else [({}, metrics.snapshot())])
+
+# Function to build the link for a received file
+def file_url(route, filename):
+    return f"{http_url}/{route}/{quote(filename)}"
+
+def start_http_server():
+    serve_files(args.http_host, args.http_port, CustomHTTPRequestHandler)
+
+http_server_thread = threading.Thread(target=start_http_server)
+http_server_thread.daemon = True
+
+# Sharded mode: fork the shards, and keep this process as the bus hub and
+# the file server. Everything below this point runs in each shard.
+bus = None
+bus_hub = None
+if args.shards > 1:
+    try:
+        bus_hub, bus = start_shards(args.shards)
+    except BusError as e:
+        sys.exit(f"Error: {e}")
+    if bus_hub is not None:
+        print(f"Started {args.shards} shards on port {port}")
+        print(f"Received files are served at {http_url}")
+        http_server_thread.start()
+        file_store.start_collector(tasks=[sweep_uploads])
+        try:
+            bus_hub.run()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+# Create a non-blocking listener socket; in sharded mode every shard binds
+# its own and the kernel spreads new connections across them
 server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+if bus is not None:
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 server_socket.bind((local_ip, port))
-server_socket.listen()
+server_socket.listen(socket.SOMAXCONN)
+server_socket.setblocking(False)
+
+# Readiness notification (epoll/kqueue where available) instead of select()
+selector = selectors.DefaultSelector()
+selector.register(server_socket, selectors.EVENT_READ)
+accept_resume_at = None  # when to watch the listener again after it was set aside
+if bus is not None:
+    selector.register(bus, selectors.EVENT_READ)
 
-# List of sockets to monitor with select
-sockets_list = [server_socket]
+# Per-connection state, keyed by socket
 clients = {}
 encryption_keys = {}
+stream_keys = {}
 nicknames = {}
+nick_index = NicknameIndex()
+room_index = RoomIndex()
+compression_stats = CompressionStats()
+decoders = {}
+protocols = {}
+codecs = {}
+outboxes = {}
+closed_outboxes = OutboxTotals()
+addresses = {}
+client_uploads = {}
 
-# Directory to store FHIR JSON files
-FHIR_FILES_DIR = "./rendered_files/rendered_fhir_files/"
-MEDIA_FILES_DIR = "./rendered_files/rendered_media_files/"
-os.makedirs(FHIR_FILES_DIR, exist_ok=True)
-os.makedirs(MEDIA_FILES_DIR, exist_ok=True)
-
-print(f"Server is listening on {local_ip}:{port}")
-
-def save_file(data, filename, dir):
-    filepath = os.path.join(dir, filename)
-    with open(filepath, 'wb') as f:
-        f.write(data)
-    return filename
-
-class CustomHTTPRequestHandler(SimpleHTTPRequestHandler):
-    def translate_path(self, path):
-        # Remove the leading /
-        path = path.lstrip('/')
-        
-        if path.startswith('fhir_files/'):
-            return os.path.join(FHIR_FILES_DIR, path[len('fhir_files/'):])
-        elif path.startswith('media_files/'):
-            return os.path.join(MEDIA_FILES_DIR, path[len('media_files/'):])
-        else:
-            return SimpleHTTPRequestHandler.translate_path(self, path)
+# Presence: the roster of everyone online and the joins and leaves waiting
+# to go out as one delta. Older clients get a frame per join and leave.
+presence = Presence()
+presence_clients = set()
+join_leave_clients = set()
 
-def start_http_server():
-    handler = CustomHTTPRequestHandler
-    httpd = HTTPServer(('localhost', 8000), handler)
-    httpd.serve_forever()
+# Chunked uploads in progress, keyed by transfer ID
+uploads = {}
+upload_owners = {}
+slow_consumer_disconnects = 0
 
-http_server_thread = threading.Thread(target=start_http_server)
-http_server_thread.daemon = True
-http_server_thread.start()
+# Idle connections: when each client was last heard from, and one timer per
+# connection in a timer wheel. Timers are not moved when traffic arrives;
+# a timer that fires early just checks last_seen and waits again.
+last_seen = {}
+heartbeat_clients = set()
+idle_timers = TimerWheel(time.monotonic())
+idle_disconnects = 0
+
+# Counters and latency histograms for /metrics, and a stack sampler that
+# SIGUSR1 switches on
+metrics = Metrics()
+profiler = SamplingProfiler(args.profile_dir, args.profile_seconds)
+profiler.install()
+
+# Pool for decryption, FHIR validation and disk writes. Its completions
+# wake the event loop through a socket registered with the selector.
+worker_pool = WorkerPool(args.pool, args.workers, args.max_in_flight, metrics.record_timings)
+selector.register(worker_pool.wakeup_reader, selectors.EVENT_READ)
 
+# Threads are started only after the pool has forked its workers, so no
+# worker process inherits a lock one of them was holding
+if bus is None:
+    http_server_thread.start()
+    file_store.start_collector(tasks=[sweep_uploads])
+paused_clients = set()
+interests = {}
+
+# Persistent log of room traffic, replayed to clients that reconnect. Live
+# frames for a client are held in its outbox until its replay is queued.
+message_log = None
+if not args.no_history:
+    if bus is not None:
+        print(f"Shard {bus.shard_id}: message history is not kept in --shards mode")
+    else:
+        message_log = MessageLog(args.history_dir, args.history_segment_mb * 1024 * 1024,
+                                 args.history_retention_mb * 1024 * 1024, args.history_retention_days * 24 * 3600)
+
+metrics.gauge("connected_clients", lambda: len(clients))
+metrics.gauge("outbound_queued_frames", lambda: sum(len(outbox) for outbox in list(outboxes.values())))
+metrics.gauge("outbound_queued_bytes", lambda: sum(outbox.queued_bytes for outbox in list(outboxes.values())))
+metrics.gauge("worker_jobs_in_flight", worker_pool.in_flight)
+metrics.gauge("paused_clients", lambda: len(paused_clients))
+metrics.gauge("uploads_in_progress", lambda: len(uploads))
+metrics.gauge("rooms", lambda: len(room_index))
+metrics.gauge("online_users", lambda: len(presence))
+
+if bus is not None:
+    print(f"Shard {bus.shard_id} is listening on {local_ip}:{port}")
+else:
+    print(f"Server is listening on {local_ip}:{port}")
+    print(f"Received files are served at {http_url}")
+
+# Function to report fan-out queue counters
+def fanout_stats():
+    stats = summarize(outboxes.values(), closed_outboxes)
+    stats["slow_consumer_disconnects"] = slow_consumer_disconnects
+    stats["idle_disconnects"] = idle_disconnects
+    # With a process pool each worker has its own cache and this process's
+    # is never used, so there is nothing meaningful to report
+    if args.pool != "process":
+        stats["fhir_validation_cache"] = validation_cache_stats()
+    stats["rooms"] = len(room_index)
+    stats["online_users"] = len(presence)
+    stats["compression"] = compression_stats.summary()
+    if message_log is not None:
+        stats["message_log"] = message_log.stats()
+    return stats
+
+# Function to pick a nickname no other user has; in sharded mode the hub
+# holds the registry for every shard
 def get_unique_nickname(nick, category):
-    base_nick = f"{nick} ({category})"
-    unique_nick = base_nick
-    count = 1
-    while unique_nick.lower() in (name.lower() for name in clients.values()):
-        unique_nick = f"{base_nick}{count}"
-        count += 1
-    return unique_nick
-
-# Function to handle receiving data from clients
-def receive_data(client_socket):
-    try:
-        data = client_socket.recv(HEADER_LENGTH)
-        if not len(data):
-            return False
-        data_length = int.from_bytes(data, byteorder='big')
-        data = b""
-        while len(data) < data_length:
-            packet = client_socket.recv(data_length - len(data))
-            if not packet:
-                return False
-            data += packet
-        return data.decode('utf-8')
-    except Exception as e:
-        print(f"Error receiving data: {e}")
+    if bus is not None:
+        return bus.claim(f"{nick} ({category})")
+    return nick_index.unique(f"{nick} ({category})")
+
+# Function to find the socket of a connected user by nickname
+def find_client(nick):
+    return nick_index.find(nick)
+
+# Function to watch a socket for writability only while it has queued output,
+# and for readability only while its sender is under the in-flight limit
+def update_interest(client_socket):
+    events = 0
+    if client_socket not in paused_clients:
+        events |= selectors.EVENT_READ
+    if outboxes[client_socket]:
+        events |= selectors.EVENT_WRITE
+    current = interests[client_socket]
+    if events == current:
+        return
+    if not current:
+        selector.register(client_socket, events)
+    elif not events:
+        selector.unregister(client_socket)
+    else:
+        selector.modify(client_socket, events)
+    interests[client_socket] = events
+
+# Function to write queued output and tell the client if frames were skipped
+def flush_client(client_socket):
+    outbox = outboxes[client_socket]
+    started = time.perf_counter()
+    sent_before = outbox.sent_bytes
+    flushed = outbox.flush(client_socket)
+    metrics.observe("stage_seconds", time.perf_counter() - started, stage="send")
+    metrics.inc("sent_bytes_total", outbox.sent_bytes - sent_before)
+    if not flushed:
         return False
+    if not outbox and outbox.skipped_since_notice:
+        skipped = outbox.skipped_since_notice
+        outbox.skipped_since_notice = 0
+        notice = {"type": "error", "message": f"{skipped} messages were skipped because your connection is too slow"}
+        outbox.push(encode_packet(notice, version=protocols.get(client_socket, PROTOCOL_V1)))
+        return outbox.flush(client_socket)
+    return True
 
-# Main server loop
-while True:
-    read_sockets, _, exception_sockets = select.select(sockets_list, [], sockets_list)
-    
-    for notified_socket in read_sockets:
-        if notified_socket == server_socket:
-            # Accept new connection
+# Function to queue an encoded frame for a client without blocking on its socket
+def queue_frame(client_socket, frame, droppable=False):
+    global slow_consumer_disconnects
+    outbox = outboxes.get(client_socket)
+    if outbox is None:
+        return
+    metrics.inc("frames_queued_total")
+    was_idle = not outbox
+    if not outbox.push(frame, droppable):
+        slow_consumer_disconnects += 1
+        metrics.inc("slow_consumer_disconnects_total")
+        print(f"--- Disconnecting slow consumer {clients.get(client_socket, addresses[client_socket])}")
+        remove_client(client_socket)
+        return
+    if not was_idle:
+        return
+    if not flush_client(client_socket):
+        remove_client(client_socket)
+    elif outbox:
+        update_interest(client_socket)
+
+# Function to encode a packet in a client's protocol version, compressing
+# long message text for clients that negotiated a codec
+def encode_for(packet, version, codec):
+    payload = None
+    if version >= PROTOCOL_V2 and packet.get('type') in ('chat', 'private'):
+        packet, payload = pack_text(packet, 'message', codec, compression_stats)
+    return encode_packet(packet, payload, version=version)
+
+# Function to send a packet to a single client in the protocol it negotiated
+def send_packet(client_socket, packet):
+    queue_frame(client_socket, encode_for(packet, protocols.get(client_socket, PROTOCOL_V1), codecs.get(client_socket)))
+
+# Function to send a packet to every user except one, on this shard and,
+# through the bus, on every other shard
+def broadcast(packet, exclude=None):
+    if message_log is not None:
+        packet = dict(packet, seq=message_log.append(packet))
+    broadcast_local(packet, exclude)
+    if bus is not None:
+        bus.publish(packet)
+
+# Function to send a packet to every user connected to this process except
+# one. Packets for a room only go to that room's members. Joins and leaves
+# are sent straight away only to older clients; the rest hear about them in
+# the next presence delta.
+def broadcast_local(packet, exclude=None):
+    room = packet.get('room')
+    if packet['type'] in ('join', 'leave'):
+        presence.record(packet, time.monotonic(), args.presence_window)
+        recipients = join_leave_clients
+    else:
+        recipients = room_index.members_of(room) if room is not None else clients
+    fan_out(packet, recipients, exclude)
+
+# Function to send a packet to a set of clients, encoding it at most once
+# per protocol version and codec
+def fan_out(packet, recipients, exclude=None):
+    started = time.perf_counter()
+    frames = {}
+    droppable = packet['type'] in DROPPABLE_TYPES
+    for client in list(recipients):
+        if client == exclude:
+            continue
+        encoding = (protocols.get(client, PROTOCOL_V1), codecs.get(client))
+        frame = frames.get(encoding)
+        if frame is None:
+            frame = frames[encoding] = encode_for(packet, *encoding)
+        queue_frame(client, frame, droppable)
+    metrics.observe("stage_seconds", time.perf_counter() - started, stage="fanout")
+
+# Function to drop a connection and tell the room if it had joined
+def remove_client(client_socket):
+    if client_socket not in decoders:
+        return
+    if interests.pop(client_socket):
+        selector.unregister(client_socket)
+    paused_clients.discard(client_socket)
+    idle_timers.cancel(client_socket)
+    last_seen.pop(client_socket, None)
+    heartbeat_clients.discard(client_socket)
+    presence_clients.discard(client_socket)
+    join_leave_clients.discard(client_socket)
+    worker_pool.forget(client_socket)
+    address = addresses.pop(client_socket)
+    del decoders[client_socket]
+    closed_outboxes.add(outboxes.pop(client_socket))
+    protocols.pop(client_socket, None)
+    codecs.pop(client_socket, None)
+
+    # Keep unfinished uploads on disk so the sender can resume them
+    for key in client_uploads.pop(client_socket, ()):
+        uploads.pop(key).failed = True
+        del upload_owners[key]
+
+    client_socket.close()
+    user = clients.pop(client_socket, None)
+    if user is None:
+        return
+    del encryption_keys[client_socket]
+    stream_keys.pop(client_socket, None)
+    del nicknames[client_socket]
+    nick_index.remove(user)
+    room_index.leave_all(client_socket)
+    if bus is not None:
+        bus.release(user)
+
+    # Broadcast leave message
+    broadcast({"type": "leave", "nick": user})
+    print(f"--- Closed connection from {address} with username: {user}")
+
+# Function to accept every pending connection on the listener
+def accept_connections():
+    global accept_resume_at
+    while True:
+        try:
             client_socket, client_address = server_socket.accept()
-            user_data = receive_data(client_socket)
-            if user_data is False:
-                continue
-            
-            user_info = json.loads(user_data)
-            nick = user_info['nick']
-            category = user_info['category']
-            unique_nick = get_unique_nickname(nick, category)
-            nicknames[client_socket] = unique_nick
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(f"Error accepting connection: {e}")
+            if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                # The connection stays queued, so the listener stays readable;
+                # stop watching it for a while instead of spinning on it
+                selector.unregister(server_socket)
+                accept_resume_at = time.monotonic() + ACCEPT_BACKOFF
+            return
+        client_socket.setblocking(False)
+        enable_keepalive(client_socket)
+        decoders[client_socket] = FrameDecoder()
+        outboxes[client_socket] = ClientOutbox(args.max_queue_bytes, args.slow_consumer_policy)
+        addresses[client_socket] = client_address
+        client_uploads[client_socket] = set()
+        interests[client_socket] = selectors.EVENT_READ
+        selector.register(client_socket, selectors.EVENT_READ)
+        # A connection that never says hello is closed after the idle timeout
+        last_seen[client_socket] = time.monotonic()
+        idle_timers.schedule(client_socket, last_seen[client_socket] + args.idle_timeout)
+
+# Function to let the kernel probe a connection that goes quiet, so a peer
+# that vanished is noticed even when it cannot answer pings (older clients)
+def enable_keepalive(client_socket):
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", int(args.idle_timeout)), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+        if hasattr(socket, option):
+            client_socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), max(1, value))
+
+# Function to check a connection whose idle timer fired: close it if nothing
+# arrived for the idle timeout, ping it if it has been quiet for a ping
+# interval, or otherwise wait until it could next need either
+def check_idle(client_socket, now):
+    global idle_disconnects
+    idle = now - last_seen[client_socket]
+    if idle >= args.idle_timeout and client_socket not in paused_clients:
+        idle_disconnects += 1
+        metrics.inc("idle_disconnects_total")
+        print(f"--- Closing idle connection {clients.get(client_socket, addresses[client_socket])}")
+        remove_client(client_socket)
+    elif client_socket in heartbeat_clients and idle >= args.ping_interval:
+        idle_timers.schedule(client_socket, last_seen[client_socket] + args.idle_timeout)
+        send_packet(client_socket, {"type": "ping"})
+    elif client_socket in heartbeat_clients:
+        idle_timers.schedule(client_socket, last_seen[client_socket] + args.ping_interval)
+    else:
+        idle_timers.schedule(client_socket, max(now, last_seen[client_socket]) + args.idle_timeout)
+
+# Function to register a user from their hello packet
+def handle_hello(client_socket, user_info):
+    nick = user_info['nick']
+    category = user_info['category']
+    if message_log is not None:
+        check_replay_point(user_info)  # Refused before the user joins
+    update_nick_message = {"type": "update_nick"}
+    if user_info.get('key_exchange') == KEY_EXCHANGE:
+        # Ephemeral X25519 exchange: no key material crosses the wire
+        client_public_key = decode_key(user_info['public_key'])
+        server_private_key, server_public_key = generate_keypair()
+        session_keys = derive_session_keys(server_private_key, client_public_key, server_public_key, client_public_key)
+        encryption_key = session_keys.fernet_key
+        stream_keys[client_socket] = worker_pool.session_cipher(session_keys.stream_key, stream_cipher)
+        update_nick_message.update({"key_exchange": KEY_EXCHANGE, "public_key": encode_key(server_public_key),
+                                    "stream_cipher": STREAM_CIPHER})
+    else:
+        # Older clients send their Fernet key in the hello packet; a
+        # malformed key is refused before the user joins
+        try:
             encryption_key = user_info['encryption_key'].encode()
-            encryption_keys[client_socket] = encryption_key
-            cipher_suite = Fernet(encryption_key)
-            sockets_list.append(client_socket)
-            clients[client_socket] = unique_nick
-
-            # Inform the client of their unique nickname
-            update_nick_message = json.dumps({"type": "update_nick", "nick": unique_nick})
-            client_socket.send(len(update_nick_message).to_bytes(HEADER_LENGTH, byteorder='big') + update_nick_message.encode('utf-8'))
-
-            # Broadcast join message
-            join_message = json.dumps({"type": "join", "nick": unique_nick})
-            for client in clients.keys():
-                if client != client_socket:
-                    client.send(len(join_message).to_bytes(HEADER_LENGTH, byteorder='big') + join_message.encode('utf-8'))
-            
-            print(f"+++ Accepted new connection from {client_address[0]}:{client_address[1]} with username: {unique_nick}")
+            Fernet(encryption_key)
+        except (KeyError, AttributeError, ValueError):
+            raise SessionError("Encryption key is not a valid Fernet key")
+    unique_nick = get_unique_nickname(nick, category)
+    nicknames[client_socket] = unique_nick
+    encryption_keys[client_socket] = worker_pool.session_cipher(encryption_key, Fernet)
+    clients[client_socket] = unique_nick
+    nick_index.add(unique_nick, client_socket)
+
+    # Inform the client of their unique nickname, the agreed protocol and the
+    # server's half of the key exchange; this reply is still v1 so clients
+    # that sent a plain hello can read it
+    protocol = negotiate(user_info.get('protocol'))
+    update_nick_message.update({"nick": unique_nick, "protocol": protocol})
+    if message_log is not None:
+        update_nick_message["log_id"] = message_log.log_id
+    codec = choose_codec(user_info.get('compression'))
+    if codec:
+        update_nick_message["compression"] = codec
+    send_packet(client_socket, update_nick_message)
+    protocols[client_socket] = protocol
+    codecs[client_socket] = codec
+
+    # Clients that keep a roster get everyone online now and presence deltas
+    # from then on
+    if user_info.get('presence'):
+        presence_clients.add(client_socket)
+        send_packet(client_socket, {"type": "roster", "users": presence.snapshot()})
+    else:
+        join_leave_clients.add(client_socket)
+
+    # Clients that answer pings are pinged when quiet; older clients are
+    # left to TCP keepalive
+    if user_info.get('heartbeat'):
+        heartbeat_clients.add(client_socket)
+        idle_timers.schedule(client_socket, last_seen[client_socket] + args.ping_interval)
+    else:
+        idle_timers.cancel(client_socket)
+
+    # Everyone starts in the lobby; returning clients ask for their rooms back
+    rooms = user_info.get('rooms')
+    for room in rooms if isinstance(rooms, list) and rooms else [DEFAULT_ROOM]:
+        try:
+            room_index.join(room_name(room), client_socket)
+        except RoomError:
+            pass
+
+    # Replay what a returning user missed; started before the join broadcast
+    # so the replay does not include their own join
+    if message_log is not None and ('since' in user_info or 'since_time' in user_info):
+        start_replay(client_socket, user_info)
+
+    # Broadcast join message
+    broadcast({"type": "join", "nick": unique_nick, "category": category}, exclude=client_socket)
 
+    client_address = addresses[client_socket]
+    print(f"+++ Accepted new connection from {client_address[0]}:{client_address[1]} with username: {unique_nick}")
+
+# Function to send a reconnecting client the room traffic it missed, from
+# sequence number `since` or time `since_time` onwards. The log is read and
+# encoded in the worker pool; records the log writer has not written yet are
+# taken from memory.
+def start_replay(client_socket, user_info):
+    reset = False
+    if 'since_time' in user_info:
+        first_seq = seq_at_time(args.history_dir, user_info['since_time'])
+        since = first_seq - 1 if first_seq is not None else message_log.next_seq - 1
+    else:
+        since = user_info['since']
+        # A sequence number from another log, or past the end of this one,
+        # says nothing about what the client missed: replay from the oldest
+        # record kept and mark the replay truncated
+        if user_info.get('log_id', message_log.log_id) != message_log.log_id or since >= message_log.next_seq:
+            since, reset = 0, True
+    until, unwritten = message_log.snapshot(since)
+    version = protocols[client_socket]
+    rooms = room_index.rooms_of(client_socket)
+    unwritten = [record for record in unwritten if record[2].get('room') in rooms or 'room' not in record[2]]
+    outboxes[client_socket].hold()
+
+    def replay_done(result, error):
+        if client_socket not in outboxes:
+            return
+        held = outboxes[client_socket].release()
+        block, count, truncated = b"", 0, False
+        if error:
+            print(f"Error replaying history: {error}")
         else:
-            message = receive_data(notified_socket)
-            if message is False:
-                # Client disconnected
-                user = clients[notified_socket]
-                sockets_list.remove(notified_socket)
-                del clients[notified_socket]
-                del encryption_keys[notified_socket]
-                del nicknames[notified_socket]
-
-                # Broadcast leave message
-                leave_message = json.dumps({"type": "leave", "nick": user})
-                for client in clients.keys():
-                    client.send(len(leave_message).to_bytes(HEADER_LENGTH, byteorder='big') + leave_message.encode('utf-8'))
-                
-                print(f"--- Closed connection from {notified_socket.getpeername()} with username: {user}")
-                continue
+            block, count, truncated = result
+        truncated = truncated or reset
+        tail = [encode_packet(dict(packet, seq=seq, ts=ts, replay=True), version=version)
+                for seq, ts, packet in unwritten]
+        send_packet(client_socket, {"type": "history", "count": count + len(tail), "truncated": truncated})
+        if block:
+            queue_frame(client_socket, block)
+        for frame in tail:
+            queue_frame(client_socket, frame)
+        for frame, droppable in held:
+            queue_frame(client_socket, frame, droppable)
+
+    worker_pool.submit(client_socket, process_replay,
+                       (args.history_dir, since, until, args.history_replay_limit, args.max_queue_bytes, version,
+                        sorted(rooms)),
+                       replay_done)
+
+# Function to deliver a notification to one named user, or to everyone else
+# in a room
+def route_packet(notified_socket, packet, target_nick, room):
+    if target_nick:
+        send_to_nick(notified_socket, target_nick, packet)
+    else:
+        broadcast(dict(packet, room=room), exclude=notified_socket)
+
+# Function to find the room a message without a target is for; clients that
+# predate rooms always talk in the lobby
+def message_room(notified_socket, message_data):
+    if message_data.get('target'):
+        return None
+    room = room_name(message_data.get('room') or DEFAULT_ROOM)
+    if not room_index.is_member(room, notified_socket):
+        raise RoomError(f"You are not in room '{room}'. Use /join {room} first")
+    return room
+
+# Function to add a user to a room and tell its members
+def join_room(notified_socket, room):
+    user = clients[notified_socket]
+    if room_index.join(room, notified_socket):
+        broadcast({"type": "room_join", "room": room, "nick": user}, exclude=notified_socket)
+    send_packet(notified_socket, {"type": "room_join", "room": room, "nick": user,
+                                  "members": len(room_index.members_of(room))})
+
+# Function to take a user out of a room and tell the remaining members
+def leave_room(notified_socket, room):
+    user = clients[notified_socket]
+    if not room_index.leave(room, notified_socket):
+        raise RoomError(f"You are not in room '{room}'")
+    broadcast({"type": "room_leave", "room": room, "nick": user})
+    send_packet(notified_socket, {"type": "room_leave", "room": room, "nick": user, "members": 0})
+
+# Function to deliver a packet to one user, wherever they are connected; the
+# sender is told if nobody has that nickname
+def send_to_nick(notified_socket, target_nick, packet):
+    target_socket = find_client(target_nick)
+    if target_socket is not None:
+        send_packet(target_socket, packet)
+    elif bus is not None:
+        bus.route(target_nick, packet, clients[notified_socket])
+    else:
+        send_packet(notified_socket, {"type": "error", "message": f"User '{target_nick}' not found"})
+
+# Function to recover the Fernet token from a v1 JSON field or a v2 payload
+def encrypted_token(message_data, payload, flags):
+    if payload is None:
+        return message_data['data'].encode('latin1')
+    if flags & FLAG_FERNET_RAW:
+        return base64.urlsafe_b64encode(payload)
+    return bytes(payload)
+
+# Function to start or resume a chunked upload
+def start_upload(notified_socket, message_data):
+    transfer_id = str(message_data.get('transfer_id', ''))
+    kind = message_data.get('kind')
+    size = int(message_data['size'])
+    chunk_size = int(message_data['chunk_size'])
+    if not TRANSFER_ID_PATTERN.match(transfer_id):
+        raise TransferError("Invalid transfer ID")
+    if not SHA256_PATTERN.match(str(message_data.get('sha256', ''))):
+        raise TransferError("Invalid file checksum")
+    if kind not in ('fhir', 'media'):
+        raise TransferError(f"Unsupported transfer kind: {kind}")
+    if not 0 <= size <= MAX_TRANSFER_SIZE:
+        raise TransferError(f"File size exceeds the {MAX_TRANSFER_SIZE // (1024 * 1024)}MB limit")
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise TransferError("Invalid chunk size")
+    cipher = message_data.get('cipher', 'fernet')
+    nonce_prefix = None
+    if cipher == STREAM_CIPHER:
+        if notified_socket not in stream_keys:
+            raise TransferError("Streaming encryption needs a key exchange at connect time")
+        try:
+            nonce_prefix = base64.b64decode(message_data['nonce_prefix'], validate=True)
+        except (KeyError, TypeError, ValueError):
+            raise TransferError("Invalid nonce prefix")
+        if len(nonce_prefix) != NONCE_PREFIX_LENGTH:
+            raise TransferError("Invalid nonce prefix")
+    elif cipher != 'fernet':
+        raise TransferError(f"Unsupported cipher: {cipher}")
+    try:
+        room = message_room(notified_socket, message_data)
+    except RoomError as e:
+        raise TransferError(str(e))
+    compression = message_data.get('compression')
+    raw_sha256 = None
+    if compression:
+        try:
+            codec_functions(compression)
+        except CompressionError as e:
+            raise TransferError(str(e))
+        raw_sha256 = str(message_data.get('raw_sha256', ''))
+        if not SHA256_PATTERN.match(raw_sha256):
+            raise TransferError("Invalid checksum for the decompressed file")
+    key = upload_key(notified_socket, transfer_id)
+    if key in uploads:
+        if upload_owners[key] is not notified_socket:
+            raise TransferError("This upload is already in progress on another connection")
+        uploads.pop(key).failed = True
+        client_uploads[notified_socket].discard(key)
+
+    transfer = IncomingTransfer(transfer_id, kind, os.path.basename(str(message_data.get('filename') or 'upload')),
+                                size, chunk_size, str(message_data['sha256']), message_data.get('target'), key)
+    transfer.cipher = cipher
+    transfer.nonce_prefix = nonce_prefix
+    transfer.room = room
+    transfer.compression = compression
+    transfer.raw_sha256 = raw_sha256
+    next_chunk = transfer.open()
+    uploads[key] = transfer
+    upload_owners[key] = notified_socket
+    client_uploads[notified_socket].add(key)
+    send_packet(notified_socket, {"type": "upload_ack", "transfer_id": transfer_id, "next_chunk": next_chunk})
+
+# Function to scope a transfer ID to the sender's nickname, so two users
+# sending the same file at once do not share an upload
+def upload_key(notified_socket, transfer_id):
+    return hashlib.sha256(f"{clients[notified_socket].casefold()}\0{transfer_id}".encode('utf-8')).hexdigest()[:32]
+
+# Function to stop tracking an upload as in progress
+def release_upload(notified_socket, transfer_id):
+    key = upload_key(notified_socket, transfer_id)
+    if upload_owners.get(key) is not notified_socket:
+        return None
+    del upload_owners[key]
+    client_uploads[notified_socket].discard(key)
+    return uploads.pop(key)
+
+# Function to stop accepting chunks for an upload, keeping it for a resume
+def abort_upload(notified_socket, transfer_id):
+    transfer = release_upload(notified_socket, transfer_id)
+    if transfer is not None:
+        transfer.failed = True
+
+# Function to drop an upload its sender cancelled, including the part file
+def cancel_upload(notified_socket, transfer_id):
+    transfer = release_upload(notified_socket, transfer_id)
+    if transfer is not None:
+        transfer.failed = True
+        transfer.discard()
+
+# Function to report a failed upload to its sender
+def upload_failed(notified_socket, transfer_id, message):
+    abort_upload(notified_socket, transfer_id)
+    send_packet(notified_socket, {"type": "error", "message": message, "transfer_id": transfer_id})
+
+# Function to hand one chunk to the worker pool
+def receive_upload_chunk(notified_socket, message_data, payload, flags):
+    transfer_id = str(message_data.get('transfer_id'))
+    key = upload_key(notified_socket, transfer_id)
+    if upload_owners.get(key) is not notified_socket:
+        raise TransferError("Unknown transfer ID")
+    transfer = uploads[key]
+    if payload is None:
+        raise TransferError("Chunk has no payload")
+    index = int(message_data['index'])
+    offset, expected_length = transfer.reserve_chunk(index)
+
+    def chunk_done(result, error):
+        if transfer.failed:
+            return
+        if error:
+            upload_failed(notified_socket, transfer_id, f"Chunk {index}: {error}")
+            return
+        transfer.chunk_written()
+        if transfer.complete:
+            finish_upload(notified_socket, transfer)
+
+    # AES-GCM tags (or Fernet's HMAC) authenticate every chunk before it
+    # touches the disk
+    if transfer.cipher == STREAM_CIPHER:
+        key, token = stream_keys[notified_socket], bytes(payload)
+    else:
+        key, token = encryption_keys[notified_socket], encrypted_token(message_data, payload, flags)
+    worker_pool.submit(notified_socket, process_chunk,
+                       (transfer.cipher, key, token, transfer.nonce_prefix, transfer_id, index,
+                        index == transfer.total_chunks - 1, transfer.part_path, offset, expected_length),
+                       chunk_done)
 
-            # Process received message
-            user = clients[notified_socket]
-            message_data = json.loads(message)
-            cipher_suite = Fernet(encryption_keys[notified_socket])
-
-            if message_data['type'] == 'fhir':
-                decrypted_fhir = cipher_suite.decrypt(message_data['data'].encode())
-                is_valid, validation_message = validate_fhir_data(decrypted_fhir.decode())
-                if is_valid:
-                    filename = save_file(decrypted_fhir, f"{uuid.uuid4()}.json", FHIR_FILES_DIR)
-                    file_url = f"http://localhost:8000/fhir_files/{filename}"
-                    fhir_message = json.dumps({"type": "fhir", "nick": user, "data": file_url})
-                    if message_data.get('target'):
-                        found = False
-                        for client_socket, nickname in clients.items():
-                            if nickname.lower() == message_data['target'].lower():
-                                client_socket.send(len(fhir_message).to_bytes(HEADER_LENGTH, byteorder='big') + fhir_message.encode('utf-8'))
-                                found = True
-                                break
-                        if not found:
-                            error_message = json.dumps({"type": "error", "message": f"User '{message_data['target']}' not found"})
-                            notified_socket.send(len(error_message).to_bytes(HEADER_LENGTH, byteorder='big') + error_message.encode('utf-8'))
-                    else:
-                        for client in clients.keys():
-                            if client != notified_socket:
-                                client.send(len(fhir_message).to_bytes(HEADER_LENGTH, byteorder='big') + fhir_message.encode('utf-8'))
-                else:
-                    error_message = json.dumps({"type": "error", "message": validation_message})
-                    notified_socket.send(len(error_message).to_bytes(HEADER_LENGTH, byteorder='big') + error_message.encode('utf-8'))
-            elif message_data['type'] == 'media':
-                decrypted_media = cipher_suite.decrypt(message_data['data'].encode('latin1'))
-                filename = save_file(decrypted_media, message_data['filename'], MEDIA_FILES_DIR)
-                file_url = f"http://localhost:8000/media_files/{filename}"
-                media_message = json.dumps({"type": "media", "nick": user, "data": file_url})
-                if message_data.get('target'):
-                    found = False
-                    for client_socket, nickname in clients.items():
-                        if nickname.lower() == message_data['target'].lower():
-                            client_socket.send(len(media_message).to_bytes(HEADER_LENGTH, byteorder='big') + media_message.encode('utf-8'))
-                            found = True
-                            break
-                    if not found:
-                        error_message = json.dumps({"type": "error", "message": f"User '{message_data['target']}' not found"})
-                        notified_socket.send(len(error_message).to_bytes(HEADER_LENGTH, byteorder='big') + error_message.encode('utf-8'))
-                else:
-                    for client in clients.keys():
-                        if client != notified_socket:
-                            client.send(len(media_message).to_bytes(HEADER_LENGTH, byteorder='big') + media_message.encode('utf-8'))
-            elif message_data['type'] == 'private':
-                target_nick = message_data['target']
-                private_message = message_data['message']
-                found = False
-                for client_socket, nickname in clients.items():
-                    if nickname.lower() == target_nick.lower():
-                        private_packet = json.dumps({"type": "private", "nick": user, "message": private_message})
-                        client_socket.send(len(private_packet).to_bytes(HEADER_LENGTH, byteorder='big') + private_packet.encode('utf-8'))
-                        found = True
-                        break
-                if not found:
-                    error_message = json.dumps({"type": "error", "message": f"User '{target_nick}' not found"})
-                    notified_socket.send(len(error_message).to_bytes(HEADER_LENGTH, byteorder='big') + error_message.encode('utf-8'))
+# Function to verify a completed upload off the loop, then publish it
+def finish_upload(notified_socket, transfer):
+    transfer_id = transfer.transfer_id
+    release_upload(notified_socket, transfer_id)
+    user = clients[notified_socket]
+    if transfer.kind == 'fhir':
+        route, filename = "fhir_files", f"{transfer.raw_sha256 or transfer.sha256}.json"
+    else:
+        route, filename = "media_files", media_object_name(transfer.filename, transfer.raw_sha256 or transfer.sha256)
+    url = file_url(route, filename)
+
+    def upload_verified(result, error):
+        if error:
+            send_packet(notified_socket, {"type": "error", "message": str(error), "transfer_id": transfer_id})
+            return
+        is_complete, message, counters = result
+        compression_stats.merge(counters)
+        transfer.discard()
+        if not is_complete:
+            send_packet(notified_socket, {"type": "error", "message": message, "transfer_id": transfer_id})
+            return
+        send_packet(notified_socket, {"type": "upload_done", "transfer_id": transfer_id})
+        route_packet(notified_socket, {"type": transfer.kind, "nick": user, "data": url}, transfer.target, transfer.room)
+
+    worker_pool.submit(notified_socket, process_finished_upload,
+                       (transfer.part_path, file_store.root, route, filename, transfer.sha256,
+                        transfer.kind == 'fhir', transfer.compression, transfer.raw_sha256),
+                       upload_verified)
+
+# Function to process one message from a joined user
+def handle_message(notified_socket, message_data, payload=None, flags=0):
+    user = clients[notified_socket]
+
+    if message_data['type'] == 'fhir':
+        target_nick = message_data.get('target')
+        room = message_room(notified_socket, message_data)
+
+        def fhir_done(result, error):
+            if error:
+                send_packet(notified_socket, {"type": "error", "message": f"Invalid FHIR Data: {error}"})
+                return
+            is_valid, validation_message, filename, counters = result
+            compression_stats.merge(counters)
+            if is_valid:
+                fhir_message = {"type": "fhir", "nick": user, "data": file_url("fhir_files", filename)}
+                route_packet(notified_socket, fhir_message, target_nick, room)
             else:
-                chat_message = json.dumps({"type": "chat", "nick": user, "message": message_data['message']})
-                for client in clients.keys():
-                    if client != notified_socket:
-                        client.send(len(chat_message).to_bytes(HEADER_LENGTH, byteorder='big') + chat_message.encode('utf-8'))
-
-    for notified_socket in exception_sockets:
-        sockets_list.remove(notified_socket)
-        del clients[notified_socket]
-        del encryption_keys[notified_socket]
-        del nicknames[notified_socket]
+                send_packet(notified_socket, {"type": "error", "message": validation_message})
+
+        worker_pool.submit(notified_socket, process_fhir,
+                           (encryption_keys[notified_socket], encrypted_token(message_data, payload, flags),
+                            file_store.root, message_data.get('compression')),
+                           fhir_done)
+    elif message_data['type'] == 'media':
+        filename = os.path.basename(message_data['filename'])
+        target_nick = message_data.get('target')
+        room = message_room(notified_socket, message_data)
+
+        def media_done(result, error):
+            if error:
+                send_packet(notified_socket, {"type": "error", "message": f"Could not store media file: {error}"})
+                return
+            media_message = {"type": "media", "nick": user, "data": file_url("media_files", result)}
+            route_packet(notified_socket, media_message, target_nick, room)
+
+        worker_pool.submit(notified_socket, process_media,
+                           (encryption_keys[notified_socket], encrypted_token(message_data, payload, flags),
+                            filename, file_store.root),
+                           media_done)
+    elif message_data['type'] == 'upload_start':
+        try:
+            start_upload(notified_socket, message_data)
+        except TransferError as e:
+            send_packet(notified_socket, {"type": "error", "message": str(e), "transfer_id": message_data.get('transfer_id')})
+    elif message_data['type'] == 'upload_chunk':
+        try:
+            receive_upload_chunk(notified_socket, message_data, payload, flags)
+        except TransferError as e:
+            upload_failed(notified_socket, message_data.get('transfer_id'), str(e))
+    elif message_data['type'] == 'upload_cancel':
+        cancel_upload(notified_socket, str(message_data.get('transfer_id')))
+    elif message_data['type'] == 'private':
+        unpack_text(message_data, payload, 'message', MAX_CHAT_TEXT, compression_stats)
+        target_nick = message_data['target']
+        private_packet = {"type": "private", "nick": user, "message": message_data['message']}
+        send_to_nick(notified_socket, target_nick, private_packet)
+    elif message_data['type'] == 'room_join':
+        join_room(notified_socket, room_name(message_data.get('room')))
+    elif message_data['type'] == 'room_leave':
+        leave_room(notified_socket, room_name(message_data.get('room')))
+    elif message_data['type'] == 'ping':
+        send_packet(notified_socket, {"type": "pong"})
+    elif message_data['type'] == 'pong':
+        pass  # Receiving it already refreshed last_seen
+    elif message_data['type'] == 'room_list':
+        rooms = [{"room": room, "members": members} for room, members in room_index.listing()]
+        send_packet(notified_socket, {"type": "room_list", "rooms": rooms})
+    else:
+        unpack_text(message_data, payload, 'message', MAX_CHAT_TEXT, compression_stats)
+        room = message_room(notified_socket, message_data)
+        broadcast({"type": "chat", "nick": user, "message": message_data['message'], "room": room},
+                  exclude=notified_socket)
+
+# Function to read whatever a client has sent and process every complete frame
+def read_from_client(notified_socket):
+    started = time.perf_counter()
+    try:
+        data = notified_socket.recv(RECV_BUFFER_SIZE)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError as e:
+        print(f"Error receiving data: {e}")
+        data = b""
+    if not data:
+        remove_client(notified_socket)
+        return
+    last_seen[notified_socket] = time.monotonic()
+
+    try:
+        frames = decoders[notified_socket].feed(data)
+    except FrameError as e:
+        print(f"Error receiving data: {e}")
+        remove_client(notified_socket)
+        return
+    metrics.inc("received_bytes_total", len(data))
+    metrics.observe("stage_seconds", time.perf_counter() - started, stage="receive")
+
+    for frame in frames:
+        if notified_socket not in decoders:
+            return
+        started = time.perf_counter()
+        message_type = "other"
+        try:
+            message_data, payload, flags = decode_packet(frame)
+            if message_data.get('type') in MESSAGE_TYPES:
+                message_type = message_data['type']
+            if notified_socket in clients:
+                handle_message(notified_socket, message_data, payload, flags)
+            else:
+                handle_hello(notified_socket, message_data)
+        except (SessionError, ReplayError) as e:
+            # The hello was refused: tell the client why before dropping it
+            send_packet(notified_socket, {"type": "error", "message": str(e)})
+            remove_client(notified_socket)
+        except (RoomError, CompressionError) as e:
+            send_packet(notified_socket, {"type": "error", "message": str(e)})
+        except Exception as e:
+            print(f"Error processing message from {addresses.get(notified_socket)}: {e}")
+            if notified_socket not in clients:
+                remove_client(notified_socket)
+        metrics.inc("messages_received_total", type=message_type)
+        metrics.observe("handle_seconds", time.perf_counter() - started, type=message_type)
+
+    # Stop reading from a sender whose jobs are piling up in the pool
+    if notified_socket in decoders and worker_pool.busy(notified_socket):
+        paused_clients.add(notified_socket)
+        update_interest(notified_socket)
+
+# Function to run finished pool jobs and resume senders that drained
+def run_worker_completions():
+    for client_socket in worker_pool.run_completions():
+        if client_socket in paused_clients and not worker_pool.busy(client_socket):
+            paused_clients.discard(client_socket)
+            update_interest(client_socket)
+
+# Function to deliver what other shards sent over the bus
+def handle_bus_messages(read=True):
+    try:
+        messages = bus.pending_messages(read)
+    except BusError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    for operation, body in messages:
+        if operation == BUS_BROADCAST:
+            broadcast_local(body["packet"])
+        elif operation == BUS_ROUTE:
+            target_socket = find_client(body["target"])
+            if target_socket is not None:
+                send_packet(target_socket, body["packet"])
+
+# Function to send this shard's counters to the hub for /stats
+def report_stats():
+    stats = fanout_stats()
+    stats["shard"] = bus.shard_id
+    bus.send(BUS_STATS, {"stats": stats, "metrics": metrics.snapshot()})
+
+# Main server loop
+next_stats_report = time.monotonic()
+while True:
+    now = time.monotonic()
+    timeout = idle_timers.timeout(now)
+    if bus is not None:
+        timeout = STATS_INTERVAL if timeout is None else min(timeout, STATS_INTERVAL)
+    if presence.flush_at is not None:
+        flush_in = max(0.0, presence.flush_at - now)
+        timeout = flush_in if timeout is None else min(timeout, flush_in)
+    if accept_resume_at is not None:
+        resume_in = max(0.0, accept_resume_at - now)
+        timeout = resume_in if timeout is None else min(timeout, resume_in)
+    for key, events in selector.select(timeout):
+        notified_socket = key.fileobj
+        if notified_socket == server_socket:
+            accept_connections()
+            continue
+        if notified_socket is bus:
+            handle_bus_messages()
+            continue
+        if notified_socket == worker_pool.wakeup_reader:
+            run_worker_completions()
+            continue
+        if events & selectors.EVENT_WRITE and notified_socket in outboxes:
+            if not flush_client(notified_socket):
+                remove_client(notified_socket)
+                continue
+            update_interest(notified_socket)
+        if events & selectors.EVENT_READ and notified_socket in decoders:
+            read_from_client(notified_socket)
+    now = time.monotonic()
+    for client_socket in idle_timers.advance(now):
+        if client_socket in last_seen:
+            check_idle(client_socket, now)
+    if presence.flush_at is not None and now >= presence.flush_at:
+        fan_out(presence.take_delta(), presence_clients)
+    if accept_resume_at is not None and now >= accept_resume_at:
+        selector.register(server_socket, selectors.EVENT_READ)
+        accept_resume_at = None
+    if bus is not None:
+        # Bus traffic that arrived while a nickname claim waited on the hub
+        if bus.backlog:
+            handle_bus_messages(read=False)
+        if time.monotonic() >= next_stats_report:
+            report_stats()
+            next_stats_report = time.monotonic() + STATS_INTERVAL
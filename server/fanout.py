@@ -0,0 +1,159 @@
+# OUTBOUND FAN-OUT QUEUES
+
+import socket
+from collections import deque
+
+# Constants
+DEFAULT_MAX_QUEUE_BYTES = 8 * 1024 * 1024  # 8 MB per client
+MAX_IOVECS = 64
+POLICIES = ["drop", "disconnect", "coalesce"]
+CONTROL_HEADROOM = 2  # control frames may fill a queue to this multiple of its limit before the client is dropped
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# Bounded queue of encoded frames waiting to be written to one client.
+# Frames are stored by reference, so a broadcast shares one bytes object
+# across every recipient's queue instead of copying it per client. New
+# frames can be held back (while a client's replay is read); held frames
+# count against the same limit and policy but are not sent until released.
+# The slow consumer policy only drops or coalesces frames pushed as
+# droppable (broadcast chat and presence). Control frames such as acks,
+# errors and replies are always queued, and only a queue far past its
+# limit disconnects the client.
+class ClientOutbox:
+    def __init__(self, max_bytes=DEFAULT_MAX_QUEUE_BYTES, policy="drop"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.frames = deque()
+        self.droppable = deque()  # One flag per frame in frames
+        self.offset = 0  # Bytes of frames[0] already written
+        self.queued_bytes = 0
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.dropped_frames = 0
+        self.coalesced_frames = 0
+        self.skipped_since_notice = 0
+        self.sent_bytes = 0
+        self.peak_depth = 0
+        self.overflowed = False
+        self.held = None  # Frames held back, or None when not holding
+        self.held_droppable = deque()
+
+    def __len__(self):
+        return len(self.frames)
+
+    # Function to queue a frame; returns False if the client must be disconnected
+    def push(self, frame, droppable=False):
+        size = len(frame)
+        over = self.queued_bytes + size > self.max_bytes and (self.frames or self.held)
+        if over and not droppable:
+            if self.queued_bytes + size > self.max_bytes * CONTROL_HEADROOM:
+                self.overflowed = True
+                return False
+        elif over:
+            if self.policy == "disconnect":
+                self.overflowed = True
+                return False
+            if self.policy == "drop":
+                self.dropped_frames += 1
+                self.skipped_since_notice += 1
+                return True
+            # Coalesce: discard the oldest frames that have not started sending
+            # so the client skips ahead to the most recent traffic
+            if self.held is not None:
+                self._discard(self.held, self.held_droppable, 0, size)
+            else:
+                self._discard(self.frames, self.droppable, 1 if self.offset else 0, size)
+        if self.held is None:
+            self.frames.append(frame)
+            self.droppable.append(droppable)
+        else:
+            self.held.append(frame)
+            self.held_droppable.append(droppable)
+        self.queued_bytes += size
+        depth = len(self.frames) + len(self.held or ())
+        if depth > self.peak_depth:
+            self.peak_depth = depth
+        return True
+
+    # Function to discard droppable frames from `position` on, oldest first,
+    # until a frame of `size` bytes fits
+    def _discard(self, frames, droppable, position, size):
+        while self.queued_bytes + size > self.max_bytes and position < len(frames):
+            if not droppable[position]:
+                position += 1
+                continue
+            self.queued_bytes -= len(frames[position])
+            del frames[position]
+            del droppable[position]
+            self.coalesced_frames += 1
+            self.skipped_since_notice += 1
+
+    def hold(self):
+        self.held = deque()
+
+    # Function to stop holding frames back; returns the held frames with
+    # their droppable flags, no longer counted against the limit, for the
+    # caller to queue again
+    def release(self):
+        held = list(zip(self.held or (), self.held_droppable))
+        self.held = None
+        self.held_droppable = deque()
+        self.queued_bytes -= sum(len(frame) for frame, _ in held)
+        return held
+
+    # Function to write queued frames; returns False if the socket failed
+    def flush(self, client_socket):
+        while self.frames:
+            try:
+                if HAS_SENDMSG:
+                    buffers = [memoryview(self.frames[0])[self.offset:]]
+                    for i in range(1, min(len(self.frames), MAX_IOVECS)):
+                        buffers.append(self.frames[i])
+                    sent = client_socket.sendmsg(buffers)
+                else:
+                    sent = client_socket.send(memoryview(self.frames[0])[self.offset:])
+            except (BlockingIOError, InterruptedError):
+                return True
+            except OSError:
+                return False
+            if sent == 0:
+                return True
+            self.sent_bytes += sent
+            self.queued_bytes -= sent
+            # Retire every frame that was written completely
+            sent += self.offset
+            self.offset = 0
+            while self.frames and sent >= len(self.frames[0]):
+                sent -= len(self.frames.popleft())
+                self.droppable.popleft()
+            self.offset = sent
+        return True
+
+# Counters carried over from the outboxes of clients that disconnected, so
+# the totals reported by summarize() only ever go up
+class OutboxTotals:
+    def __init__(self):
+        self.dropped_frames = 0
+        self.coalesced_frames = 0
+        self.sent_bytes = 0
+
+    def add(self, outbox):
+        self.dropped_frames += outbox.dropped_frames
+        self.coalesced_frames += outbox.coalesced_frames
+        self.sent_bytes += outbox.sent_bytes
+
+# Function to aggregate queue counters across every client outbox, plus the
+# totals of outboxes already closed
+def summarize(outboxes, closed=None):
+    outboxes = list(outboxes)
+    closed = closed or OutboxTotals()
+    return {
+        "clients": len(outboxes),
+        "queued_frames": sum(len(outbox) for outbox in outboxes),
+        "bytes_in_flight": sum(outbox.queued_bytes for outbox in outboxes),
+        "max_queue_depth": max((len(outbox) for outbox in outboxes), default=0),
+        "peak_queue_depth": max((outbox.peak_depth for outbox in outboxes), default=0),
+        "dropped_frames": closed.dropped_frames + sum(outbox.dropped_frames for outbox in outboxes),
+        "coalesced_frames": closed.coalesced_frames + sum(outbox.coalesced_frames for outbox in outboxes),
+        "sent_bytes": closed.sent_bytes + sum(outbox.sent_bytes for outbox in outboxes),
+    }
@@ -0,0 +1,228 @@
+# HTTP FILE SERVER
+
+# Serves received files over HTTP. Each connection gets its own thread, so
+# one large download does not hold up anyone else's link. File bodies are
+# sent with sendfile() straight from the page cache, and the server handles
+# single byte ranges (partial and resumed downloads), ETag/Last-Modified
+# revalidation with 304 responses, and gzip for routes marked compressible.
+
+import os
+import stat
+import gzip
+import json
+import shutil
+import mimetypes
+import threading
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote
+
+# Constants
+DEFAULT_HTTP_HOST = "localhost"
+DEFAULT_HTTP_PORT = 8000
+GZIP_MIN_SIZE = 1024  # bytes; smaller files are sent as they are
+GZIP_SUFFIX = ".gz"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+# Function to keep a gzip copy next to a file, rebuilding it when the file
+# is newer; returns the path of the copy, or None if it cannot be written
+def compressed_copy(filepath, file_stat):
+    gzip_path = filepath + GZIP_SUFFIX
+    try:
+        if os.stat(gzip_path).st_mtime_ns >= file_stat.st_mtime_ns:
+            return gzip_path
+    except FileNotFoundError:
+        pass
+    temp_path = f"{gzip_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(filepath, 'rb') as source, gzip.open(temp_path, 'wb', compresslevel=6) as target:
+            shutil.copyfileobj(source, target)
+        os.replace(temp_path, gzip_path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+    return gzip_path
+
+# Request handler for files under a fixed set of routes. Subclasses set
+# `routes` to {"<url prefix>": (directory, compressible)} and may override
+# resolve() to look files up somewhere other than the route's directory,
+# get_stats() to serve a JSON document at /stats, and get_metrics() to serve
+# Prometheus metrics text at /metrics.
+class FileRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive; every response has a Content-Length
+    timeout = 60  # seconds an idle keep-alive connection holds its thread
+    routes = {}
+
+    def get_stats(self):
+        return None
+
+    def get_metrics(self):
+        return None
+
+    # Function to map a route and file name to a path, or None if there is
+    # no such file
+    def resolve(self, prefix, name):
+        return os.path.join(self.routes[prefix][0], name)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def serve(self, send_body):
+        path = unquote(urlsplit(self.path).path)
+        if path == '/stats':
+            stats = self.get_stats()
+            if stats is not None:
+                self.send_json(stats, send_body)
+                return
+        if path == '/metrics':
+            metrics = self.get_metrics()
+            if metrics is not None:
+                self.send_document(metrics.encode('utf-8'), METRICS_CONTENT_TYPE, send_body)
+                return
+        prefix, _, name = path.lstrip('/').partition('/')
+        route = self.routes.get(prefix)
+        # Only plain file names directly inside a route's directory
+        if route is None or not name or name != os.path.basename(name) or name.startswith('.'):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        filepath = self.resolve(prefix, name)
+        if filepath is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        self.send_file(filepath, route[1], send_body)
+
+    def send_json(self, document, send_body):
+        self.send_document(json.dumps(document).encode('utf-8'), "application/json", send_body)
+
+    def send_document(self, body, content_type, send_body):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_file(self, filepath, compressible, send_body):
+        try:
+            f = open(filepath, 'rb')
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        with f:
+            file_stat = os.fstat(f.fileno())
+            if not stat.S_ISREG(file_stat.st_mode):
+                self.send_error(HTTPStatus.NOT_FOUND)
+                return
+            content_type = mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+            last_modified = self.date_time_string(int(file_stat.st_mtime))
+            gzip_path = None
+            if compressible and file_stat.st_size >= GZIP_MIN_SIZE and self.accepts_gzip():
+                gzip_path = compressed_copy(filepath, file_stat)
+            # The gzip body is a different representation, so it has its own ETag
+            etag = f'"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}{"-gz" if gzip_path else ""}"'
+
+            if self.not_modified(etag, file_stat.st_mtime):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_validators(etag, last_modified, compressible)
+                self.end_headers()
+                return
+
+            if gzip_path:
+                f.close()
+                f = open(gzip_path, 'rb')
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                try:
+                    byte_range = self.requested_range(size, etag, last_modified)
+                except RangeNotSatisfiable:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                start, end = byte_range or (0, size - 1)
+                length = end - start + 1 if size else 0
+
+                self.send_response(HTTPStatus.PARTIAL_CONTENT if byte_range else HTTPStatus.OK)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(length))
+                if byte_range:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                if gzip_path:
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_validators(etag, last_modified, compressible)
+                self.end_headers()
+                if send_body and length:
+                    try:
+                        # socket.sendfile() uses os.sendfile(), so the body never
+                        # passes through Python
+                        self.connection.sendfile(f, start, length)
+                    except (BrokenPipeError, ConnectionResetError):
+                        self.close_connection = True
+
+    def send_validators(self, etag, last_modified, compressible):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Accept-Ranges", "bytes")
+        if compressible:
+            self.send_header("Vary", "Accept-Encoding")
+
+    def accepts_gzip(self):
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = coding.strip().partition(';')
+            if name.strip().lower() == 'gzip':
+                return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+        return False
+
+    # Function to evaluate If-None-Match, or If-Modified-Since without it
+    def not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or f"W/{etag}" in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+        return False
+
+    # Function to parse a single "bytes=" range; returns (start, end) or None
+    # to send the whole file. Multiple ranges are answered with the whole file.
+    def requested_range(self, size, etag, last_modified):
+        header = self.headers.get('Range')
+        if not header or not header.startswith('bytes=') or ',' in header:
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range.strip() not in (etag, last_modified):
+            return None  # The file changed since the client's partial copy
+        start_text, _, end_text = header[len('bytes='):].strip().partition('-')
+        try:
+            if start_text:
+                start = int(start_text)
+                end = min(int(end_text), size - 1) if end_text else size - 1
+            else:
+                suffix_length = int(end_text)
+                if suffix_length <= 0:
+                    raise RangeNotSatisfiable()
+                start, end = max(0, size - suffix_length), size - 1
+        except ValueError:
+            return None
+        if start < 0 or start >= size or start > end:
+            raise RangeNotSatisfiable()
+        return start, end
+
+# Function to serve requests on a thread per connection until the process exits
+def serve_files(host, port, handler):
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.serve_forever()
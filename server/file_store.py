@@ -0,0 +1,198 @@
+# RECEIVED FILE STORE
+
+# Received files are stored as objects under a route ("fhir_files",
+# "media_files") and a name that is unique for its content: FHIR resources
+# are named by their SHA-256, media files by a digest prefix and the
+# original file name. Objects live in hash-prefix sharded directories
+# (ab/cd/<name>), so no directory grows past a few hundred entries.
+#
+# Writes go to a temporary file that is renamed into place, so readers
+# never see a partial object. An SQLite index maps (route, name) to the
+# object's path, size and times. The HTTP server resolves links with one
+# index lookup instead of touching directories, and the garbage collector
+# picks objects to delete from it. Reads are recorded in memory and written
+# to the index in batches by the collector thread, which then deletes
+# objects past the age limit and evicts the least recently used ones until
+# the store is under its size limit.
+#
+# Worker jobs, the HTTP thread and the collector each use their own SQLite
+# connection; WAL mode lets them read while another writes.
+
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+# Constants
+INDEX_NAME = "index.sqlite3"
+TEMP_DIR = "tmp"
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024 * 1024  # 10 GB
+DEFAULT_MAX_AGE = 30 * 24 * 3600  # 30 days
+GC_INTERVAL = 60  # seconds between collector runs
+GC_BATCH = 256  # objects evicted per index query
+SIDECAR_SUFFIXES = (".gz",)  # derived copies written next to an object by the HTTP server
+
+# Function to build a collision-free name for a media file from its content
+# digest and the name the sender gave it
+def media_object_name(filename, sha256):
+    filename = os.path.basename(filename).lstrip('.') or "file"
+    return f"{sha256[:16]}-{filename}"
+
+class FileStore:
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_path = os.path.join(root, INDEX_NAME)
+        self.temp_dir = os.path.join(root, TEMP_DIR)
+        os.makedirs(self.temp_dir, exist_ok=True)
+        self.local = threading.local()
+        self.accessed = {}  # (route, name) -> time of the latest read not yet in the index
+        self.access_lock = threading.Lock()
+        self.evicted_objects = 0
+        self.evicted_bytes = 0
+        with self.db() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS objects (
+                              route TEXT NOT NULL, name TEXT NOT NULL, path TEXT NOT NULL,
+                              size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL,
+                              PRIMARY KEY (route, name))""")
+            db.execute("CREATE INDEX IF NOT EXISTS objects_by_access ON objects (last_access)")
+            db.execute("CREATE INDEX IF NOT EXISTS objects_by_age ON objects (created)")
+
+    # Function to get this thread's index connection; a forked worker opens
+    # its own instead of sharing its parent's
+    def db(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.index_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    # Function to find where an object lives: <root>/<route>/ab/cd/<name>
+    def path_for(self, route, name):
+        shard = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, route, shard[:2], shard[2:4], name)
+
+    def temp_path(self):
+        return os.path.join(self.temp_dir, f"{os.getpid()}.{threading.get_ident()}.{time.monotonic_ns()}.tmp")
+
+    # Function to store bytes as an object. An object that already exists
+    # has the same content (names are derived from it) and is kept; storing
+    # it again restarts its age, since a new link to it was just shared.
+    def put_bytes(self, route, name, data):
+        path = self.path_for(route, name)
+        if not os.path.exists(path):
+            temp_path = self.temp_path()
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            self._move_into_place(temp_path, path)
+        self._record(route, name, path)
+        return name
+
+    # Function to move a finished file (e.g. a completed upload) into the store
+    def put_file(self, route, name, source_path):
+        path = self.path_for(route, name)
+        if os.path.exists(path):
+            os.remove(source_path)
+        else:
+            try:
+                self._move_into_place(source_path, path)
+            except OSError:
+                # Different file system: copy into the store's temp directory first
+                temp_path = self.temp_path()
+                shutil.copyfile(source_path, temp_path)
+                self._move_into_place(temp_path, path)
+                os.remove(source_path)
+        self._record(route, name, path)
+        return name
+
+    def _move_into_place(self, temp_path, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def _record(self, route, name, path):
+        now = time.time()
+        with self.db() as db:
+            db.execute("""INSERT INTO objects (route, name, path, size, created, last_access) VALUES (?, ?, ?, ?, ?, ?)
+                          ON CONFLICT (route, name) DO UPDATE SET created = excluded.created,
+                                                                   last_access = excluded.last_access""",
+                       (route, name, path, os.path.getsize(path), now, now))
+
+    # Function to resolve an object to its path for a read, or None
+    def lookup(self, route, name):
+        row = self.db().execute("SELECT path FROM objects WHERE route = ? AND name = ?", (route, name)).fetchone()
+        if row is None:
+            return None
+        with self.access_lock:
+            self.accessed[(route, name)] = time.time()
+        return row[0]
+
+    def stats(self):
+        objects, total = self.db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects").fetchone()
+        return {"objects": objects, "bytes": total, "max_bytes": self.max_bytes,
+                "evicted_objects": self.evicted_objects, "evicted_bytes": self.evicted_bytes}
+
+    # Function to run the collector on a daemon thread; each task in `tasks`
+    # (other clean-up, e.g. of unfinished uploads) runs after every collection
+    def start_collector(self, interval=GC_INTERVAL, tasks=()):
+        thread = threading.Thread(target=self._run_collector, args=(interval, tasks), daemon=True)
+        thread.start()
+        return thread
+
+    def _run_collector(self, interval, tasks):
+        while True:
+            time.sleep(interval)
+            try:
+                self.collect()
+                for task in tasks:
+                    task()
+            except (OSError, sqlite3.Error) as e:
+                print(f"Error collecting received files: {e}")
+
+    # Function to save recorded reads, then delete expired objects and evict
+    # the least recently used ones while the store is over its size limit
+    def collect(self):
+        with self.access_lock:
+            accessed, self.accessed = self.accessed, {}
+        db = self.db()
+        with db:
+            db.executemany("UPDATE objects SET last_access = MAX(last_access, ?) WHERE route = ? AND name = ?",
+                           [(when, route, name) for (route, name), when in accessed.items()])
+        if self.max_age:
+            cutoff = time.time() - self.max_age
+            while True:
+                rows = db.execute("SELECT route, name, path, size FROM objects WHERE created < ? LIMIT ?",
+                                  (cutoff, GC_BATCH)).fetchall()
+                if not rows:
+                    break
+                self._delete(rows)
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        while total > self.max_bytes:
+            rows = db.execute("SELECT route, name, path, size FROM objects ORDER BY last_access LIMIT ?",
+                              (GC_BATCH,)).fetchall()
+            if not rows:
+                break
+            victims = []
+            for row in rows:
+                if total <= self.max_bytes:
+                    break
+                victims.append(row)
+                total -= row[3]
+            self._delete(victims)
+
+    def _delete(self, rows):
+        for route, name, path, size in rows:
+            for victim in (path,) + tuple(path + suffix for suffix in SIDECAR_SUFFIXES):
+                try:
+                    os.remove(victim)
+                except FileNotFoundError:
+                    pass
+            self.evicted_objects += 1
+            self.evicted_bytes += size
+        with self.db() as db:
+            db.executemany("DELETE FROM objects WHERE route = ? AND name = ?", [(row[0], row[1]) for row in rows])
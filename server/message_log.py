@@ -0,0 +1,400 @@
+# PERSISTENT MESSAGE LOG
+
+# Append-only log of room traffic, split into segments. Each segment has a
+# data file of records (header + packet JSON) and an index file with one
+# fixed-size entry per record (timestamp, byte offset). Sequence numbers are
+# dense, so the index entry for a sequence number is found by position alone.
+# Readers memory-map the index to jump straight to the first record they
+# need, and to binary-search it by time.
+#
+# append() only queues the packet. A writer thread serialises the queued
+# records, writes each batch with one write() call, and fsyncs at most once
+# per fsync interval. Full segments are closed and a new one is started, and
+# old segments are deleted once the log is over its size or age limit.
+# If a write fails, the open segment is cut back to its last complete
+# record and the records not written go back on the queue to be retried.
+#
+# A log ID, kept in a file next to the segments, names this log. A new one
+# is made whenever the log starts empty, so clients can tell that sequence
+# numbers they saved belong to a log that no longer exists.
+
+import os
+import json
+import math
+import mmap
+import time
+import uuid
+import bisect
+import struct
+import threading
+
+# Constants
+RECORD_HEADER = struct.Struct('!QdI')  # sequence number, unix time, body length
+INDEX_ENTRY = struct.Struct('!dQ')  # unix time, offset of the record in the data file
+DATA_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+LOG_ID_NAME = "log_id"
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024  # 64 MB
+DEFAULT_RETENTION_BYTES = 1024 * 1024 * 1024  # 1 GB
+DEFAULT_RETENTION_SECONDS = 7 * 24 * 3600  # 7 days
+DEFAULT_FSYNC_INTERVAL = 0.2  # seconds
+DEFAULT_REPLAY_LIMIT = 1000  # messages
+RETENTION_CHECK_INTERVAL = 60  # seconds
+
+class ReplayError(Exception):
+    pass
+
+# Function to check the point a client asked to be replayed from: `since`
+# must be a sequence number and `since_time` a Unix time
+def check_replay_point(hello):
+    if 'since_time' in hello:
+        since_time = hello['since_time']
+        if isinstance(since_time, bool) or not isinstance(since_time, (int, float)) or not math.isfinite(since_time):
+            raise ReplayError("since_time must be a Unix time")
+    elif 'since' in hello:
+        since = hello['since']
+        if isinstance(since, bool) or not isinstance(since, int) or since < 0:
+            raise ReplayError("since must be a message sequence number")
+
+def segment_path(directory, first_seq, suffix):
+    return os.path.join(directory, f"{first_seq:020d}{suffix}")
+
+# Function to list the first sequence number of every segment, oldest first
+def list_segments(directory):
+    firsts = []
+    for name in os.listdir(directory):
+        if name.endswith(DATA_SUFFIX) and name[:-len(DATA_SUFFIX)].isdigit():
+            firsts.append(int(name[:-len(DATA_SUFFIX)]))
+    return sorted(firsts)
+
+# Function to memory-map a segment index; returns None for an empty index
+def map_index(directory, first_seq):
+    with open(segment_path(directory, first_seq, INDEX_SUFFIX), 'rb') as f:
+        if os.fstat(f.fileno()).st_size < INDEX_ENTRY.size:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def index_entries(index):
+    return len(index) // INDEX_ENTRY.size if index is not None else 0
+
+# Function to read the records with since < seq <= until. Only the newest
+# max_count records (and as many as fit in max_bytes) are returned, so a
+# client that was away for a long time gets the recent traffic. The byte
+# range of those records is looked up in the index, and only that range is
+# read. Returns (records, truncated) where records are (seq, ts, body)
+# tuples.
+def read_records(directory, since, until, max_count=DEFAULT_REPLAY_LIMIT, max_bytes=None):
+    start = max(since + 1, until - max_count + 1)
+    truncated = start > since + 1
+    firsts = list_segments(directory)
+    if start > until or not firsts:
+        return [], truncated
+    if start < firsts[0]:
+        truncated = truncated or since + 1 < firsts[0]
+        start = firsts[0]
+    # (segment, offsets of the records wanted, offset just past the last one)
+    ranges = []
+    first_segment = max(bisect.bisect_right(firsts, start) - 1, 0)
+    for first_seq in firsts[first_segment:]:
+        if first_seq > until:
+            break
+        try:
+            index = map_index(directory, first_seq)
+            size = os.path.getsize(segment_path(directory, first_seq, DATA_SUFFIX))
+        except FileNotFoundError:
+            continue  # Removed by retention while we were reading
+        entries = index_entries(index)
+        first_entry = max(start, first_seq) - first_seq
+        end_entry = min(until - first_seq + 1, entries)
+        if first_entry < end_entry:
+            offsets = [INDEX_ENTRY.unpack_from(index, entry * INDEX_ENTRY.size)[1]
+                       for entry in range(first_entry, end_entry)]
+            end = INDEX_ENTRY.unpack_from(index, end_entry * INDEX_ENTRY.size)[1] if end_entry < entries else size
+            ranges.append((first_seq, offsets, end))
+        if index is not None:
+            index.close()
+    if max_bytes is not None:
+        # Keep the newest records that fit
+        budget = max_bytes
+        for position in range(len(ranges) - 1, -1, -1):
+            first_seq, offsets, end = ranges[position]
+            keep = bisect.bisect_left(offsets, end - budget)
+            if keep:
+                kept = [(first_seq, offsets[keep:], end)] if keep < len(offsets) else []
+                ranges = kept + ranges[position + 1:]
+                truncated = True
+                break
+            budget -= end - offsets[0]
+    records = []
+    for first_seq, offsets, end in ranges:
+        try:
+            with open(segment_path(directory, first_seq, DATA_SUFFIX), 'rb') as data:
+                data.seek(offsets[0])
+                block = data.read(end - offsets[0])
+        except FileNotFoundError:
+            continue
+        view = memoryview(block)
+        cursor = 0
+        while cursor + RECORD_HEADER.size <= len(view):
+            seq, ts, length = RECORD_HEADER.unpack_from(view, cursor)
+            body_start = cursor + RECORD_HEADER.size
+            if seq > until or body_start + length > len(view):
+                break
+            records.append((seq, ts, bytes(view[body_start:body_start + length])))
+            cursor = body_start + length
+    return records, truncated
+
+# Function to find the first sequence number logged at or after a time
+def seq_at_time(directory, timestamp):
+    for first_seq in list_segments(directory):
+        try:
+            index = map_index(directory, first_seq)
+        except FileNotFoundError:
+            continue
+        entries = index_entries(index)
+        if not entries:
+            continue
+        low, high = 0, entries
+        while low < high:
+            middle = (low + high) // 2
+            if INDEX_ENTRY.unpack_from(index, middle * INDEX_ENTRY.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        index.close()
+        if low < entries:
+            return first_seq + low
+    return None
+
+class MessageLog:
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, retention_bytes=DEFAULT_RETENTION_BYTES,
+                 retention_seconds=DEFAULT_RETENTION_SECONDS, fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        self.data_file = None
+        self.index_file = None
+        self.segment_first = None
+        self.segment_size = 0
+        self.segment_records = 0
+        self.next_seq = self._recover()
+        self.log_id = self._load_log_id(self.next_seq == 1)
+        self.written_seq = self.next_seq - 1
+        self.flushed_seq = self.written_seq
+        self.torn = False
+        self.lock = threading.Lock()
+        self.queued = []
+        self.writing = []
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.dirty = False
+        self.last_fsync = time.monotonic()
+        self.last_retention_check = time.monotonic()
+        self.writer = threading.Thread(target=self._run, daemon=True)
+        self.writer.start()
+
+    # Function to queue a packet; returns its sequence number. The packet is
+    # serialised on the writer thread, so it must not be changed afterwards.
+    def append(self, packet):
+        seq = self.next_seq
+        self.next_seq += 1
+        with self.lock:
+            self.queued.append((seq, time.time(), packet))
+        self.wakeup.set()
+        return seq
+
+    # Function to split a replay into the part already in the data files
+    # (up to the returned sequence number) and the queued records after
+    # `since` that the writer has not written yet
+    def snapshot(self, since):
+        with self.lock:
+            unwritten = [record for record in self.writing + self.queued if record[0] > since]
+            return self.written_seq, unwritten
+
+    def stats(self):
+        firsts = list_segments(self.directory)
+        return {
+            "next_seq": self.next_seq,
+            "segments": len(firsts),
+            "bytes": sum(self._segment_bytes(first_seq) for first_seq in firsts),
+        }
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.writer.join()
+
+    # Function to reopen the newest segment after a restart. Its index is
+    # rebuilt from the data file, and a record cut short by a crash is
+    # truncated away.
+    def _recover(self):
+        firsts = list_segments(self.directory)
+        if not firsts:
+            return 1
+        first_seq = firsts[-1]
+        data_path = segment_path(self.directory, first_seq, DATA_SUFFIX)
+        with open(data_path, 'rb') as f:
+            block = f.read()
+        entries = bytearray()
+        position = 0
+        seq = first_seq - 1
+        while position + RECORD_HEADER.size <= len(block):
+            record_seq, ts, length = RECORD_HEADER.unpack_from(block, position)
+            if record_seq != seq + 1 or position + RECORD_HEADER.size + length > len(block):
+                break
+            entries += INDEX_ENTRY.pack(ts, position)
+            seq = record_seq
+            position += RECORD_HEADER.size + length
+        with open(data_path, 'r+b') as f:
+            f.truncate(position)
+        with open(segment_path(self.directory, first_seq, INDEX_SUFFIX), 'wb') as f:
+            f.write(entries)
+        self._open_segment(first_seq)
+        return seq + 1
+
+    # Function to read the log ID, or to make a new one for an empty log
+    def _load_log_id(self, empty):
+        path = os.path.join(self.directory, LOG_ID_NAME)
+        if not empty:
+            try:
+                with open(path) as f:
+                    log_id = f.read().strip()
+                if log_id:
+                    return log_id
+            except FileNotFoundError:
+                pass
+        log_id = uuid.uuid4().hex
+        with open(path, 'w') as f:
+            f.write(log_id)
+        return log_id
+
+    def _open_segment(self, first_seq):
+        if self.data_file is not None:
+            self._sync()
+            self.data_file.close()
+            self.index_file.close()
+        data_file = open(segment_path(self.directory, first_seq, DATA_SUFFIX), 'ab')
+        index_file = open(segment_path(self.directory, first_seq, INDEX_SUFFIX), 'ab')
+        self.segment_first = first_seq
+        self.data_file = data_file
+        self.index_file = index_file
+        self.segment_size = data_file.tell()
+        self.segment_records = index_file.tell() // INDEX_ENTRY.size
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.fsync_interval)
+            self.wakeup.clear()
+            with self.lock:
+                self.writing, self.queued = self.queued, []
+            failed = False
+            if self.writing:
+                try:
+                    if self.torn:
+                        self._rollback()
+                    self._write_batch(self.writing)
+                except OSError as e:
+                    if not self.torn:
+                        print(f"Error writing message log, retrying: {e}")
+                    self.torn = failed = True
+                # Records that did not reach the files stay unwritten, so
+                # replays still take them from memory
+                with self.lock:
+                    self.written_seq = self.flushed_seq
+                    self.queued[:0] = [record for record in self.writing if record[0] > self.flushed_seq]
+                    self.writing = []
+            if self.dirty and (self.closed or time.monotonic() - self.last_fsync >= self.fsync_interval):
+                self._sync()
+            if time.monotonic() - self.last_retention_check >= RETENTION_CHECK_INTERVAL:
+                self._apply_retention()
+            if self.closed and (failed or not self.queued):
+                return
+
+    def _write_batch(self, batch):
+        data = bytearray()
+        index = bytearray()
+        last_seq = None
+        for seq, ts, packet in batch:
+            body = json.dumps(packet, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            if self.data_file is None or self.segment_size + len(data) >= self.segment_bytes:
+                self._flush(data, index, last_seq)
+                data, index = bytearray(), bytearray()
+                self._open_segment(seq)
+                self._apply_retention()
+            index += INDEX_ENTRY.pack(ts, self.segment_size + len(data))
+            data += RECORD_HEADER.pack(seq, ts, len(body))
+            data += body
+            last_seq = seq
+        self._flush(data, index, last_seq)
+
+    def _flush(self, data, index, last_seq):
+        if not data:
+            return
+        # Data before index, so an index entry never points past the data
+        self.data_file.write(data)
+        self.data_file.flush()
+        self.index_file.write(index)
+        self.index_file.flush()
+        self.segment_size += len(data)
+        self.segment_records += len(index) // INDEX_ENTRY.size
+        self.flushed_seq = last_seq
+        self.dirty = True
+
+    # Function to cut the open segment back to its last complete record
+    # after a failed write, so that its data and index agree again
+    def _rollback(self):
+        if self.segment_first is None:
+            self.torn = False
+            return
+        for f in (self.data_file, self.index_file):
+            try:
+                f.close()
+            except OSError:
+                pass  # Whatever it still had buffered is cut off below
+        os.truncate(segment_path(self.directory, self.segment_first, DATA_SUFFIX), self.segment_size)
+        os.truncate(segment_path(self.directory, self.segment_first, INDEX_SUFFIX),
+                    self.segment_records * INDEX_ENTRY.size)
+        self.data_file = None
+        self._open_segment(self.segment_first)
+        self.torn = False
+
+    def _sync(self):
+        if self.data_file is not None and self.dirty:
+            os.fsync(self.data_file.fileno())
+            os.fsync(self.index_file.fileno())
+        self.dirty = False
+        self.last_fsync = time.monotonic()
+
+    def _segment_bytes(self, first_seq):
+        total = 0
+        for suffix in (DATA_SUFFIX, INDEX_SUFFIX):
+            try:
+                total += os.path.getsize(segment_path(self.directory, first_seq, suffix))
+            except FileNotFoundError:
+                pass
+        return total
+
+    # Function to delete the oldest closed segments while the log is over its
+    # size limit or they are older than the age limit
+    def _apply_retention(self):
+        self.last_retention_check = time.monotonic()
+        closed_segments = [first_seq for first_seq in list_segments(self.directory) if first_seq != self.segment_first]
+        total = sum(self._segment_bytes(first_seq) for first_seq in closed_segments) + self.segment_size
+        cutoff = time.time() - self.retention_seconds
+        for first_seq in closed_segments:
+            data_path = segment_path(self.directory, first_seq, DATA_SUFFIX)
+            try:
+                too_old = os.path.getmtime(data_path) < cutoff
+            except FileNotFoundError:
+                continue
+            if total <= self.retention_bytes and not too_old:
+                break
+            total -= self._segment_bytes(first_seq)
+            for suffix in (DATA_SUFFIX, INDEX_SUFFIX):
+                try:
+                    os.remove(segment_path(self.directory, first_seq, suffix))
+                except FileNotFoundError:
+                    pass
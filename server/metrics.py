@@ -0,0 +1,225 @@
+# SERVER METRICS
+
+# Counters, gauges and latency histograms for the event loop and the worker
+# jobs, served in the Prometheus text format at /metrics. Recording is a
+# dict lookup and a few additions, cheap enough to leave on in production;
+# gauges are callbacks that only run when /metrics is scraped.
+#
+# Worker jobs time their stages with `with stage("decrypt"):`. The worker
+# pool switches timing on around each job, wherever the job runs (thread or
+# process), and hands the timings back to the loop with the job's result.
+#
+# SIGUSR1 starts a sampling profiler. It records the main thread's stack
+# every few milliseconds and writes the counts as folded stacks, one
+# "frame;frame;frame count" line per stack, which flamegraph.pl and
+# speedscope read directly. A second SIGUSR1 stops it early.
+
+import os
+import sys
+import time
+import bisect
+import signal
+import threading
+from collections import Counter
+
+# Constants
+METRIC_PREFIX = "dpc_"
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # seconds
+DEFAULT_PROFILE_SECONDS = 10
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+
+# Every exported metric: name -> (type, help)
+METRICS = {
+    "messages_received_total": ("counter", "Frames received from clients, by message type"),
+    "frames_queued_total": ("counter", "Frames queued for sending to clients"),
+    "received_bytes_total": ("counter", "Bytes read from client sockets"),
+    "sent_bytes_total": ("counter", "Bytes written to client sockets"),
+    "slow_consumer_disconnects_total": ("counter", "Clients disconnected for not reading"),
+    "idle_disconnects_total": ("counter", "Connections closed for not answering pings in time"),
+    "stage_seconds": ("histogram", "Time spent in each stage of message processing"),
+    "handle_seconds": ("histogram", "Time the event loop spent handling one message, by type"),
+    "job_seconds": ("histogram", "Run time of worker pool jobs, by job"),
+    "connected_clients": ("gauge", "Users connected to this process"),
+    "outbound_queued_frames": ("gauge", "Frames waiting in client outboxes"),
+    "outbound_queued_bytes": ("gauge", "Bytes waiting in client outboxes"),
+    "worker_jobs_in_flight": ("gauge", "Worker pool jobs queued or running"),
+    "paused_clients": ("gauge", "Clients not being read until their jobs drain"),
+    "uploads_in_progress": ("gauge", "Chunked uploads being received"),
+    "rooms": ("gauge", "Rooms with at least one member"),
+    "online_users": ("gauge", "Users online on every shard"),
+}
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+# Metric store for one process. Series are created under a lock so the
+# HTTP thread can copy them while the loop records; updating an existing
+# series takes no lock.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}  # name -> callback
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(labels.items()))
+        try:
+            self.counters[key] += amount
+        except KeyError:
+            with self.lock:
+                self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        histogram.observe(seconds)
+
+    def gauge(self, name, callback):
+        self.gauges[name] = callback
+
+    # Function to record the timings a worker job brought back
+    def record_timings(self, timings):
+        for family, label, seconds in timings:
+            self.observe(f"{family}_seconds", seconds, **{family: label})
+
+    # Function to copy every series into plain lists, for rendering or for
+    # sending to the shard hub
+    def snapshot(self):
+        with self.lock:
+            counters = [[name, dict(labels), value] for (name, labels), value in self.counters.items()]
+            histograms = [[name, dict(labels), list(histogram.counts), histogram.total, histogram.count]
+                          for (name, labels), histogram in self.histograms.items()]
+        gauges = []
+        for name, callback in self.gauges.items():
+            try:
+                gauges.append([name, {}, callback()])
+            except RuntimeError:
+                pass  # The loop changed a dict while we read it; skip this scrape
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + "}"
+
+# Function to render snapshots in the Prometheus text format. Each snapshot
+# comes with extra labels (e.g. the shard), so several processes can be
+# exported as one document.
+def render(snapshots):
+    series = {}
+    for extra_labels, snapshot in snapshots:
+        for kind in ("counters", "gauges"):
+            for name, labels, value in snapshot.get(kind, ()):
+                series.setdefault(name, []).append(
+                    f"{METRIC_PREFIX}{name}{format_labels({**labels, **extra_labels})} {value}")
+        for name, labels, counts, total, count in snapshot.get("histograms", ()):
+            labels = {**labels, **extra_labels}
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{METRIC_PREFIX}{name}_bucket{format_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{METRIC_PREFIX}{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{METRIC_PREFIX}{name}_count{format_labels(labels)} {count}")
+    output = []
+    for name, lines in series.items():
+        kind, text = METRICS.get(name, ("untyped", name))
+        output.append(f"# HELP {METRIC_PREFIX}{name} {text}")
+        output.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+        output.extend(lines)
+    return "\n".join(output) + "\n"
+
+# Stage timing for worker jobs. Timings are kept per thread, and only while
+# the pool has switched timing on; elsewhere stage() records nothing.
+timing = threading.local()
+
+class StageTimer:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        timings = getattr(timing, "timings", None)
+        if timings is not None:
+            timings.append(("stage", self.name, time.perf_counter() - self.started))
+
+def stage(name):
+    return StageTimer(name)
+
+def start_timing():
+    timing.timings = []
+
+def stop_timing():
+    timings = getattr(timing, "timings", None) or []
+    timing.timings = None
+    return timings
+
+# Samples the main thread's stack from a background thread while running
+class SamplingProfiler:
+    def __init__(self, directory, seconds=DEFAULT_PROFILE_SECONDS, interval=PROFILE_INTERVAL):
+        self.directory = directory
+        self.seconds = seconds
+        self.interval = interval
+        self.thread = None
+        self.stop_requested = threading.Event()
+
+    def install(self, signum=getattr(signal, "SIGUSR1", None)):
+        if signum is None:
+            return False
+        signal.signal(signum, self.toggle)
+        return True
+
+    # Signal handler: start a profile, or stop the one that is running
+    def toggle(self, signum=None, frame=None):
+        if self.thread is not None and self.thread.is_alive():
+            self.stop_requested.set()
+            return
+        self.stop_requested.clear()
+        self.thread = threading.Thread(target=self.run, args=(threading.main_thread().ident,), daemon=True)
+        self.thread.start()
+
+    def run(self, thread_id):
+        samples = Counter()
+        deadline = time.monotonic() + self.seconds
+        print(f"*** Profiling for up to {self.seconds}s")
+        while time.monotonic() < deadline and not self.stop_requested.is_set():
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                samples[folded_stack(frame)] += 1
+            time.sleep(self.interval)
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"profile-{os.getpid()}-{int(time.time())}.folded")
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"*** Wrote {sum(samples.values())} stack samples to {path}")
+
+def folded_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
@@ -0,0 +1,69 @@
+# NICKNAME INDEX
+
+# Case-insensitive nickname -> socket index with per-base suffix counters,
+# so lookups and unique-nick assignment do not scan every connected user.
+# Suffixes freed by users who left are handed out again, smallest first,
+# and a base's counter is dropped once none of its suffixed nicks is left.
+
+import heapq
+
+# Suffixes handed out for one base nickname
+class SuffixCounter:
+    def __init__(self):
+        self.next = 1  # lowest suffix never handed out
+        self.free = []  # heap of suffixes handed out and freed again
+        self.live = 0  # suffixed nicks of this base still assigned
+
+class NicknameIndex:
+    def __init__(self):
+        self.sockets = {}
+        self.counters = {}  # base -> SuffixCounter
+        self.assigned = {}  # suffixed nick -> (base, suffix)
+
+    def __len__(self):
+        return len(self.sockets)
+
+    def __contains__(self, nick):
+        return nick.casefold() in self.sockets
+
+    # Function to find the socket registered under a nickname
+    def find(self, nick):
+        return self.sockets.get(nick.casefold())
+
+    # Function to pick the first free nickname for a base, e.g. "Alice (Doctor)1"
+    def unique(self, base_nick):
+        key = base_nick.casefold()
+        if key not in self.sockets:
+            return base_nick
+        counter = self.counters.setdefault(key, SuffixCounter())
+        count = None
+        while counter.free:
+            count = heapq.heappop(counter.free)
+            if f"{key}{count}" not in self.sockets:
+                break
+            count = None  # Taken by a user whose own nickname ends in digits
+        if count is None:
+            count = counter.next
+            while f"{key}{count}" in self.sockets:
+                count += 1
+            counter.next = count + 1
+        counter.live += 1
+        self.assigned[f"{key}{count}"] = (key, count)
+        return f"{base_nick}{count}"
+
+    def add(self, nick, client_socket):
+        self.sockets[nick.casefold()] = client_socket
+
+    def remove(self, nick):
+        key = nick.casefold()
+        self.sockets.pop(key, None)
+        assigned = self.assigned.pop(key, None)
+        if assigned is None:
+            return
+        base, count = assigned
+        counter = self.counters[base]
+        counter.live -= 1
+        if counter.live:
+            heapq.heappush(counter.free, count)
+        else:
+            del self.counters[base]
@@ -0,0 +1,61 @@
+# PRESENCE
+
+# Who is online, on every shard, with their category, and the join/leave
+# events that have not been sent out yet. Events are collected for a short
+# window and sent as one delta, so a burst of n joins costs each client one
+# frame instead of n. Only each user's latest state in the window is sent:
+# a user who joined and left again is only listed as having left. The
+# roster sent to a new client is the one as of the last delta, so the
+# pending delta brings it up to date without repeating anything.
+
+# Constants
+DEFAULT_PRESENCE_WINDOW = 0.25  # seconds
+
+class Presence:
+    def __init__(self):
+        self.roster = {}  # nick -> category
+        self.flushed = {}  # the roster as of the last delta
+        self.pending = {}  # nick -> category, or None once the user left
+        self.pending_seq = None
+        self.flush_at = None
+
+    def __len__(self):
+        return len(self.roster)
+
+    # Function to apply a join or leave packet; the first event of a window
+    # sets when the delta is due
+    def record(self, packet, now, window):
+        nick = packet['nick']
+        if packet['type'] == 'join':
+            category = packet.get('category') or ""
+            self.roster[nick] = category
+            self.pending[nick] = category
+        else:
+            self.roster.pop(nick, None)
+            self.pending[nick] = None
+        if 'seq' in packet:
+            self.pending_seq = packet['seq']
+        if self.flush_at is None:
+            self.flush_at = now + window
+
+    # Function to list everyone online as of the last delta as compact
+    # [nick, category] pairs
+    def snapshot(self):
+        return [[nick, category] for nick, category in self.flushed.items()]
+
+    # Function to take the pending events as one delta packet
+    def take_delta(self):
+        delta = {"type": "presence",
+                 "joined": [[nick, category] for nick, category in self.pending.items() if category is not None],
+                 "left": [nick for nick, category in self.pending.items() if category is None]}
+        if self.pending_seq is not None:
+            delta["seq"] = self.pending_seq
+        for nick, category in self.pending.items():
+            if category is None:
+                self.flushed.pop(nick, None)
+            else:
+                self.flushed[nick] = category
+        self.pending = {}
+        self.pending_seq = None
+        self.flush_at = None
+        return delta
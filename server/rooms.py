@@ -0,0 +1,77 @@
+# ROOM INDEX
+
+# Room membership kept from both sides: room -> member sockets for fan-out,
+# and socket -> rooms for leaving everything on disconnect. A broadcast to a
+# room only walks that room's members, however many users are connected.
+
+import re
+
+# Constants
+DEFAULT_ROOM = "lobby"
+ROOM_NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,31}$')
+
+class RoomError(Exception):
+    pass
+
+# Function to turn a user-supplied room name into its canonical form
+def room_name(name):
+    name = str(name or '').strip().lstrip('#')
+    if not ROOM_NAME_PATTERN.match(name):
+        raise RoomError("Room names are 1-32 letters, digits, '.', '_' or '-'")
+    return name.casefold()
+
+class RoomIndex:
+    def __init__(self):
+        self.members = {}
+        self.memberships = {}
+
+    def __len__(self):
+        return len(self.members)
+
+    # Function to add a member; returns False if it was already in the room
+    def join(self, room, client_socket):
+        members = self.members.setdefault(room, set())
+        if client_socket in members:
+            return False
+        members.add(client_socket)
+        self.memberships.setdefault(client_socket, set()).add(room)
+        return True
+
+    # Function to remove a member; returns False if it was not in the room.
+    # Empty rooms are dropped.
+    def leave(self, room, client_socket):
+        members = self.members.get(room)
+        if not members or client_socket not in members:
+            return False
+        members.discard(client_socket)
+        if not members:
+            del self.members[room]
+        rooms = self.memberships[client_socket]
+        rooms.discard(room)
+        if not rooms:
+            del self.memberships[client_socket]
+        return True
+
+    # Function to remove a member from every room; returns the rooms it left
+    def leave_all(self, client_socket):
+        rooms = self.memberships.pop(client_socket, set())
+        for room in rooms:
+            members = self.members[room]
+            members.discard(client_socket)
+            if not members:
+                del self.members[room]
+        return rooms
+
+    def members_of(self, room):
+        return self.members.get(room, ())
+
+    def rooms_of(self, client_socket):
+        return self.memberships.get(client_socket, set())
+
+    def is_member(self, room, client_socket):
+        return client_socket in self.members.get(room, ())
+
+    # Function to list (room, member count) pairs, busiest first
+    def listing(self):
+        return sorted(((room, len(members)) for room, members in self.members.items()),
+                      key=lambda item: (-item[1], item[0]))
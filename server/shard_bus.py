@@ -0,0 +1,253 @@
+# CROSS-SHARD MESSAGE BUS
+
+# With --shards N the server forks N shard processes that all accept on the
+# same port (SO_REUSEPORT), so each shard owns the connections the kernel
+# hands it. The parent process becomes the hub of a star-shaped bus with a
+# Unix socketpair to every shard. The hub relays broadcasts to the other
+# shards without decoding them, routes packets addressed to a nickname to
+# the shard that owns that user, and keeps the one nickname registry, so
+# nicknames stay unique across shards.
+#
+# Bus frames use the normal length prefix; the body is a one-byte operation
+# followed by JSON.
+
+import os
+import sys
+import json
+import socket
+import selectors
+from collections import deque
+from framing import FrameDecoder, encode_frame
+from nick_index import NicknameIndex
+
+# Operations
+BUS_BROADCAST = ord('B')  # {"packet"}: deliver to every user on every other shard
+BUS_ROUTE = ord('R')  # {"target", "packet", "sender"}: deliver to one user
+BUS_CLAIM = ord('C')  # {"id", "base"}: reserve a unique nickname
+BUS_CLAIMED = ord('c')  # {"id", "nick"}: the hub's answer to a claim
+BUS_RELEASE = ord('X')  # {"nick"}: a user left
+BUS_STATS = ord('S')  # {"stats", "metrics"}: a shard's latest /stats document and metrics snapshot
+
+# Constants
+RECV_BUFFER_SIZE = 256 * 1024
+
+class BusError(Exception):
+    pass
+
+def encode_bus_frame(operation, body):
+    return encode_frame(bytes([operation]) + json.dumps(body, separators=(',', ':')).encode('utf-8'))
+
+def decode_bus_frame(frame):
+    return frame[0], json.loads(bytes(frame[1:]).decode('utf-8'))
+
+# Function to fork the shard processes. Returns (hub, None) in the parent
+# and (None, shard_bus) in each shard.
+def start_shards(count):
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+        raise BusError("Sharding needs a platform with fork() and SO_REUSEPORT")
+    sys.stdout.flush()
+    hub_ends = []
+    pids = []
+    for shard_id in range(count):
+        hub_end, shard_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            hub_end.close()
+            for other in hub_ends:
+                other.close()
+            return None, ShardBus(shard_end, shard_id)
+        shard_end.close()
+        hub_ends.append(hub_end)
+        pids.append(pid)
+    return BusHub(hub_ends, pids), None
+
+# The shard's end of the bus. Sends block, which is safe because the hub
+# never stops reading; only nickname claims wait for an answer. A claim may
+# read everything the hub sent, so a readable event the main loop got
+# before the claim is stale: the next read is skipped, and the selector
+# reports the socket again if more has arrived since.
+class ShardBus:
+    def __init__(self, sock, shard_id):
+        self.sock = sock
+        self.shard_id = shard_id
+        self.decoder = FrameDecoder()
+        self.backlog = deque()
+        self.next_call_id = 0
+        self.drained = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, operation, body):
+        self.sock.sendall(encode_bus_frame(operation, body))
+
+    def publish(self, packet):
+        self.send(BUS_BROADCAST, {"packet": packet})
+
+    def route(self, target_nick, packet, sender_nick):
+        self.send(BUS_ROUTE, {"target": target_nick, "packet": packet, "sender": sender_nick})
+
+    def release(self, nick):
+        self.send(BUS_RELEASE, {"nick": nick})
+
+    # Function to reserve a nickname through the hub. Bus traffic that
+    # arrives meanwhile is kept for pending_messages().
+    def claim(self, base_nick):
+        self.next_call_id += 1
+        call_id = self.next_call_id
+        self.send(BUS_CLAIM, {"id": call_id, "base": base_nick})
+        claimed = None
+        while claimed is None:
+            # Keep everything else that came in the same read for the loop
+            for frame in self._read():
+                operation, body = decode_bus_frame(frame)
+                if claimed is None and operation == BUS_CLAIMED and body["id"] == call_id:
+                    claimed = body["nick"]
+                else:
+                    self.backlog.append((operation, body))
+        self.drained = True
+        return claimed
+
+    # Function to return the messages waiting on the bus; call when the
+    # socket is readable, or with read=False to drain only the backlog
+    def pending_messages(self, read=True):
+        messages = list(self.backlog)
+        self.backlog.clear()
+        if read and self.drained:
+            self.drained = False
+        elif read:
+            messages.extend(decode_bus_frame(frame) for frame in self._read())
+        return messages
+
+    def _read(self):
+        data = self.sock.recv(RECV_BUFFER_SIZE)
+        if not data:
+            raise BusError("The shard hub has exited")
+        return self.decoder.feed(data)
+
+# The hub: relays between shards and owns the nickname registry. Writes to
+# shards are buffered and non-blocking, so one busy shard cannot stall the
+# others.
+class BusHub:
+    def __init__(self, sockets, pids):
+        self.sockets = sockets
+        self.pids = pids
+        self.selector = selectors.DefaultSelector()
+        self.decoders = {}
+        self.outbound = {}
+        self.writing = set()
+        self.shard_ids = {}
+        self.owners = NicknameIndex()  # nick -> (shard ID, nick)
+        self.shard_stats = {}
+        self.shard_metrics = {}
+        for shard_id, sock in enumerate(sockets):
+            sock.setblocking(False)
+            self.decoders[sock] = FrameDecoder()
+            self.outbound[sock] = bytearray()
+            self.shard_ids[sock] = shard_id
+            self.selector.register(sock, selectors.EVENT_READ)
+
+    # Function to combine the latest stats of every shard for /stats
+    def stats(self):
+        shards = [self.shard_stats.get(shard_id, {}) for shard_id in range(len(self.sockets))]
+        return {
+            "shards": shards,
+            "clients": sum(shard.get("clients", 0) for shard in shards),
+            "registered_nicknames": len(self.owners),
+        }
+
+    # Function to list each shard's latest metrics snapshot, labelled with
+    # the shard, for /metrics
+    def metric_snapshots(self):
+        return [({"shard": shard_id}, snapshot) for shard_id, snapshot in sorted(self.shard_metrics.items())]
+
+    def run(self):
+        while self.decoders:
+            for key, events in self.selector.select():
+                sock = key.fileobj
+                if events & selectors.EVENT_WRITE and sock in self.decoders:
+                    self._flush(sock)
+                if events & selectors.EVENT_READ and sock in self.decoders:
+                    self._read(sock)
+
+    def _read(self, sock):
+        try:
+            data = sock.recv(RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._drop_shard(sock)
+            return
+        for frame in self.decoders[sock].feed(data):
+            self._handle(sock, frame)
+
+    def _handle(self, sock, frame):
+        shard_id = self.shard_ids[sock]
+        operation = frame[0]
+        if operation == BUS_BROADCAST:
+            relayed = encode_frame(frame)
+            for other in self.decoders:
+                if other is not sock:
+                    self._queue(other, relayed)
+            return
+        _, body = decode_bus_frame(frame)
+        if operation == BUS_ROUTE:
+            owner = self.owners.find(body["target"])
+            if owner is not None:
+                self._queue(self.sockets[owner[0]], encode_frame(frame))
+            else:
+                error = {"type": "error", "message": f"User '{body['target']}' not found"}
+                self._queue(sock, encode_bus_frame(BUS_ROUTE, {"target": body["sender"], "packet": error}))
+        elif operation == BUS_CLAIM:
+            nick = self.owners.unique(body["base"])
+            self.owners.add(nick, (shard_id, nick))
+            self._queue(sock, encode_bus_frame(BUS_CLAIMED, {"id": body["id"], "nick": nick}))
+        elif operation == BUS_RELEASE:
+            owner = self.owners.find(body["nick"])
+            if owner is not None and owner[0] == shard_id:
+                self.owners.remove(body["nick"])
+        elif operation == BUS_STATS:
+            self.shard_stats[shard_id] = body["stats"]
+            if "metrics" in body:
+                self.shard_metrics[shard_id] = body["metrics"]
+
+    def _queue(self, sock, frame):
+        if sock not in self.outbound:
+            return
+        buffer = self.outbound[sock]
+        was_idle = not buffer
+        buffer += frame
+        if was_idle:
+            self._flush(sock)
+
+    def _flush(self, sock):
+        buffer = self.outbound[sock]
+        try:
+            sent = sock.send(buffer)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._drop_shard(sock)
+            return
+        del buffer[:sent]
+        if bool(buffer) != (sock in self.writing):
+            self.writing.symmetric_difference_update((sock,))
+            self.selector.modify(sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if buffer else 0))
+
+    # Function to forget a shard that exited and tell the others its users left
+    def _drop_shard(self, sock):
+        shard_id = self.shard_ids[sock]
+        self.selector.unregister(sock)
+        del self.decoders[sock]
+        del self.outbound[sock]
+        self.writing.discard(sock)
+        sock.close()
+        print(f"--- Shard {shard_id} exited")
+        for owner_id, nick in list(self.owners.sockets.values()):
+            if owner_id == shard_id:
+                self.owners.remove(nick)
+                leave = encode_bus_frame(BUS_BROADCAST, {"packet": {"type": "leave", "nick": nick}})
+                for other in self.decoders:
+                    self._queue(other, leave)
@@ -0,0 +1,102 @@
+# HIERARCHICAL TIMER WHEEL
+
+# Deadlines for many connections, kept in a few rings of slots instead of a
+# sorted structure. Level 0 has one slot per tick; each slot of level 1
+# covers a whole turn of level 0, and so on. A timer goes into the finest
+# level whose ring reaches its deadline. When level 0 completes a turn, the
+# next level 1 slot is emptied and its timers move down to level 0, so each
+# timer is moved at most once per level.
+#
+# Scheduling and cancelling are a dict insert and a dict delete. Advancing
+# the wheel only looks at the slots of the ticks that passed, so a quiet
+# server pays for one slot per tick however many timers are waiting.
+
+import math
+
+# Constants
+DEFAULT_TICK = 1.0  # seconds
+SLOT_BITS = 6  # 64 slots per level
+LEVELS = 3  # 64 ticks, ~68 minutes and ~3 days at one-second ticks
+
+class TimerWheel:
+    def __init__(self, now, tick=DEFAULT_TICK, slot_bits=SLOT_BITS, levels=LEVELS):
+        self.tick = tick
+        self.slot_bits = slot_bits
+        self.slot_mask = (1 << slot_bits) - 1
+        self.wheels = [[{} for _ in range(1 << slot_bits)] for _ in range(levels)]
+        self.current = int(now / tick)  # the last tick processed
+        self.slots = {}  # key -> the slot dict holding it
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    # Function to (re)schedule a key to fire at a monotonic time, rounded up
+    # to the next tick; a deadline already passed fires on the next advance
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        self._place(key, max(math.ceil(deadline / self.tick), self.current + 1))
+
+    def cancel(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def _place(self, key, due):
+        top = len(self.wheels) - 1
+        for level in range(top + 1):
+            shift = self.slot_bits * level
+            if (due >> shift) - (self.current >> shift) <= self.slot_mask:
+                slot = self.wheels[level][(due >> shift) & self.slot_mask]
+                break
+        else:
+            # Beyond the top ring: park it in the top slot that comes round
+            # last; it is placed again from there
+            shift = self.slot_bits * top
+            slot = self.wheels[top][((self.current >> shift) - 1) & self.slot_mask]
+        slot[key] = due
+        self.slots[key] = slot
+
+    # Function to get the seconds until the wheel next needs advancing, or
+    # None when no timers are waiting
+    def timeout(self, now):
+        if not self.slots:
+            return None
+        return max(0.0, (self.current + 1) * self.tick - now)
+
+    # Function to advance to a monotonic time; returns the keys that fired
+    def advance(self, now):
+        target = int(now / self.tick)
+        expired = []
+        while self.current < target:
+            if not self.slots:
+                self.current = target
+                break
+            self.current += 1
+            if not self.current & self.slot_mask:
+                self._cascade(1)
+            slot = self.wheels[0][self.current & self.slot_mask]
+            if slot:
+                for key in slot:
+                    del self.slots[key]
+                expired.extend(slot)
+                slot.clear()
+        return expired
+
+    # Function to move the timers of the level's next slot down the wheel,
+    # after cascading the level above if this level completed a turn
+    def _cascade(self, level):
+        if level >= len(self.wheels):
+            return
+        shift = self.slot_bits * level
+        index = (self.current >> shift) & self.slot_mask
+        if not index:
+            self._cascade(level + 1)
+        slot = self.wheels[level][index]
+        if slot:
+            timers = list(slot.items())
+            slot.clear()
+            for key, due in timers:
+                self._place(key, due)
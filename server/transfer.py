@@ -0,0 +1,114 @@
+# CHUNKED UPLOAD RECEIVER
+
+import os
+import json
+import re
+import time
+
+# Constants
+UPLOADS_DIR = "./rendered_files/uploads/"
+DEFAULT_UPLOAD_MAX_AGE = 24 * 3600  # seconds an unfinished upload is kept for resuming
+TRANSFER_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+class TransferError(Exception):
+    pass
+
+# One upload being streamed to disk. Chunks are written into a .part file
+# at their offsets as they arrive, so memory use is one chunk regardless of
+# the file size. The upload's metadata is kept next to it in a .meta file so
+# that a client can resume it by transfer ID after reconnecting.
+class IncomingTransfer:
+    def __init__(self, transfer_id, kind, filename, size, chunk_size, sha256, target=None, storage_id=None, directory=UPLOADS_DIR):
+        self.transfer_id = transfer_id
+        self.kind = kind
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.sha256 = sha256
+        self.target = target
+        storage_id = storage_id or transfer_id
+        self.part_path = os.path.join(directory, f"{storage_id}.part")
+        self.meta_path = os.path.join(directory, f"{storage_id}.meta")
+        self.total_chunks = max(1, -(-size // chunk_size))
+        self.next_chunk = 0
+        self.written_chunks = 0
+        self.failed = False
+        self.cipher = "fernet"
+        self.nonce_prefix = None
+        self.room = None
+        self.compression = None  # codec the sender compressed the file with
+        self.raw_sha256 = None  # checksum of the file after decompression
+
+    # Function to prepare the .part file, picking up any chunks already on disk
+    def open(self):
+        previous = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                previous = json.load(f)
+        if previous != self.describe() or not os.path.exists(self.part_path):
+            # A different upload with the same ID starts from scratch
+            with open(self.meta_path, 'w') as f:
+                json.dump(self.describe(), f)
+            open(self.part_path, 'wb').close()
+            return self.next_chunk
+
+        # Only whole chunks count; a torn final write is discarded
+        complete = min(os.path.getsize(self.part_path) // self.chunk_size, self.total_chunks - 1)
+        os.truncate(self.part_path, complete * self.chunk_size)
+        self.next_chunk = self.written_chunks = complete
+        return self.next_chunk
+
+    def describe(self):
+        return {"kind": self.kind, "filename": self.filename, "size": self.size,
+                "chunk_size": self.chunk_size, "sha256": self.sha256, "target": self.target}
+
+    @property
+    def complete(self):
+        return self.written_chunks >= self.total_chunks
+
+    # Function to claim the next chunk, returning its offset and expected length
+    def reserve_chunk(self, index):
+        if self.failed:
+            raise TransferError("Upload was aborted")
+        if index != self.next_chunk or index >= self.total_chunks:
+            raise TransferError(f"Expected chunk {self.next_chunk}, got {index}")
+        self.next_chunk += 1
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def chunk_written(self):
+        self.written_chunks += 1
+
+    def discard(self):
+        for path in (self.part_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+# Function to delete unfinished uploads that nobody has resumed within
+# max_age seconds. An upload's age is taken from the newer of its .meta and
+# .part files, so one that is still receiving chunks is never removed.
+# Returns the number of uploads deleted.
+def sweep_abandoned(directory=UPLOADS_DIR, max_age=DEFAULT_UPLOAD_MAX_AGE):
+    last_used = {}
+    for name in os.listdir(directory):
+        storage_id, suffix = os.path.splitext(name)
+        if suffix not in (".part", ".meta"):
+            continue
+        try:
+            modified = os.path.getmtime(os.path.join(directory, name))
+        except FileNotFoundError:
+            continue
+        last_used[storage_id] = max(modified, last_used.get(storage_id, 0))
+    cutoff = time.time() - max_age
+    removed = 0
+    for storage_id, modified in last_used.items():
+        if modified >= cutoff:
+            continue
+        for suffix in (".part", ".meta"):
+            try:
+                os.remove(os.path.join(directory, storage_id + suffix))
+            except FileNotFoundError:
+                pass
+        removed += 1
+    return removed
@@ -0,0 +1,302 @@
+# WORKER POOL FOR CPU-HEAVY MESSAGE PROCESSING
+
+import os
+import time
+import json
+import socket
+import hashlib
+import queue
+import multiprocessing
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from cryptography.fernet import Fernet, InvalidToken # type: ignore
+from cryptography.exceptions import InvalidTag # type: ignore
+from session_crypto import STREAM_CIPHER, stream_cipher, open_chunk
+from fhir_handler import validate_fhir_data, fhir_digest, check_fhir_size
+from wire import encode_packet
+from framing import MAX_FRAME_SIZE
+from chunking import MAX_TRANSFER_SIZE
+from compression import CompressionStats, CompressionError, decompress, iter_decompressed
+from message_log import read_records
+from metrics import stage, start_timing, stop_timing
+from file_store import FileStore, media_object_name
+
+# Constants
+POOL_MODES = ["thread", "process"]
+DEFAULT_WORKERS = os.cpu_count() or 2
+DEFAULT_MAX_IN_FLIGHT = 8
+HASH_READ_SIZE = 1024 * 1024
+
+class JobError(Exception):
+    pass
+
+# Runs jobs on a thread or process pool and hands their results back to the
+# event loop. Jobs submitted under the same key (one per sender) run one at
+# a time and in order, so a client's chunks are written sequentially while
+# different clients are processed in parallel. Completions are queued and
+# signalled through a socketpair that the event loop watches like any other
+# socket; callbacks then run on the loop thread. Each job's stage timings
+# are passed to record_timings, if set, before its callback runs.
+class WorkerPool:
+    def __init__(self, mode="thread", workers=DEFAULT_WORKERS, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 record_timings=None):
+        if mode not in POOL_MODES:
+            raise ValueError(f"Unknown worker pool mode: {mode}")
+        if mode == "process":
+            # Workers are forked so they never re-run the server script itself
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                raise ValueError("The process pool needs a platform with fork()")
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+            # The first job forks every worker. Run one now, before the
+            # caller starts threads whose locks a child would inherit.
+            self.executor.submit(os.getpid).result()
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.mode = mode
+        self.max_in_flight = max_in_flight
+        self.record_timings = record_timings
+        self.lanes = {}
+        self.running = set()
+        self.completed = queue.SimpleQueue()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    # Function to prepare a connection's session key for its jobs. Thread
+    # workers share the server's memory, so they get one cipher object built
+    # here; process workers get the key and build a cipher per job. Either
+    # way the caller drops it when the client leaves.
+    def session_cipher(self, key, build):
+        return build(key) if self.mode == "thread" else key
+
+    # Function to queue a job; callback(result, error) runs on the loop thread
+    def submit(self, key, job, args, callback):
+        self.lanes.setdefault(key, deque()).append((job, args, callback))
+        if key not in self.running:
+            self._start_next(key)
+
+    # Function to tell whether a sender has reached its in-flight limit
+    def busy(self, key):
+        lane = self.lanes.get(key)
+        return lane is not None and len(lane) + (key in self.running) >= self.max_in_flight
+
+    def in_flight(self, key=None):
+        if key is not None:
+            return len(self.lanes.get(key, ())) + (key in self.running)
+        return sum(len(lane) for lane in self.lanes.values()) + len(self.running)
+
+    # Function to drop a sender's queued jobs; a job already running still
+    # completes, so its callback must check that the sender is still around
+    def forget(self, key):
+        lane = self.lanes.get(key)
+        if lane:
+            lane.clear()
+        if key not in self.running:
+            self.lanes.pop(key, None)
+
+    def _start_next(self, key):
+        lane = self.lanes.get(key)
+        if not lane:
+            self.lanes.pop(key, None)
+            return
+        job, args, callback = lane.popleft()
+        self.running.add(key)
+        future = self.executor.submit(run_timed, job, args)
+        future.add_done_callback(lambda future: self._post(key, callback, future))
+
+    # Called on a worker (or executor management) thread
+    def _post(self, key, callback, future):
+        self.completed.put((key, callback, future))
+        try:
+            self.wakeup_writer.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass  # A wakeup is already pending
+
+    # Function to run the callbacks of every finished job; call from the loop
+    def run_completions(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        finished = []
+        while True:
+            try:
+                key, callback, future = self.completed.get_nowait()
+            except queue.Empty:
+                break
+            self.running.discard(key)
+            self._start_next(key)
+            error = future.exception()
+            result = None
+            if not error:
+                result, timings = future.result()
+                if self.record_timings is not None:
+                    self.record_timings(timings)
+            try:
+                callback(result, error)
+            except Exception as e:
+                print(f"Error finishing worker job: {e}")
+            finished.append(key)
+        return finished
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# Function run in the pool around every job: returns the job's result with
+# the stage timings it recorded and its total run time
+def run_timed(job, args):
+    start_timing()
+    started = time.perf_counter()
+    try:
+        result = job(*args)
+    finally:
+        timings = stop_timing()
+    timings.append(("job", job.__name__, time.perf_counter() - started))
+    return result, timings
+
+# Jobs below run inside the pool. They only take and return plain values so
+# they also work with a process pool.
+
+# Jobs get a connection's cipher object, or its key from the process pool
+# (see WorkerPool.session_cipher)
+def fernet_for(encryption_key):
+    return Fernet(encryption_key) if isinstance(encryption_key, bytes) else encryption_key
+
+def stream_cipher_for(stream_key):
+    return stream_cipher(stream_key) if isinstance(stream_key, bytes) else stream_key
+
+# The file store is opened once per worker
+@functools.lru_cache(maxsize=None)
+def store_for(store_root):
+    return FileStore(store_root)
+
+def decrypt_token(encryption_key, token):
+    try:
+        with stage("decrypt"):
+            return fernet_for(encryption_key).decrypt(token)
+    except InvalidToken:
+        raise JobError("Message failed its integrity check")
+
+# Function to decrypt, decompress, validate and store a single-frame FHIR
+# upload under the SHA-256 of its contents; identical resources share one
+# object. Also returns the compression counters for the server's stats.
+def process_fhir(encryption_key, token, store_root, compression=None):
+    decrypted_fhir = decrypt_token(encryption_key, token)
+    stats = CompressionStats()
+    if compression:
+        try:
+            with stage("decompress"):
+                decrypted_fhir = decompress(compression, decrypted_fhir, MAX_FRAME_SIZE, stats)
+        except CompressionError as e:
+            raise JobError(str(e))
+    oversized = check_fhir_size(len(decrypted_fhir))
+    if oversized:
+        return oversized + (None, stats.counters)
+    digest = fhir_digest(decrypted_fhir)
+    with stage("fhir_validate"):
+        is_valid, validation_message = validate_fhir_data(decrypted_fhir.decode(), digest)
+    filename = f"{digest}.json"
+    if is_valid:
+        with stage("disk_write"):
+            store_for(store_root).put_bytes("fhir_files", filename, decrypted_fhir)
+    return is_valid, validation_message, filename, stats.counters
+
+# Function to decrypt and store a single-frame media upload; returns the
+# name of the stored object
+def process_media(encryption_key, token, filename, store_root):
+    data = decrypt_token(encryption_key, token)
+    name = media_object_name(filename, hashlib.sha256(data).hexdigest())
+    with stage("disk_write"):
+        return store_for(store_root).put_bytes("media_files", name, data)
+
+# Function to decrypt one upload chunk and write it at its offset
+def process_chunk(cipher, key, token, nonce_prefix, transfer_id, index, last, part_path, offset, expected_length):
+    if cipher == STREAM_CIPHER:
+        try:
+            with stage("decrypt"):
+                chunk = open_chunk(stream_cipher_for(key), nonce_prefix, index, last, token, transfer_id)
+        except InvalidTag:
+            raise JobError("Chunk failed its integrity check")
+    else:
+        chunk = decrypt_token(key, token)
+    if len(chunk) != expected_length:
+        raise JobError(f"Chunk has {len(chunk)} bytes, expected {expected_length}")
+    with stage("disk_write"), open(part_path, 'r+b') as f:
+        f.seek(offset)
+        f.write(chunk)
+    return len(chunk)
+
+def read_blocks(f):
+    while True:
+        block = f.read(HASH_READ_SIZE)
+        if not block:
+            return
+        yield block
+
+# Function to expand a compressed upload into a new file, streaming so that
+# at most max_size bytes are ever written; returns the SHA-256 of the output
+def decompress_upload(part_path, raw_path, compression, max_size, stats):
+    digest = hashlib.sha256()
+    with open(part_path, 'rb') as source, open(raw_path, 'wb') as target:
+        for output in iter_decompressed(compression, read_blocks(source), max_size, stats):
+            digest.update(output)
+            target.write(output)
+    return digest.hexdigest()
+
+# Function to verify a completed upload, decompress it, validate FHIR, and
+# move it into the file store as route/name. Compressed uploads carry the
+# checksum of the decompressed file as raw_sha256.
+def process_finished_upload(part_path, store_root, route, name, sha256, validate_fhir, compression=None,
+                            raw_sha256=None):
+    digest = hashlib.sha256()
+    with open(part_path, 'rb') as f:
+        for block in read_blocks(f):
+            digest.update(block)
+    if digest.hexdigest() != sha256:
+        os.remove(part_path)
+        return False, "File checksum does not match, upload discarded", None
+    stats = CompressionStats()
+    if compression:
+        raw_path = f"{part_path}.raw"
+        try:
+            with stage("decompress"):
+                raw_digest = decompress_upload(part_path, raw_path, compression, MAX_TRANSFER_SIZE, stats)
+        except CompressionError as e:
+            os.remove(raw_path)
+            os.remove(part_path)
+            return False, f"Could not decompress the upload: {e}", stats.counters
+        if raw_digest != raw_sha256:
+            os.remove(raw_path)
+            os.remove(part_path)
+            return False, "Decompressed file checksum does not match, upload discarded", stats.counters
+        os.replace(raw_path, part_path)
+        sha256 = raw_digest
+    if validate_fhir:
+        oversized = check_fhir_size(os.path.getsize(part_path))
+        if oversized:
+            os.remove(part_path)
+            return oversized + (stats.counters,)
+        with open(part_path, 'r') as f, stage("fhir_validate"):
+            is_valid, validation_message = validate_fhir_data(f.read(), sha256)
+        if not is_valid:
+            os.remove(part_path)
+            return False, validation_message, stats.counters
+    with stage("disk_write"):
+        store_for(store_root).put_file(route, name, part_path)
+    return True, "Upload complete", stats.counters
+
+# Function to load logged messages after `since` and encode them for one
+# client as a single block of frames, leaving out rooms it is not in
+def process_replay(directory, since, until, max_count, max_bytes, version, rooms=None):
+    with stage("log_read"):
+        records, truncated = read_records(directory, since, until, max_count, max_bytes)
+    frames = []
+    for seq, ts, body in records:
+        packet = json.loads(body)
+        if rooms is not None and 'room' in packet and packet['room'] not in rooms:
+            continue  # Traffic of rooms the client is not in
+        packet.update({"seq": seq, "ts": ts, "replay": True})
+        frames.append(encode_packet(packet, version=version))
+    return b"".join(frames), len(frames), truncated
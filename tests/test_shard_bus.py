@@ -0,0 +1,38 @@
+# SHARD BUS TESTS
+
+import os
+import sys
+import socket
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+from framing import FrameDecoder
+from shard_bus import ShardBus, BUS_BROADCAST, BUS_CLAIMED, decode_bus_frame, encode_bus_frame
+
+# Function to answer one nickname claim as the hub would, sending a
+# broadcast from another shard just before the answer
+def answer_claim(hub_end):
+    decoder = FrameDecoder()
+    frames = []
+    while not frames:
+        frames = decoder.feed(hub_end.recv(4096))
+    _, body = decode_bus_frame(frames[0])
+    hub_end.sendall(encode_bus_frame(BUS_BROADCAST, {"packet": {"type": "chat", "message": "hi"}}) +
+                    encode_bus_frame(BUS_CLAIMED, {"id": body["id"], "nick": "Alice (Other)"}))
+
+def test_stale_readable_event_after_claim_does_not_block():
+    hub_end, shard_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    shard_end.settimeout(2)  # a blocking read fails the test instead of hanging it
+    bus = ShardBus(shard_end, 0)
+    hub = threading.Thread(target=answer_claim, args=(hub_end,))
+    hub.start()
+    assert bus.claim("Alice (Other)") == "Alice (Other)"
+    hub.join()
+    # The main loop saw the bus readable before the claim drained it
+    messages = bus.pending_messages(read=True)
+    assert messages == [(BUS_BROADCAST, {"packet": {"type": "chat", "message": "hi"}})]
+    # Later traffic is read as usual
+    hub_end.sendall(encode_bus_frame(BUS_BROADCAST, {"packet": {"type": "leave", "nick": "Bob"}}))
+    assert bus.pending_messages(read=True) == [(BUS_BROADCAST, {"packet": {"type": "leave", "nick": "Bob"}})]
+    hub_end.close()
+    shard_end.close()